@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from aws_cdk import core
+from aws_cdk import core, aws_iam as iam
 
 from stacks.repo_stack import RepoStack
 from stacks.cloudformation_pipeline_stack import CloudformationPipelineStack
@@ -8,6 +8,17 @@ from stacks.s3_pipeline_stack import S3PipelineStack
 from stacks.cross_account_role_stack import CrossAccountRoleStack
 from stacks.pipeline_infra_stack import PipelineInfraStack
 from stacks.parameter_stack import ParameterStack
+from stacks.pipeline_telemetry_stack import PipelineTelemetryStack
+from stacks.branch_pipeline_factory_stack import (
+    BRANCH_PIPELINE_CONTEXT,
+    BranchPipelineFactoryStack,
+)
+from stacks.shared_pipeline_infra_stack import (
+    SharedPipelineInfraStack,
+    shared_artifact_bucket_name,
+)
+from stacks.fleet import create_fleet_role_stacks
+from stacks.pipeline_names import safe_branch_name
 
 import os
 
@@ -19,12 +30,15 @@ deploy_region = os.environ["CDK_DEFAULT_REGION"]
 # repo config
 repo = app.node.try_get_context("repo")
 branch = app.node.try_get_context("branch")
+# stack names can't have everything a branch name can, eg feature/x
+branch_name = safe_branch_name(branch) if branch else branch
 github_oauth_token = app.node.try_get_context("github_oauth_token")
 repo_owner = app.node.try_get_context("repo_owner")
 
 # buckets
 target_bucket = app.node.try_get_context("target_bucket")
 artifact_bucket = app.node.try_get_context("artifact_bucket")
+target_prefix = app.node.try_get_context("target_prefix")
 
 # build vars
 build_env = app.node.try_get_context("build_env")
@@ -37,6 +51,46 @@ cross_account_role = app.node.try_get_context("cross_account_role_arn")
 deployment_role_arn = app.node.try_get_context("deployment_role_arn")
 parameter_list = app.node.try_get_context("parameter_list")
 region = app.node.try_get_context("region")
+gitlab_repo_url = app.node.try_get_context("gitlab_repo_url")
+git_layer_arn = app.node.try_get_context("git_layer_arn")
+# a json file listing the target accounts (and their buckets and keys) to create cross account roles in
+fleet_file = app.node.try_get_context("fleet_file")
+# set by the branch pipeline factory, every role in the pipeline stack has to carry it
+permissions_boundary_arn = app.node.try_get_context("permissions_boundary_arn")
+
+
+def context_flag(key):
+    # context values passed on the command line arrive as strings, so "false" needs to be false
+    return str(app.node.try_get_context(key)).lower() in ("true", "yes", "1")
+
+
+preflight = context_flag("preflight")
+build_metrics = context_flag("build_metrics")
+# share one key and artifact bucket between all the pipelines deploying to a target account
+pooled = context_flag("pooled")
+# give builds the parameter loader, and store parameters as a hierarchy or a single json document
+load_parameters = context_flag("load_parameters")
+parameter_format = app.node.try_get_context("parameter_format")
+# have builds clone the repo rather than download a zip of it, optionally only checking out some paths
+full_clone = context_flag("full_clone")
+sparse_paths = app.node.try_get_context("sparse_paths")
+execution_mode = app.node.try_get_context("execution_mode")
+buildspec_model = app.node.try_get_context("buildspec_model")
+alarm_names = app.node.try_get_context("alarm_names")
+bake_minutes = app.node.try_get_context("bake_minutes")
+# how long artifact buckets keep build output and packages, and how many promoted releases
+artifact_retention_days = app.node.try_get_context("artifact_retention_days")
+package_retention_days = app.node.try_get_context("package_retention_days")
+releases_to_keep = app.node.try_get_context("releases_to_keep")
+# cross account role policies collapse resources to a wildcard once there are more than this many
+max_policy_resources = app.node.try_get_context("max_policy_resources")
+# unset means the stacks decide (locked by default for PARALLEL pipelines)
+deploy_lock = None
+if app.node.try_get_context("deploy_lock") != None:
+    deploy_lock = context_flag("deploy_lock")
+
+if execution_mode:
+    execution_mode = execution_mode.upper()
 
 if region:
     deploy_region = region
@@ -46,13 +100,24 @@ deploy_environment = core.Environment(account=account_num, region=deploy_region)
 if build_env == None:
     build_env = ""
 
+if pooled and target_account_id:
+    # create in the devops account, once per target account and region
+    SharedPipelineInfraStack(
+        app,
+        "create-shared-pipeline-infra-" + target_account_id,
+        target_account_id=target_account_id,
+        artifact_retention_days=artifact_retention_days,
+        package_retention_days=package_retention_days,
+        env=deploy_environment,
+    )
+
 if repo and branch:
 
-    if target_account_id:
+    if target_account_id and not pooled:
         # create in the devops account
         PipelineInfraStack(
             app,
-            "create-pipeline-infra-" + repo + "-" + branch,
+            "create-pipeline-infra-" + repo + "-" + branch_name,
             target_account_id=target_account_id,
             repo_name=repo,
             repo_branch=branch,
@@ -60,43 +125,81 @@ if repo and branch:
         )
 
     if devops_account_id:
+        # the shared bucket's name is known up front, so the role can be limited to it straight away
+        if pooled and not artifact_bucket:
+            artifact_bucket = shared_artifact_bucket_name(
+                devops_account_id, account_num, deploy_region
+            )
+
         CrossAccountRoleStack(
             app,
-            "create-cross-account-role-" + repo + "-" + branch,
+            "create-cross-account-role-" + repo + "-" + branch_name,
             devops_account_id=devops_account_id,
             pipeline_key_arn=pipeline_key_arn,
             artifact_bucket=artifact_bucket,
             target_bucket=target_bucket,
+            max_policy_resources=max_policy_resources,
             env=deploy_environment,
         )
 
+if fleet_file:
+    # create in every target account listed in the file, one role stack per account, region and
+    # pipeline type however many pipelines deploy there
+    create_fleet_role_stacks(
+        app,
+        fleet_file,
+        devops_account_id=devops_account_id,
+        pooled=pooled,
+        max_policy_resources=max_policy_resources,
+    )
+
 if repo:
     RepoStack(
         app,
         "create-repo-" + repo,
         repo_name=repo,
+        gitlab_webhook=context_flag("gitlab_webhook"),
+        gitlab_repo_url=gitlab_repo_url,
+        git_layer_arn=git_layer_arn,
         env=deploy_environment,
     )
 
+pipeline_stacks = []
+
 if all([target_bucket, repo, branch, cross_account_role]):
-    S3PipelineStack(
+    s3_pipeline_stack = S3PipelineStack(
         app,
-        "s3-create-pipeline-" + repo + "-" + branch,
+        "s3-create-pipeline-" + repo + "-" + branch_name,
         repo_name=repo,
         repo_branch=branch,
         build_env=build_env,
         target_bucket=target_bucket,
+        target_prefix=target_prefix,
         approvers=approvers,
         cross_account_role_arn=cross_account_role,
         env=deploy_environment,
         github_oauth_token=github_oauth_token,
         repo_owner=repo_owner,
+        execution_mode=execution_mode,
+        deploy_lock=deploy_lock,
+        alarm_names=alarm_names,
+        bake_minutes=bake_minutes,
+        build_metrics=build_metrics,
+        buildspec_model=buildspec_model,
+        pooled=pooled,
+        artifact_retention_days=artifact_retention_days,
+        package_retention_days=package_retention_days,
+        releases_to_keep=releases_to_keep,
+        load_parameters=load_parameters,
+        full_clone=full_clone,
+        sparse_paths=sparse_paths,
     )
+    pipeline_stacks.append(s3_pipeline_stack)
 
 if all([repo, branch, cross_account_role, deployment_role_arn]):
-    CloudformationPipelineStack(
+    cf_pipeline_stack = CloudformationPipelineStack(
         app,
-        "cf-create-pipeline-" + repo + "-" + branch,
+        "cf-create-pipeline-" + repo + "-" + branch_name,
         repo_name=repo,
         repo_branch=branch,
         github_oauth_token=github_oauth_token,
@@ -106,16 +209,65 @@ if all([repo, branch, cross_account_role, deployment_role_arn]):
         cross_account_role_arn=cross_account_role,
         deployment_role_arn=deployment_role_arn,
         approvers=approvers,
+        preflight=preflight,
+        execution_mode=execution_mode,
+        deploy_lock=deploy_lock,
+        alarm_names=alarm_names,
+        bake_minutes=bake_minutes,
+        build_metrics=build_metrics,
+        buildspec_model=buildspec_model,
+        pooled=pooled,
+        artifact_retention_days=artifact_retention_days,
+        package_retention_days=package_retention_days,
+        releases_to_keep=releases_to_keep,
+        load_parameters=load_parameters,
+        full_clone=full_clone,
+        sparse_paths=sparse_paths,
         env=deploy_environment,
     )
+    pipeline_stacks.append(cf_pipeline_stack)
+
+if permissions_boundary_arn:
+    for pipeline_stack in pipeline_stacks:
+        iam.PermissionsBoundary.of(pipeline_stack).apply(
+            iam.ManagedPolicy.from_managed_policy_arn(
+                pipeline_stack, "PermissionsBoundary", permissions_boundary_arn
+            )
+        )
 
 if all([parameter_list, repo, branch]):
     ParameterStack(
         app,
-        "parameter-stack-" + repo + "-" + branch,
+        "parameter-stack-" + repo + "-" + branch_name,
         repo_name=repo,
         repo_branch=branch,
         parameter_list=parameter_list,
+        parameter_format=parameter_format,
+        env=deploy_environment,
+    )
+
+if repo and context_flag("branch_pipelines"):
+    # create in the devops account, new branches of the repo then get a pooled pipeline of their own
+    BranchPipelineFactoryStack(
+        app,
+        "branch-pipelines-" + repo,
+        repo_name=repo,
+        pipeline_context={
+            key: app.node.try_get_context(key)
+            for key in BRANCH_PIPELINE_CONTEXT
+            if app.node.try_get_context(key) != None
+        },
+        branch_pattern=app.node.try_get_context("branch_pattern"),
+        idle_hours=app.node.try_get_context("idle_hours"),
+        delete_idle_deployments=context_flag("delete_idle_deployments"),
+        env=deploy_environment,
+    )
+
+if context_flag("telemetry"):
+    # one per devops account and region, it watches every pipeline created by this project
+    PipelineTelemetryStack(
+        app,
+        "create-pipeline-telemetry",
         env=deploy_environment,
     )
 
@@ -0,0 +1,236 @@
+"""Creates and tears down pipelines for short-lived branches.
+
+Receives two kinds of input:
+
+- "CodeCommit Repository State Change" events for the repo's branches. A new
+  branch (or a push to a branch whose pipeline was torn down for being idle)
+  gets a pipeline, and a deleted branch has its pipeline torn down
+- a scheduled event, which tears down the pipelines that haven't run for
+  IDLE_HOURS
+
+Pipelines are deployed and destroyed by the deployer CodeBuild project, which
+runs `cdk deploy`/`cdk destroy` for the branch's pipeline stack from a copy of
+this project. Only stacks tagged as made by this function are ever torn down,
+so pipelines created by hand for the same repo are left alone.
+
+The repo's default branch never gets a pipeline from here, whatever
+BRANCH_PATTERN is, as it's the branch with a pipeline made by hand.
+
+Branch names that can't go in a stack name, eg feature/x, get a safe name
+(feature-x-<hash>) for their stacks and pipeline, the same one the stacks
+give them. The idle sweep only knows a branch by its stack, so it works
+with the safe name, which maps to itself.
+
+For CloudFormation pipelines, deleting a branch also deletes the stack it
+deployed to the target account. A pipeline torn down for being idle leaves
+its deployed stack alone, unless DELETE_IDLE_DEPLOYMENTS is set.
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+import boto3
+from botocore.exceptions import ClientError
+
+REPO_NAME = os.environ.get("REPO_NAME")
+PROJECT_NAME = os.environ.get("PROJECT_NAME")
+STACK_PREFIX = os.environ.get("STACK_PREFIX")
+FACTORY_TAG = os.environ.get("FACTORY_TAG", "branch-pipeline-factory")
+BRANCH_PATTERN = os.environ.get("BRANCH_PATTERN", "*")
+IDLE_HOURS = float(os.environ.get("IDLE_HOURS", "72"))
+CROSS_ACCOUNT_ROLE_ARN = os.environ.get("CROSS_ACCOUNT_ROLE_ARN")
+# only set for CloudFormation pipelines, whose deployed stacks are deleted with them
+DEPLOYMENT_ROLE_ARN = os.environ.get("DEPLOYMENT_ROLE_ARN")
+DELETE_IDLE_DEPLOYMENTS = os.environ.get("DELETE_IDLE_DEPLOYMENTS") == "true"
+
+# branch names end up in stack names, which can only have letters, numbers and dashes
+STACK_SAFE_BRANCH = re.compile(r"^[A-Za-z0-9][A-Za-z0-9-]*$")
+BRANCH_HASH_LENGTH = 6
+ACTIVE_BUILD_STATUSES = ("IN_PROGRESS",)
+# how many of the deployer's recent builds to check for one already working on a branch
+RECENT_BUILDS = 50
+
+cloudformation = boto3.client("cloudformation")
+codebuild = boto3.client("codebuild")
+codepipeline = boto3.client("codepipeline")
+codecommit = boto3.client("codecommit")
+
+_default_branch = None
+
+
+def short_hash(value, length):
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()[:length]
+
+
+def safe_branch_name(branch):
+    # the same as stacks.pipeline_names.safe_branch_name()
+    if STACK_SAFE_BRANCH.match(branch):
+        return branch
+    safe = re.sub(r"[^A-Za-z0-9-]+", "-", branch).strip("-")
+    return (safe + "-" if safe else "") + short_hash(branch, BRANCH_HASH_LENGTH)
+
+
+def stack_name(branch):
+    return STACK_PREFIX + REPO_NAME + "-" + safe_branch_name(branch)
+
+
+def pipeline_name(branch):
+    # branch pipelines are pooled, so CodePipeline knows them by a name with a hash in it, the
+    # same as stacks.pipeline_names.pooled_codepipeline_name() gives them
+    name = REPO_NAME + "-" + safe_branch_name(branch)
+    return "pipeline-" + short_hash("pipeline-" + name, 8) + "-" + name
+
+
+def default_branch():
+    global _default_branch
+    if _default_branch is None:
+        _default_branch = codecommit.get_repository(repositoryName=REPO_NAME)[
+            "repositoryMetadata"
+        ].get("defaultBranch", "")
+    return _default_branch
+
+
+def is_managed_branch(branch):
+    if branch == default_branch():
+        return False
+    return fnmatch.fnmatchcase(branch, BRANCH_PATTERN)
+
+
+def describe_stack(name):
+    try:
+        return cloudformation.describe_stacks(StackName=name)["Stacks"][0]
+    except ClientError as e:
+        if "does not exist" in e.response["Error"]["Message"]:
+            return None
+        raise
+
+
+def made_by_us(stack):
+    return any(
+        tag["Key"] == FACTORY_TAG and tag["Value"] == REPO_NAME
+        for tag in stack.get("Tags", [])
+    )
+
+
+def build_in_progress(branch):
+    build_ids = codebuild.list_builds_for_project(
+        projectName=PROJECT_NAME, sortOrder="DESCENDING"
+    )["ids"][:RECENT_BUILDS]
+    if not build_ids:
+        return False
+    for build in codebuild.batch_get_builds(ids=build_ids)["builds"]:
+        if build["buildStatus"] not in ACTIVE_BUILD_STATUSES:
+            continue
+        variables = {
+            v["name"]: v["value"]
+            for v in build.get("environment", {}).get("environmentVariables", [])
+        }
+        # the sweep only knows a branch by its safe name
+        if safe_branch_name(variables.get("BRANCH", "")) == safe_branch_name(branch):
+            return True
+    return False
+
+
+def start_deployer(action, branch):
+    if build_in_progress(branch):
+        print("Already working on " + branch + ", not starting another " + action)
+        return None
+    build = codebuild.start_build(
+        projectName=PROJECT_NAME,
+        environmentVariablesOverride=[
+            {"name": "ACTION", "value": action, "type": "PLAINTEXT"},
+            {"name": "BRANCH", "value": branch, "type": "PLAINTEXT"},
+            {"name": "STACK", "value": stack_name(branch), "type": "PLAINTEXT"},
+        ],
+    )["build"]
+    print(json.dumps({"action": action, "branch": branch, "build": build["id"]}))
+    return build["id"]
+
+
+def delete_deployed_stack(branch):
+    # the pipeline stack's default, branch pipelines aren't given a stack name of their own
+    name = REPO_NAME + "-" + safe_branch_name(branch) + "-stack"
+    credentials = boto3.client("sts").assume_role(
+        RoleArn=CROSS_ACCOUNT_ROLE_ARN,
+        RoleSessionName=("teardown-" + safe_branch_name(branch))[:64],
+    )["Credentials"]
+    boto3.client(
+        "cloudformation",
+        aws_access_key_id=credentials["AccessKeyId"],
+        aws_secret_access_key=credentials["SecretAccessKey"],
+        aws_session_token=credentials["SessionToken"],
+    ).delete_stack(StackName=name, RoleARN=DEPLOYMENT_ROLE_ARN)
+    print("Deleting " + name + " from the target account")
+
+
+def tear_down(branch, stack, delete_deployment=False):
+    if not made_by_us(stack):
+        print(stack["StackName"] + " wasn't created for a branch, leaving it alone")
+        return None
+    if DEPLOYMENT_ROLE_ARN and delete_deployment:
+        delete_deployed_stack(branch)
+    return start_deployer("destroy", branch)
+
+
+def last_activity(branch, stack):
+    # the latest of the stack being deployed and the pipeline last starting
+    latest = stack.get("LastUpdatedTime") or stack["CreationTime"]
+    try:
+        executions = codepipeline.list_pipeline_executions(
+            pipelineName=pipeline_name(branch), maxResults=1
+        )["pipelineExecutionSummaries"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "PipelineNotFoundException":
+            raise
+        executions = []
+    if executions:
+        latest = max(latest, executions[0]["startTime"])
+    return latest
+
+
+def sweep_idle(now=None):
+    now = now or datetime.now(timezone.utc)
+    prefix = STACK_PREFIX + REPO_NAME + "-"
+    torn_down = []
+    for page in cloudformation.get_paginator("describe_stacks").paginate():
+        for stack in page["Stacks"]:
+            if not stack["StackName"].startswith(prefix) or not made_by_us(stack):
+                continue
+            if stack["StackStatus"].endswith("_IN_PROGRESS"):
+                continue
+            # the safe name, which is all the stack has
+            branch = stack["StackName"][len(prefix) :]
+            if branch == safe_branch_name(default_branch()):
+                continue
+            idle_hours = (now - last_activity(branch, stack)).total_seconds() / 3600
+            if idle_hours >= IDLE_HOURS:
+                print("%s has been idle for %.0f hours" % (branch, idle_hours))
+                tear_down(branch, stack, delete_deployment=DELETE_IDLE_DEPLOYMENTS)
+                torn_down.append(branch)
+    return torn_down
+
+
+def handle_branch_change(detail):
+    branch = detail.get("referenceName", "")
+    if detail.get("referenceType") != "branch" or not is_managed_branch(branch):
+        return None
+
+    stack = describe_stack(stack_name(branch))
+    if detail.get("event") == "referenceDeleted":
+        return tear_down(branch, stack, delete_deployment=True) if stack else None
+
+    # created, or pushed to after being torn down for being idle (or failing to create,
+    # which cdk deploy cleans up). an existing pipeline starts itself
+    if stack is None or stack["StackStatus"] == "ROLLBACK_COMPLETE":
+        return start_deployer("deploy", branch)
+    return None
+
+
+def handler(event, context):
+    if event.get("detail-type") == "Scheduled Event":
+        return {"torn_down": sweep_idle()}
+    return {"build": handle_branch_change(event.get("detail", {}))}
@@ -0,0 +1,146 @@
+"""Turns CodeBuild builds into phase timing and cache metrics.
+
+Receives two kinds of input:
+
+- "CodeBuild Build State Change" events for finished builds, whose phase list
+  gives the duration of every phase (QUEUED, PROVISIONING, DOWNLOAD_SOURCE,
+  INSTALL, PRE_BUILD, BUILD, POST_BUILD, UPLOAD_ARTIFACTS, ...)
+- CloudWatch Logs subscription batches from the build log group, filtered down
+  to the `CACHE_HIT <name>` / `CACHE_MISS <name>` marker lines builds print.
+  Only lines that are exactly a marker count, not the commands that print them
+
+and prints the results as embedded metric format (EMF) records:
+
+- PhaseDuration (Project, Phase)
+- BuildDuration, BuildSucceeded, BuildFailed (Project)
+- CacheHit, CacheMiss (Project)
+"""
+
+import base64
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+METRIC_NAMESPACE = os.environ.get("METRIC_NAMESPACE", "CodePipeline/Telemetry")
+# only whole lines, CodeBuild also logs each command before running it, and the command that
+# prints a marker can contain the marker text
+CACHE_MARKER = re.compile(r"^(CACHE_HIT|CACHE_MISS) (\S+)$")
+# phases that aren't part of the build itself, the build is timed from the first one after these
+WAITING_PHASES = ("SUBMITTED", "QUEUED")
+
+
+def metric(timestamp_ms, dimensions, values, properties=None):
+    record = {
+        "_aws": {
+            "Timestamp": int(timestamp_ms),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRIC_NAMESPACE,
+                    "Dimensions": [list(dimensions.keys())],
+                    "Metrics": [
+                        {"Name": name, "Unit": unit}
+                        for name, (value, unit) in values.items()
+                    ],
+                }
+            ],
+        }
+    }
+    record.update(dimensions)
+    record.update(properties or {})
+    record.update({name: value for name, (value, unit) in values.items()})
+    return record
+
+
+def _event_timestamp_ms(event):
+    return (
+        datetime.strptime(event["time"], "%Y-%m-%dT%H:%M:%SZ")
+        .replace(tzinfo=timezone.utc)
+        .timestamp()
+        * 1000
+    )
+
+
+def phase_metrics(event):
+    """EMF records for a finished build's phases."""
+    detail = event["detail"]
+    project = detail["project-name"]
+    info = detail.get("additional-information", {})
+    timestamp = _event_timestamp_ms(event)
+    properties = {"BuildId": detail.get("build-id")}
+
+    initiator = info.get("initiator", "")
+    if initiator.startswith("codepipeline/"):
+        properties["Pipeline"] = initiator.split("/", 1)[1]
+
+    records = []
+    build_seconds = 0
+    for phase in info.get("phases", []):
+        duration = phase.get("duration-in-seconds")
+        if duration is None:
+            continue
+        if phase["phase-type"] not in WAITING_PHASES:
+            build_seconds += duration
+        records.append(
+            metric(
+                timestamp,
+                {"Project": project, "Phase": phase["phase-type"]},
+                {"PhaseDuration": (duration, "Seconds")},
+                dict(properties, PhaseStatus=phase.get("phase-status")),
+            )
+        )
+
+    status = detail.get("build-status")
+    records.append(
+        metric(
+            timestamp,
+            {"Project": project},
+            {
+                "BuildDuration": (build_seconds, "Seconds"),
+                "BuildSucceeded": (1 if status == "SUCCEEDED" else 0, "Count"),
+                "BuildFailed": (1 if status == "FAILED" else 0, "Count"),
+            },
+            dict(properties, BuildStatus=status),
+        )
+    )
+    return records
+
+
+def cache_metrics(log_data, project):
+    """EMF records for the cache markers in a decoded CloudWatch Logs subscription batch."""
+    records = []
+    for log_event in log_data.get("logEvents", []):
+        match = CACHE_MARKER.match(log_event["message"].strip())
+        if not match:
+            continue
+        hit = match.group(1) == "CACHE_HIT"
+        records.append(
+            metric(
+                log_event["timestamp"],
+                {"Project": project},
+                {
+                    "CacheHit": (1 if hit else 0, "Count"),
+                    "CacheMiss": (0 if hit else 1, "Count"),
+                },
+                {
+                    "Cache": match.group(2),
+                    # CodeBuild names the log stream after the build
+                    "BuildId": log_data.get("logStream"),
+                },
+            )
+        )
+    return records
+
+
+def handler(event, context):
+    if "awslogs" in event:
+        log_data = json.loads(
+            gzip.decompress(base64.b64decode(event["awslogs"]["data"]))
+        )
+        records = cache_metrics(log_data, os.environ["PROJECT_NAME"])
+    else:
+        records = phase_metrics(event)
+
+    for record in records:
+        print(json.dumps(record))
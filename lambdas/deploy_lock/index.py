@@ -0,0 +1,167 @@
+"""Deploy lock for pipelines running in PARALLEL execution mode.
+
+Invoked as a CodePipeline Lambda action with UserParameters like:
+
+    {"operation": "acquire", "lock": "pipeline-repo-branch/deploy",
+     "pipeline": "pipeline-repo-branch", "execution_id": "<execution id>"}
+
+Acquiring waits (using continuation tokens) while another execution of the
+pipeline holds the lock. A lock held by an execution that is no longer in
+progress (eg it failed before reaching the release action) is taken over.
+"""
+
+import json
+import os
+import time
+import traceback
+
+import boto3
+from botocore.exceptions import ClientError
+
+LOCK_TABLE = os.environ.get("LOCK_TABLE")
+# give up before the Lambda action itself times out
+MAX_WAIT_SECONDS = int(os.environ.get("MAX_WAIT_SECONDS", "3000"))
+POLL_SECONDS = int(os.environ.get("POLL_SECONDS", "20"))
+ACTIVE_STATUSES = ("InProgress", "Stopping")
+
+dynamodb = boto3.client("dynamodb")
+codepipeline = boto3.client("codepipeline")
+
+
+def _put_lock(lock, execution_id, condition, values):
+    dynamodb.put_item(
+        TableName=LOCK_TABLE,
+        Item={
+            "lock_id": {"S": lock},
+            "execution_id": {"S": execution_id},
+            "acquired_at": {"N": str(int(time.time()))},
+        },
+        ConditionExpression=condition,
+        ExpressionAttributeValues=values,
+    )
+
+
+def _holder(lock):
+    item = dynamodb.get_item(
+        TableName=LOCK_TABLE, Key={"lock_id": {"S": lock}}, ConsistentRead=True
+    ).get("Item")
+    return item["execution_id"]["S"] if item else None
+
+
+def _is_active(pipeline, execution_id):
+    try:
+        execution = codepipeline.get_pipeline_execution(
+            pipelineName=pipeline, pipelineExecutionId=execution_id
+        )["pipelineExecution"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "PipelineExecutionNotFoundException":
+            return False
+        raise
+    return execution["status"] in ACTIVE_STATUSES
+
+
+def acquire(lock, pipeline, execution_id):
+    """Try to take the lock, returning the execution id currently holding it, or None once we hold it."""
+    try:
+        _put_lock(
+            lock,
+            execution_id,
+            "attribute_not_exists(lock_id) OR execution_id = :me",
+            {":me": {"S": execution_id}},
+        )
+        return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+    holder = _holder(lock)
+    if holder is None:
+        # released between our put and get, try again on the next poll
+        return "unknown"
+    if _is_active(pipeline, holder):
+        return holder
+
+    # the holder is finished but never released the lock, take it over
+    try:
+        _put_lock(
+            lock,
+            execution_id,
+            "execution_id = :holder",
+            {":holder": {"S": holder}},
+        )
+        print("Took over lock " + lock + " from finished execution " + holder)
+        return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return _holder(lock) or "unknown"
+
+
+def release(lock, execution_id):
+    try:
+        dynamodb.delete_item(
+            TableName=LOCK_TABLE,
+            Key={"lock_id": {"S": lock}},
+            ConditionExpression="execution_id = :me",
+            ExpressionAttributeValues={":me": {"S": execution_id}},
+        )
+    except ClientError as e:
+        # somebody else holds it (eg it was taken over), nothing for us to release
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+
+def handler(event, context):
+    job = event["CodePipeline.job"]
+    job_id = job["id"]
+    params = json.loads(
+        job["data"]["actionConfiguration"]["configuration"]["UserParameters"]
+    )
+    lock = params["lock"]
+    execution_id = params["execution_id"]
+
+    try:
+        if params["operation"] == "release":
+            release(lock, execution_id)
+            codepipeline.put_job_success_result(jobId=job_id)
+            return
+
+        continuation = json.loads(job["data"].get("continuationToken") or "{}")
+        waiting_since = continuation.get("waiting_since", time.time())
+
+        holder = acquire(lock, params["pipeline"], execution_id)
+        if holder is None:
+            print(
+                "Execution %s acquired lock %s after waiting %ds"
+                % (execution_id, lock, time.time() - waiting_since)
+            )
+            codepipeline.put_job_success_result(jobId=job_id)
+            return
+
+        if time.time() - waiting_since > MAX_WAIT_SECONDS:
+            codepipeline.put_job_failure_result(
+                jobId=job_id,
+                failureDetails={
+                    "type": "JobFailed",
+                    "message": "Timed out waiting for lock "
+                    + lock
+                    + " held by execution "
+                    + holder,
+                },
+            )
+            return
+
+        print("Lock " + lock + " is held by execution " + holder + ", waiting")
+        time.sleep(POLL_SECONDS)
+        # a continuation token keeps the action in progress and CodePipeline invokes us again
+        codepipeline.put_job_success_result(
+            jobId=job_id,
+            continuationToken=json.dumps({"waiting_since": waiting_since}),
+        )
+    except Exception as e:
+        # report the failure rather than raising, a raised error would just get the invocation retried
+        traceback.print_exc()
+        codepipeline.put_job_failure_result(
+            jobId=job_id,
+            failureDetails={"type": "JobFailed", "message": str(e)[:5000]},
+        )
@@ -0,0 +1,334 @@
+"""Post-deploy bake: watch alarms for a while, then promote or roll back.
+
+Invoked as a CodePipeline Lambda action after the deploy stage, with the
+built artifact as its input and UserParameters like:
+
+    {"alarms": ["my-app-5xx"], "bake_seconds": 600, "execution_id": "<id>"}
+
+While baking the alarms are checked (in the target account, through the
+cross-account role) once a minute using continuation tokens. If the window
+passes quietly the artifact is recorded as the pipeline's last known good
+release in the artifact bucket, keeping the last few releases and pruning
+older ones. CloudFormation releases keep their own copy of the packaged code
+their template refers to, since packages/ expires. If an alarm fires, the last known good
+release is redeployed straight from the artifact bucket (no rebuild) and the
+action fails.
+"""
+
+import io
+import json
+import mimetypes
+import os
+import re
+import time
+import traceback
+import zipfile
+
+import boto3
+from botocore.exceptions import ClientError
+
+ARTIFACT_BUCKET = os.environ.get("ARTIFACT_BUCKET")
+PIPELINE_NAME = os.environ.get("PIPELINE_NAME")
+CROSS_ACCOUNT_ROLE_ARN = os.environ.get("CROSS_ACCOUNT_ROLE_ARN")
+DEPLOY_MODEL = os.environ.get("DEPLOY_MODEL")
+POLL_SECONDS = int(os.environ.get("POLL_SECONDS", "60"))
+# pipelines sharing a pooled artifact bucket keep their releases under their own prefix
+RELEASE_PREFIX = os.environ.get("RELEASE_PREFIX")
+RELEASES_TO_KEEP = int(os.environ.get("RELEASES_TO_KEEP", "3"))
+
+# s3 model
+TARGET_BUCKET = os.environ.get("TARGET_BUCKET")
+TARGET_PREFIX = os.environ.get("TARGET_PREFIX", "").strip("/")
+
+# cloudformation model
+STACK_NAME = os.environ.get("STACK_NAME")
+DEPLOYMENT_ROLE_ARN = os.environ.get("DEPLOYMENT_ROLE_ARN")
+TEMPLATE_PATH = os.environ.get("TEMPLATE_PATH", "packaged.yaml")
+STACK_PARAMETERS = json.loads(os.environ.get("STACK_PARAMETERS") or "{}")
+CAPABILITIES = [c for c in os.environ.get("CAPABILITIES", "").split(",") if c]
+
+# where sam package puts the code a template refers to, which expires long before a kept release
+PACKAGES_PREFIX = "packages/"
+# nested stack templates uploaded by sam package, which refer to packaged code of their own
+NESTED_TEMPLATE_SUFFIXES = (".template", ".yaml", ".yml", ".json")
+
+s3 = boto3.client("s3")
+codepipeline = boto3.client("codepipeline")
+
+
+def release_prefix(pipeline_name):
+    return RELEASE_PREFIX or "releases/" + pipeline_name + "/"
+
+
+def target_account_session():
+    credentials = boto3.client("sts").assume_role(
+        RoleArn=CROSS_ACCOUNT_ROLE_ARN, RoleSessionName="bake-" + PIPELINE_NAME[:50]
+    )["Credentials"]
+    return boto3.session.Session(
+        aws_access_key_id=credentials["AccessKeyId"],
+        aws_secret_access_key=credentials["SecretAccessKey"],
+        aws_session_token=credentials["SessionToken"],
+    )
+
+
+def alarms_firing(session, alarm_names):
+    cloudwatch = session.client("cloudwatch")
+    firing = []
+    # DescribeAlarms takes at most 100 names per call
+    for start in range(0, len(alarm_names), 100):
+        response = cloudwatch.describe_alarms(
+            AlarmNames=alarm_names[start : start + 100],
+            AlarmTypes=["MetricAlarm", "CompositeAlarm"],
+        )
+        for alarm in response.get("MetricAlarms", []) + response.get(
+            "CompositeAlarms", []
+        ):
+            if alarm["StateValue"] == "ALARM":
+                firing.append(alarm["AlarmName"])
+    return firing
+
+
+def read_artifact(location):
+    response = s3.get_object(Bucket=location["bucketName"], Key=location["objectKey"])
+    return response["Body"].read()
+
+
+def package_reference_pattern():
+    """Matches the packaged code keys a template refers to, in s3:// URIs, S3 URLs
+    (eg TemplateURL) and S3Keys, with the key as the second group."""
+    bucket = re.escape(ARTIFACT_BUCKET)
+    return re.compile(
+        r"(s3://"
+        + bucket
+        + r"/|amazonaws\.com/"
+        + bucket
+        + r"/|S3Key[\"']?\s*:\s*[\"']?)("
+        + PACKAGES_PREFIX
+        + r"[^\s\"',}]+)"
+    )
+
+
+def keep_packages(template, release_key):
+    """Copy the packaged code a template refers to into the release, returning the template
+    rewritten to refer to the copies, so rolling back doesn't depend on packages/ still having it.
+    """
+    pattern = package_reference_pattern()
+    text = template.decode("utf-8")
+    for key in sorted(set(match[1] for match in pattern.findall(text))):
+        if key.endswith(NESTED_TEMPLATE_SUFFIXES):
+            nested = s3.get_object(Bucket=ARTIFACT_BUCKET, Key=key)["Body"].read()
+            s3.put_object(
+                Bucket=ARTIFACT_BUCKET,
+                Key=release_key + key,
+                Body=keep_packages(nested, release_key),
+            )
+        else:
+            s3.copy_object(
+                Bucket=ARTIFACT_BUCKET,
+                Key=release_key + key,
+                CopySource={"Bucket": ARTIFACT_BUCKET, "Key": key},
+            )
+    return pattern.sub(
+        lambda match: match.group(1) + release_key + match.group(2), text
+    ).encode("utf-8")
+
+
+def promote(artifact_location, execution_id):
+    prefix = release_prefix(PIPELINE_NAME)
+    # each release gets its own folder, release.json points at the latest one
+    release_key = prefix + execution_id + "/"
+    body = read_artifact(artifact_location)
+    s3.put_object(Bucket=ARTIFACT_BUCKET, Key=release_key + "artifact.zip", Body=body)
+
+    # keep the template unzipped so CloudFormation can read it directly on rollback, along with
+    # the packaged code it deploys (pruned with the release rather than expired with packages/)
+    if DEPLOY_MODEL == "cloudformation":
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            template = keep_packages(archive.read(TEMPLATE_PATH), release_key)
+        s3.put_object(
+            Bucket=ARTIFACT_BUCKET, Key=release_key + TEMPLATE_PATH, Body=template
+        )
+
+    s3.put_object(
+        Bucket=ARTIFACT_BUCKET,
+        Key=prefix + "release.json",
+        Body=json.dumps(
+            {
+                "execution_id": execution_id,
+                "promoted_at": int(time.time()),
+                "artifact": artifact_location,
+                "key": release_key,
+            }
+        ),
+    )
+    prune_releases(prefix, RELEASES_TO_KEEP)
+
+
+def prune_releases(prefix, keep):
+    """Delete all but the newest `keep` release folders."""
+    releases = {}
+    stale = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=ARTIFACT_BUCKET, Prefix=prefix):
+        for item in page.get("Contents", []):
+            name, separator, _ = item["Key"][len(prefix) :].partition("/")
+            # release.json, which points at the newest
+            if not separator:
+                continue
+            release = releases.setdefault(
+                name, {"modified": item["LastModified"], "keys": []}
+            )
+            release["modified"] = max(release["modified"], item["LastModified"])
+            release["keys"].append(item["Key"])
+
+    newest_first = sorted(releases.values(), key=lambda r: r["modified"], reverse=True)
+    for release in newest_first[keep:]:
+        stale.extend(release["keys"])
+
+    # DeleteObjects takes at most 1000 keys per call
+    for start in range(0, len(stale), 1000):
+        s3.delete_objects(
+            Bucket=ARTIFACT_BUCKET,
+            Delete={
+                "Objects": [{"Key": key} for key in stale[start : start + 1000]],
+                "Quiet": True,
+            },
+        )
+
+
+def last_good_release():
+    try:
+        response = s3.get_object(
+            Bucket=ARTIFACT_BUCKET, Key=release_prefix(PIPELINE_NAME) + "release.json"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def rollback_s3(session, release_key):
+    # the same as the S3Deploy action with extract enabled: unzip into the root of the bucket,
+    # or the prefix the pipeline deploys to
+    target = session.client("s3")
+    body = s3.get_object(Bucket=ARTIFACT_BUCKET, Key=release_key + "artifact.zip")[
+        "Body"
+    ].read()
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        for name in archive.namelist():
+            if name.endswith("/"):
+                continue
+            extra = {}
+            content_type = mimetypes.guess_type(name)[0]
+            if content_type:
+                extra["ContentType"] = content_type
+            target.put_object(
+                Bucket=TARGET_BUCKET,
+                Key=TARGET_PREFIX + "/" + name if TARGET_PREFIX else name,
+                Body=archive.read(name),
+                **extra
+            )
+
+
+def rollback_cloudformation(session, release_key):
+    cloudformation = session.client("cloudformation")
+    template_url = "https://s3.%s.amazonaws.com/%s/%s%s" % (
+        os.environ["AWS_REGION"],
+        ARTIFACT_BUCKET,
+        release_key,
+        TEMPLATE_PATH,
+    )
+    change_set_name = STACK_NAME + "-rollback-" + str(int(time.time()))
+
+    cloudformation.create_change_set(
+        StackName=STACK_NAME,
+        ChangeSetName=change_set_name,
+        ChangeSetType="UPDATE",
+        TemplateURL=template_url,
+        Parameters=[
+            {"ParameterKey": key, "ParameterValue": value}
+            for key, value in STACK_PARAMETERS.items()
+        ],
+        Capabilities=CAPABILITIES,
+        RoleARN=DEPLOYMENT_ROLE_ARN,
+    )
+
+    try:
+        cloudformation.get_waiter("change_set_create_complete").wait(
+            StackName=STACK_NAME,
+            ChangeSetName=change_set_name,
+            WaiterConfig={"Delay": 5, "MaxAttempts": 60},
+        )
+    except Exception:
+        change_set = cloudformation.describe_change_set(
+            StackName=STACK_NAME, ChangeSetName=change_set_name
+        )
+        # the stack is already running the last good template
+        if "didn't contain changes" in change_set.get("StatusReason", ""):
+            return
+        raise
+
+    cloudformation.execute_change_set(
+        StackName=STACK_NAME, ChangeSetName=change_set_name
+    )
+
+
+def rollback(session):
+    release = last_good_release()
+    if release is None:
+        return "there is no last known good release to roll back to"
+
+    if DEPLOY_MODEL == "s3":
+        rollback_s3(session, release["key"])
+    else:
+        rollback_cloudformation(session, release["key"])
+    return "rolled back to the release from execution " + release["execution_id"]
+
+
+def fail(job_id, message):
+    print(message)
+    codepipeline.put_job_failure_result(
+        jobId=job_id, failureDetails={"type": "JobFailed", "message": message[:5000]}
+    )
+
+
+def handler(event, context):
+    job = event["CodePipeline.job"]
+    job_id = job["id"]
+
+    try:
+        params = json.loads(
+            job["data"]["actionConfiguration"]["configuration"]["UserParameters"]
+        )
+        continuation = json.loads(job["data"].get("continuationToken") or "{}")
+        started = continuation.get("started", time.time())
+
+        session = target_account_session()
+        firing = alarms_firing(session, params["alarms"])
+        if firing:
+            outcome = rollback(session)
+            fail(
+                job_id,
+                "Alarms " + ", ".join(firing) + " fired while baking, " + outcome,
+            )
+            return
+
+        remaining = params["bake_seconds"] - (time.time() - started)
+        if remaining <= 0:
+            promote(
+                job["data"]["inputArtifacts"][0]["location"]["s3Location"],
+                params["execution_id"],
+            )
+            print("Baked for %ds without alarms, promoted" % params["bake_seconds"])
+            codepipeline.put_job_success_result(jobId=job_id)
+            return
+
+        time.sleep(min(POLL_SECONDS, remaining))
+        codepipeline.put_job_success_result(
+            jobId=job_id, continuationToken=json.dumps({"started": started})
+        )
+    except Exception as e:
+        # report the failure rather than raising, a raised error would just get the invocation retried
+        traceback.print_exc()
+        fail(job_id, str(e))
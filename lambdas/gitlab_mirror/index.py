@@ -0,0 +1,229 @@
+"""Pushes a GitLab branch into its CodeCommit mirror as soon as GitLab says it changed.
+
+GitLab's push mirror only syncs every minute or so, and the pipeline can't start
+until it has. This does the sync itself straight away: the pushed branch is
+fetched from GitLab and pushed to CodeCommit, where the pipeline's source
+action picks it up the same way it would a mirror sync. When the mirror gets
+there later it finds nothing left to do.
+
+There are two handlers, deployed as two functions:
+
+- handler is called by the GitLab push webhook (through API Gateway). GitLab
+  gives up on a webhook after 10 seconds, and disables hooks that keep failing,
+  so it only checks the token and the push, and hands the push to the sync
+  function with an asynchronous invoke before answering
+- sync_handler does the fetch and push, which can take minutes for a big repo.
+  If it fails, Lambda retries it, and the mirror catches up after that
+
+The webhook's secret token and a GitLab token that can read the repository are
+kept in a Secrets Manager secret, as {"webhook_token": ..., "gitlab_token": ...}.
+CodeCommit is pushed to over HTTPS, signing the git password with the
+function's own credentials the same way the CodeCommit credential helper does.
+
+The repository fetched into is kept in /tmp, so warm invocations only fetch
+what's new. The git functions take plain URLs, so they can be run against
+local repositories:
+
+    python -c "from index import sync_ref; sync_ref('/tmp/src.git', '/tmp/dst.git', 'refs/heads/main')"
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import subprocess
+from datetime import datetime
+from urllib.parse import quote, urlsplit, urlunsplit
+
+REPO_NAME = os.environ.get("REPO_NAME")
+GITLAB_REPO_URL = os.environ.get("GITLAB_REPO_URL")
+SECRET_ARN = os.environ.get("SECRET_ARN")
+REGION = os.environ.get("AWS_REGION")
+# only set for the webhook function
+SYNC_FUNCTION_NAME = os.environ.get("SYNC_FUNCTION_NAME")
+WORK_DIR = os.environ.get("WORK_DIR", "/tmp/mirror")
+GIT_TIMEOUT_SECONDS = int(os.environ.get("GIT_TIMEOUT_SECONDS", "240"))
+
+BRANCH_PREFIX = "refs/heads/"
+# GitLab sends this as the new commit when a branch is deleted
+DELETED_SHA = "0" * 40
+CREDENTIALS_IN_URL = re.compile(r"//[^/@\s]+@")
+
+_secret = None
+
+
+class GitError(Exception):
+    pass
+
+
+def git(*args, cwd=None):
+    # never log the credentials that are in the URLs
+    try:
+        result = subprocess.run(
+            ("git",) + args,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            timeout=GIT_TIMEOUT_SECONDS,
+        )
+    except subprocess.TimeoutExpired:
+        raise GitError("git " + args[0] + " timed out") from None
+    if result.returncode != 0:
+        raise GitError(CREDENTIALS_IN_URL.sub("//***@", result.stderr.strip()))
+    return result.stdout.strip()
+
+
+def with_credentials(url, username, password):
+    """Put a username and password into an https URL, anything else is left alone."""
+    parts = urlsplit(url)
+    if parts.scheme != "https" or not password:
+        return url
+    netloc = quote(username, safe="") + ":" + quote(password, safe="") + "@"
+    netloc += parts.hostname
+    # self hosted GitLab might not be on 443
+    if parts.port:
+        netloc += ":" + str(parts.port)
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+def codecommit_password(hostname, path, region, secret_key, now):
+    # a SigV4 signature of a "GIT" request for the repo path, which is what CodeCommit
+    # expects as the password when using temporary credentials over HTTPS
+    timestamp = now.strftime("%Y%m%dT%H%M%S")
+    canonical_request = "GIT\n" + path + "\n\nhost:" + hostname + "\n\nhost\n"
+    scope = timestamp[:8] + "/" + region + "/codecommit/aws4_request"
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            timestamp,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+    key = _hmac(("AWS4" + secret_key).encode(), timestamp[:8])
+    for part in (region, "codecommit", "aws4_request"):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    return timestamp + "Z" + signature
+
+
+def codecommit_url(
+    repo_name, region, access_key, secret_key, session_token=None, now=None
+):
+    hostname = "git-codecommit." + region + ".amazonaws.com"
+    path = "/v1/repos/" + repo_name
+    username = access_key + ("%" + session_token if session_token else "")
+    password = codecommit_password(
+        hostname, path, region, secret_key, now or datetime.utcnow()
+    )
+    return with_credentials("https://" + hostname + path, username, password)
+
+
+def sync_ref(source_url, target_url, ref, new_sha=None, work_dir=WORK_DIR):
+    """Copy `ref` from the source repo to the target, returning the commit now on the
+    target, or None if the ref was deleted or the push was rejected as not a fast forward.
+    """
+    repo_dir = os.path.join(work_dir, "repo.git")
+    if not os.path.isdir(repo_dir):
+        os.makedirs(work_dir, exist_ok=True)
+        git("init", "--bare", "--quiet", repo_dir)
+
+    if new_sha == DELETED_SHA:
+        git("push", "--quiet", target_url, ":" + ref, cwd=repo_dir)
+        return None
+
+    git(
+        "fetch", "--quiet", "--no-tags", source_url, "+" + ref + ":" + ref, cwd=repo_dir
+    )
+    head = git("rev-parse", ref, cwd=repo_dir)
+    try:
+        # not forced, so a slow invocation can't put back a commit a later one replaced.
+        # a rewritten branch is left to the mirror, which does force push
+        git("push", "--quiet", target_url, ref + ":" + ref, cwd=repo_dir)
+    except GitError as e:
+        if "rejected" not in str(e):
+            raise
+        print("CodeCommit rejected " + ref + ", leaving it to the mirror")
+        return None
+    return head
+
+
+def load_secret():
+    global _secret
+    if _secret is None:
+        import boto3
+
+        _secret = json.loads(
+            boto3.client("secretsmanager").get_secret_value(SecretId=SECRET_ARN)[
+                "SecretString"
+            ]
+        )
+    return _secret
+
+
+def response(status, message):
+    return {
+        "statusCode": status,
+        "headers": {"Content-Type": "application/json"},
+        "body": json.dumps({"message": message}),
+    }
+
+
+def start_sync(ref, new_sha):
+    import boto3
+
+    boto3.client("lambda").invoke(
+        FunctionName=SYNC_FUNCTION_NAME,
+        InvocationType="Event",
+        Payload=json.dumps({"ref": ref, "after": new_sha}).encode(),
+    )
+
+
+def handler(event, context):
+    secret = load_secret()
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    if not hmac.compare_digest(
+        headers.get("x-gitlab-token", ""), secret.get("webhook_token", "")
+    ):
+        return response(401, "Bad webhook token")
+
+    body = event.get("body") or "{}"
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body).decode()
+    push = json.loads(body)
+
+    ref = push.get("ref", "")
+    if push.get("object_kind") != "push" or not ref.startswith(BRANCH_PREFIX):
+        return response(200, "Ignored, only branch pushes are synced")
+
+    start_sync(ref, push.get("after"))
+    return response(202, "Syncing " + ref[len(BRANCH_PREFIX) :])
+
+
+def sync_handler(event, context):
+    secret = load_secret()
+    ref = event["ref"]
+    source_url = with_credentials(
+        GITLAB_REPO_URL, "oauth2", secret.get("gitlab_token", "")
+    )
+    target_url = codecommit_url(
+        REPO_NAME,
+        REGION,
+        os.environ["AWS_ACCESS_KEY_ID"],
+        os.environ["AWS_SECRET_ACCESS_KEY"],
+        os.environ.get("AWS_SESSION_TOKEN"),
+    )
+
+    # failures are raised, so that Lambda retries the invoke
+    head = sync_ref(source_url, target_url, ref, event.get("after"))
+
+    branch = ref[len(BRANCH_PREFIX) :]
+    print(json.dumps({"branch": branch, "pushed": head}))
+    return {"branch": branch, "pushed": head}
@@ -0,0 +1,279 @@
+"""Turns CodePipeline state-change events into stage and action timing metrics.
+
+Subscribed to the pipeline, stage and action execution state-change events
+for our pipelines. Start times are kept in a small store until the matching
+terminal event arrives, then durations are published as CloudWatch metrics
+using the embedded metric format (EMF), by printing them to the log.
+
+Metrics (dimensions in brackets):
+
+- ExecutionDuration, ExecutionSucceeded, ExecutionFailed (Pipeline)
+- StageDuration (Pipeline, Stage)
+- StageQueueTime (Pipeline, Stage) - time between the previous stage finishing,
+  or the execution starting, and this stage starting
+- ActionDuration (Pipeline, Stage, Action)
+- ApprovalWait (Pipeline) - time spent waiting in manual approval actions
+
+process_event() has no AWS dependencies, so recorded events can be replayed
+locally through it with a MemoryStore:
+
+    python lambdas/pipeline_telemetry/index.py recorded-events.jsonl
+"""
+
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+METRIC_NAMESPACE = os.environ.get("METRIC_NAMESPACE", "CodePipeline/Telemetry")
+PIPELINE_PREFIX = os.environ.get("PIPELINE_PREFIX", "pipeline-")
+# start times only need to outlive the longest execution
+STATE_TTL_SECONDS = 14 * 24 * 60 * 60
+
+PIPELINE_EVENT = "CodePipeline Pipeline Execution State Change"
+STAGE_EVENT = "CodePipeline Stage Execution State Change"
+ACTION_EVENT = "CodePipeline Action Execution State Change"
+
+STARTED_STATES = ("STARTED", "RESUMED")
+FINISHED_STATES = ("SUCCEEDED", "FAILED", "CANCELED", "STOPPED", "SUPERSEDED")
+
+
+class MemoryStore:
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def put(self, key, value):
+        self.items[key] = value
+
+
+class DynamoStore:
+    def __init__(self, table_name):
+        import boto3
+
+        self.table_name = table_name
+        self.dynamodb = boto3.client("dynamodb")
+
+    def get(self, key):
+        item = self.dynamodb.get_item(
+            TableName=self.table_name, Key={"key": {"S": key}}
+        ).get("Item")
+        return float(item["value"]["N"]) if item else None
+
+    def put(self, key, value):
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={
+                "key": {"S": key},
+                "value": {"N": repr(value)},
+                "expires_at": {"N": str(int(time.time()) + STATE_TTL_SECONDS)},
+            },
+        )
+
+
+def event_time(event):
+    return (
+        datetime.strptime(event["time"], "%Y-%m-%dT%H:%M:%SZ")
+        .replace(tzinfo=timezone.utc)
+        .timestamp()
+    )
+
+
+def metric(timestamp, dimensions, values, properties=None):
+    """Build an EMF record for one or more values sharing the same dimensions."""
+    record = {
+        "_aws": {
+            "Timestamp": int(timestamp * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRIC_NAMESPACE,
+                    "Dimensions": [list(dimensions.keys())],
+                    "Metrics": [
+                        {"Name": name, "Unit": unit}
+                        for name, (value, unit) in values.items()
+                    ],
+                }
+            ],
+        }
+    }
+    record.update(dimensions)
+    record.update(properties or {})
+    record.update({name: value for name, (value, unit) in values.items()})
+    return record
+
+
+def _start(store, key, now):
+    """Record a start time, returning (finish time, duration) if the finish event got here first
+    (EventBridge doesn't guarantee the order events arrive in), otherwise (None, None).
+    """
+    store.put(key, now)
+    finished = store.get("finished/" + key)
+    if finished is None or finished < now:
+        # no finish yet, or the finish of an earlier attempt
+        return None, None
+    return finished, finished - now
+
+
+def _finish(store, key, now):
+    """The time since the start, or None if its start event hasn't arrived (or was missed)."""
+    started = store.get(key)
+    if started is None:
+        # remember the finish, in case the start event turns up late
+        store.put("finished/" + key, now)
+        return None
+    return max(now - started, 0)
+
+
+def _advance(store, key, now):
+    # a late event for an earlier stage mustn't move the cursor backwards
+    cursor = store.get(key)
+    if cursor is None or cursor < now:
+        store.put(key, now)
+
+
+def _action_records(timestamp, detail, duration, properties):
+    pipeline = detail["pipeline"]
+    stage = detail["stage"]
+    action = detail["action"]
+    records = [
+        metric(
+            timestamp,
+            {"Pipeline": pipeline, "Stage": stage, "Action": action},
+            {"ActionDuration": (duration, "Seconds")},
+            properties,
+        )
+    ]
+    if detail.get("type", {}).get("category") == "Approval":
+        records.append(
+            metric(
+                timestamp,
+                {"Pipeline": pipeline},
+                {"ApprovalWait": (duration, "Seconds")},
+                dict(properties, Stage=stage, Action=action),
+            )
+        )
+    return records
+
+
+def process_event(event, store):
+    """Record the state change in the store and return any EMF metric records it completes.
+
+    Events can arrive out of order: a finish that arrives before its start is kept, and its
+    duration published (without the State property) when the start arrives."""
+    detail = event.get("detail", {})
+    pipeline = detail.get("pipeline", "")
+    if not pipeline.startswith(PIPELINE_PREFIX):
+        return []
+
+    now = event_time(event)
+    state = detail.get("state")
+    execution = detail["execution-id"]
+    properties = {"ExecutionId": execution}
+    records = []
+
+    if event["detail-type"] == PIPELINE_EVENT:
+        key = "execution/" + execution
+        dimensions = {"Pipeline": pipeline}
+        if state in STARTED_STATES:
+            finished, duration = _start(store, key, now)
+            if duration is not None:
+                records.append(
+                    metric(
+                        finished,
+                        dimensions,
+                        {"ExecutionDuration": (duration, "Seconds")},
+                        properties,
+                    )
+                )
+            # the first stage queues from the moment the execution starts
+            _advance(store, "cursor/" + execution, now)
+        elif state in FINISHED_STATES:
+            values = {
+                "ExecutionSucceeded": (1 if state == "SUCCEEDED" else 0, "Count"),
+                "ExecutionFailed": (1 if state == "FAILED" else 0, "Count"),
+            }
+            duration = _finish(store, key, now)
+            if duration is not None:
+                values["ExecutionDuration"] = (duration, "Seconds")
+            records.append(metric(now, dimensions, values, properties))
+
+    elif event["detail-type"] == STAGE_EVENT:
+        stage = detail["stage"]
+        key = "stage/" + execution + "/" + stage
+        dimensions = {"Pipeline": pipeline, "Stage": stage}
+        if state in STARTED_STATES:
+            # a retried (RESUMED) stage is timed from the retry
+            finished, duration = _start(store, key, now)
+            if state == "STARTED":
+                queued = store.get("cursor/" + execution)
+                # past the stage's start when a later event got here first, so unknown
+                if queued is not None and queued <= now:
+                    records.append(
+                        metric(
+                            now,
+                            dimensions,
+                            {"StageQueueTime": (now - queued, "Seconds")},
+                            properties,
+                        )
+                    )
+            if duration is not None:
+                records.append(
+                    metric(
+                        finished,
+                        dimensions,
+                        {"StageDuration": (duration, "Seconds")},
+                        properties,
+                    )
+                )
+        elif state in FINISHED_STATES:
+            _advance(store, "cursor/" + execution, now)
+            duration = _finish(store, key, now)
+            if duration is not None:
+                records.append(
+                    metric(
+                        now,
+                        dimensions,
+                        {"StageDuration": (duration, "Seconds")},
+                        dict(properties, State=state),
+                    )
+                )
+
+    elif event["detail-type"] == ACTION_EVENT:
+        key = "action/" + execution + "/" + detail["stage"] + "/" + detail["action"]
+        if state in STARTED_STATES:
+            finished, duration = _start(store, key, now)
+            if duration is not None:
+                records += _action_records(finished, detail, duration, properties)
+        elif state in FINISHED_STATES:
+            duration = _finish(store, key, now)
+            if duration is not None:
+                records += _action_records(
+                    now, detail, duration, dict(properties, State=state)
+                )
+
+    return records
+
+
+_store = None
+
+
+def handler(event, context):
+    global _store
+    if _store is None:
+        _store = DynamoStore(os.environ["STATE_TABLE"])
+
+    for record in process_event(event, _store):
+        print(json.dumps(record))
+
+
+if __name__ == "__main__":
+    # replay recorded events (one JSON event per line) and print the metrics they produce
+    store = MemoryStore()
+    with open(sys.argv[1]) as fp:
+        for line in fp:
+            if line.strip():
+                for record in process_event(json.loads(line), store):
+                    print(json.dumps(record))
@@ -17,15 +17,23 @@ setuptools.setup(
     install_requires=[
         "aws-cdk.core",
         "aws_cdk.aws_apigateway",
+        "aws_cdk.aws_cloudwatch",
         "aws_cdk.aws_codedeploy",
         "aws_cdk.aws_lambda",
         "aws_cdk.aws_codebuild",
         "aws_cdk.aws_codepipeline",
         "aws_cdk.aws_codecommit",
+        "aws_cdk.aws_dynamodb",
+        "aws_cdk.aws_events",
+        "aws_cdk.aws_events_targets",
         "aws_cdk.aws_codepipeline_actions",
         "aws_cdk.aws_s3",
+        "aws_cdk.aws_s3_assets",
         "aws_cdk.aws_iam",
+        "aws_cdk.aws_ssm",
+        "aws_cdk.aws_secretsmanager",
         "aws_cdk.aws_logs",
+        "aws_cdk.aws_logs_destinations",
         "aws_cdk.pipelines",
     ],
     python_requires=">=3.6",
@@ -0,0 +1,93 @@
+from aws_cdk import (
+    core as cdk,
+    aws_s3 as s3,
+)
+
+DEFAULT_ARTIFACT_RETENTION_DAYS = 30
+DEFAULT_RELEASES_TO_KEEP = 3
+
+# S3 won't move objects to infrequent access until they are 30 days old
+INFREQUENT_ACCESS_AFTER_DAYS = 30
+
+# what lives where in an artifact bucket. CodePipeline keeps its own artifacts in a folder named
+# after the pipeline, so everything under pipeline- is intermediate build output
+CODEPIPELINE_ARTIFACTS_PREFIX = "pipeline-"
+PACKAGES_PREFIX = "packages/"
+BUILD_CACHE_PREFIX = "build-cache/"
+# promoted releases, pruned by the bake function rather than by age
+RELEASES_PREFIX = "releases/"
+
+
+def artifact_lifecycle_rules(
+    artifact_retention_days: int = None,
+    package_retention_days: int = None,
+) -> list:
+    artifact_retention_days = int(
+        artifact_retention_days or DEFAULT_ARTIFACT_RETENTION_DAYS
+    )
+
+    rules = [
+        s3.LifecycleRule(
+            id="AbortIncompleteUploads",
+            abort_incomplete_multipart_upload_after=cdk.Duration.days(1),
+        ),
+        # build output is only needed while the execution that made it is running
+        s3.LifecycleRule(
+            id="ExpirePipelineArtifacts",
+            prefix=CODEPIPELINE_ARTIFACTS_PREFIX,
+            expiration=cdk.Duration.days(artifact_retention_days),
+        ),
+        # caches are rewritten by every build, so old ones belong to branches that stopped building
+        s3.LifecycleRule(
+            id="ExpireBuildCaches",
+            prefix=BUILD_CACHE_PREFIX,
+            expiration=cdk.Duration.days(artifact_retention_days),
+        ),
+    ]
+
+    # packaged code is referenced by deployed stacks for as long as they run it, and needed
+    # again if CloudFormation rolls one back or replaces a resource, however long ago it was
+    # deployed. so it's only moved to a cheaper class, and only expires if asked to
+    package_transitions = []
+    if package_retention_days == None or (
+        int(package_retention_days) > INFREQUENT_ACCESS_AFTER_DAYS
+    ):
+        package_transitions.append(
+            s3.Transition(
+                storage_class=s3.StorageClass.INFREQUENT_ACCESS,
+                transition_after=cdk.Duration.days(INFREQUENT_ACCESS_AFTER_DAYS),
+            )
+        )
+    if package_retention_days == None:
+        rules.append(
+            s3.LifecycleRule(
+                id="TierPackages",
+                prefix=PACKAGES_PREFIX,
+                transitions=package_transitions,
+            )
+        )
+    else:
+        rules.append(
+            s3.LifecycleRule(
+                id="ExpirePackages",
+                prefix=PACKAGES_PREFIX,
+                expiration=cdk.Duration.days(int(package_retention_days)),
+                transitions=package_transitions,
+            )
+        )
+
+    # releases are pruned by the bake function, so they're only moved to a cheaper class
+    rules.append(
+        s3.LifecycleRule(
+            id="TierReleases",
+            prefix=RELEASES_PREFIX,
+            transitions=[
+                s3.Transition(
+                    storage_class=s3.StorageClass.INFREQUENT_ACCESS,
+                    transition_after=cdk.Duration.days(INFREQUENT_ACCESS_AFTER_DAYS),
+                )
+            ],
+        )
+    )
+
+    return rules
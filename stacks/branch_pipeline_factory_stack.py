@@ -0,0 +1,565 @@
+import os
+
+from aws_cdk import (
+    core as cdk,
+    aws_codebuild as codebuild,
+    aws_codecommit as codecommit,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_iam as iam,
+    aws_lambda as lambda_,
+    aws_logs as logs,
+    aws_s3_assets as s3_assets,
+)
+
+from stacks.buildspec_generator import TOOL_VERSIONS
+
+DEFAULT_IDLE_HOURS = 72
+# branch pipeline stacks are tagged with this (and the repo name), only those are ever torn down
+BRANCH_PIPELINE_TAG = "branch-pipeline-factory"
+# S3 branch pipelines deploy under <prefix><branch>/ in the target bucket, rather than over the top of each other
+BRANCH_TARGET_PREFIX = "branches/"
+
+# the most a role created by a branch pipeline stack can do: run builds, read and write artifacts,
+# assume the cross account roles and run the pipeline's lambdas, but nothing in IAM
+BRANCH_PIPELINE_BOUNDARY_ACTIONS = [
+    "codebuild:CreateReport*",
+    "codebuild:UpdateReport*",
+    "codebuild:BatchPutTestCases",
+    "codebuild:BatchPutCodeCoverages",
+    "codebuild:StartBuild",
+    "codebuild:StopBuild",
+    "codebuild:BatchGetBuilds",
+    "codecommit:GetBranch",
+    "codecommit:GetCommit",
+    "codecommit:GetRepository",
+    "codecommit:GitPull",
+    "codecommit:UploadArchive",
+    "codecommit:GetUploadArchiveStatus",
+    "codecommit:CancelUploadArchive",
+    "codepipeline:StartPipelineExecution",
+    "codepipeline:GetPipeline*",
+    "codepipeline:ListPipelineExecutions",
+    "codepipeline:PutJob*",
+    "codepipeline:PutApprovalResult",
+    "codepipeline:StopPipelineExecution",
+    "cloudwatch:DescribeAlarms",
+    "cloudwatch:PutMetricData",
+    "dynamodb:GetItem",
+    "dynamodb:PutItem",
+    "dynamodb:UpdateItem",
+    "dynamodb:DeleteItem",
+    "kms:Decrypt",
+    "kms:DescribeKey",
+    "kms:Encrypt",
+    "kms:GenerateDataKey*",
+    "kms:ReEncrypt*",
+    "lambda:InvokeFunction",
+    "logs:CreateLogGroup",
+    "logs:CreateLogStream",
+    "logs:PutLogEvents",
+    "logs:PutRetentionPolicy",
+    "logs:DeleteRetentionPolicy",
+    "s3:GetObject*",
+    "s3:PutObject*",
+    "s3:ListBucket",
+    "s3:GetBucket*",
+    "s3:DeleteObject*",
+    "s3:Abort*",
+    "ssm:GetParameter*",
+    "sts:AssumeRole",
+]
+
+# the context passed on to every branch pipeline, everything else is specific to a branch
+BRANCH_PIPELINE_CONTEXT = (
+    "build_env",
+    "cross_account_role_arn",
+    "deployment_role_arn",
+    "target_bucket",
+    "buildspec_model",
+    "build_metrics",
+    "load_parameters",
+    "full_clone",
+    "sparse_paths",
+    "execution_mode",
+    "artifact_retention_days",
+    "package_retention_days",
+)
+
+# this project, minus anything that's generated or local to the machine deploying it
+PROJECT_PATH = os.path.join(os.path.dirname(__file__), "..")
+PROJECT_EXCLUDES = [
+    ".git",
+    "cdk.out",
+    "cdk.context.json",
+    "__pycache__",
+    "*.pyc",
+    ".venv",
+    "venv",
+    "*.egg-info",
+    "node_modules",
+]
+
+
+####################################################################################################
+# Create in the devops account, once per repo. Branches created in the repo get a pooled pipeline
+# of their own, which is torn down when the branch is deleted or hasn't been built for a while
+####################################################################################################
+
+
+class BranchPipelineFactoryStack(cdk.Stack):
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        id: str,
+        repo_name: str,
+        pipeline_context: dict,
+        branch_pattern: str = None,
+        idle_hours: int = None,
+        delete_idle_deployments: bool = False,
+        **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        if repo_name == None:
+            raise ValueError(
+                "The repo name needs to be provided as `-c repo=<repo-name>`"
+            )
+
+        cross_account_role_arn = pipeline_context.get("cross_account_role_arn")
+        if cross_account_role_arn == None:
+            raise ValueError(
+                "The cross account role branch pipelines will assume must be provided as `-c cross_account_role_arn=<cross_account_role_arn>`"
+            )
+
+        # the same choice app.py makes, a target bucket means an S3 pipeline
+        deployment_role_arn = None
+        pipeline_context = dict(pipeline_context, repo=repo_name, pooled="true")
+        if pipeline_context.get("target_bucket"):
+            stack_prefix = "s3-create-pipeline-"
+        else:
+            deployment_role_arn = pipeline_context.get("deployment_role_arn")
+            if deployment_role_arn == None:
+                raise ValueError(
+                    "Branch pipelines need either `-c target_bucket=<bucket-name>` or `-c deployment_role_arn=<deployment_role_arn>`"
+                )
+            stack_prefix = "cf-create-pipeline-"
+
+        stack_arn_prefix = (
+            "arn:aws:cloudformation:"
+            + self.region
+            + ":"
+            + self.account
+            + ":stack/"
+            + stack_prefix
+            + repo_name
+            + "-"
+        )
+        # CloudFormation names what the branch pipeline stacks create after the stack, so the
+        # execution role can be limited to names starting with this
+        resource_prefix = stack_prefix + repo_name + "-"
+
+        # every role a branch pipeline creates has to carry this boundary, so whatever a branch
+        # deploys can't do more than run a pipeline, and can't touch IAM at all
+        permissions_boundary = iam.ManagedPolicy(
+            self,
+            "BranchPipelinePermissionsBoundary",
+            description="The most that roles created for "
+            + repo_name
+            + " branch pipelines can do",
+            statements=[
+                iam.PolicyStatement(
+                    actions=BRANCH_PIPELINE_BOUNDARY_ACTIONS,
+                    effect=iam.Effect.ALLOW,
+                    resources=["*"],
+                )
+            ],
+        )
+
+        # CloudFormation deploys the branch pipelines with this role, the deployer only gets to
+        # pass it on, and to touch the branch pipeline stacks
+        execution_role = iam.Role(
+            self,
+            "BranchPipelineExecutionRole",
+            assumed_by=iam.ServicePrincipal("cloudformation.amazonaws.com"),
+        )
+        self.scope_execution_role(
+            execution_role, repo_name, resource_prefix, permissions_boundary
+        )
+
+        project_source = s3_assets.Asset(
+            self,
+            "ProjectSource",
+            path=PROJECT_PATH,
+            exclude=PROJECT_EXCLUDES,
+        )
+
+        # context values are all single words (names, ARNs and comma separated lists)
+        pipeline_context["permissions_boundary_arn"] = (
+            permissions_boundary.managed_policy_arn
+        )
+        context_args = " ".join(
+            "-c " + key + "=" + str(value)
+            for key, value in sorted(pipeline_context.items())
+        )
+        branch_context = '-c branch="$BRANCH"'
+        if stack_prefix == "s3-create-pipeline-":
+            branch_context += ' -c target_prefix="' + BRANCH_TARGET_PREFIX + '$BRANCH"'
+        cdk_args = "--role-arn $EXECUTION_ROLE_ARN $CDK_CONTEXT " + branch_context
+
+        deployer = codebuild.Project(
+            self,
+            "BranchPipelineDeployer",
+            description="Deploys and destroys the branch pipelines for " + repo_name,
+            source=codebuild.Source.s3(
+                bucket=project_source.bucket, path=project_source.s3_object_key
+            ),
+            build_spec=codebuild.BuildSpec.from_object(
+                {
+                    "version": "0.2",
+                    "phases": {
+                        "install": {
+                            "runtime-versions": {
+                                "python": TOOL_VERSIONS["python"],
+                                "nodejs": TOOL_VERSIONS["nodejs"],
+                            },
+                            "commands": [
+                                "npm install -g aws-cdk@" + TOOL_VERSIONS["aws-cdk"],
+                                "pip3 install --quiet -r requirements.txt",
+                            ],
+                        },
+                        "build": {
+                            "commands": [
+                                'if [ "$ACTION" = destroy ]; then cdk destroy "$STACK" --force '
+                                + cdk_args
+                                + '; else cdk deploy "$STACK" --require-approval never --tags '
+                                + BRANCH_PIPELINE_TAG
+                                + "="
+                                + repo_name
+                                + " "
+                                + cdk_args
+                                + "; fi"
+                            ]
+                        },
+                    },
+                }
+            ),
+            environment=codebuild.BuildEnvironment(
+                build_image=codebuild.LinuxBuildImage.AMAZON_LINUX_2_3
+            ),
+            environment_variables={
+                "CDK_CONTEXT": codebuild.BuildEnvironmentVariable(value=context_args),
+                "EXECUTION_ROLE_ARN": codebuild.BuildEnvironmentVariable(
+                    value=execution_role.role_arn
+                ),
+                # set when the build is started
+                "ACTION": codebuild.BuildEnvironmentVariable(value="deploy"),
+                "BRANCH": codebuild.BuildEnvironmentVariable(value=""),
+                "STACK": codebuild.BuildEnvironmentVariable(value=""),
+            },
+            timeout=cdk.Duration.minutes(30),
+        )
+        deployer.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["cloudformation:*"],
+                effect=iam.Effect.ALLOW,
+                resources=[stack_arn_prefix + "*"],
+            )
+        )
+        # finding and uploading to the CDK staging bucket
+        deployer.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["cloudformation:DescribeStacks"],
+                effect=iam.Effect.ALLOW,
+                resources=[
+                    "arn:aws:cloudformation:"
+                    + self.region
+                    + ":"
+                    + self.account
+                    + ":stack/CDKToolkit/*"
+                ],
+            )
+        )
+        deployer.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject*", "s3:PutObject*", "s3:ListBucket"],
+                effect=iam.Effect.ALLOW,
+                resources=[
+                    "arn:aws:s3:::cdktoolkit-stagingbucket-*",
+                    "arn:aws:s3:::cdktoolkit-stagingbucket-*/*",
+                ],
+            )
+        )
+        # looking up the shared pipeline key
+        deployer.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["ssm:GetParameters"],
+                effect=iam.Effect.ALLOW,
+                resources=["*"],
+            )
+        )
+        execution_role.grant_pass_role(deployer)
+
+        environment = {
+            "REPO_NAME": repo_name,
+            "PROJECT_NAME": deployer.project_name,
+            "STACK_PREFIX": stack_prefix,
+            "FACTORY_TAG": BRANCH_PIPELINE_TAG,
+            "BRANCH_PATTERN": branch_pattern or "*",
+            "IDLE_HOURS": str(idle_hours or DEFAULT_IDLE_HOURS),
+            "CROSS_ACCOUNT_ROLE_ARN": cross_account_role_arn,
+        }
+        if deployment_role_arn:
+            environment["DEPLOYMENT_ROLE_ARN"] = deployment_role_arn
+            # a deleted branch's deployment is always deleted, an idle one's only if asked
+            if delete_idle_deployments:
+                environment["DELETE_IDLE_DEPLOYMENTS"] = "true"
+
+        code_repo = codecommit.Repository.from_repository_name(self, "Repo", repo_name)
+
+        factory_function = lambda_.Function(
+            self,
+            "BranchPipelineFunction",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            handler="index.handler",
+            code=lambda_.Code.from_asset(
+                os.path.join(
+                    os.path.dirname(__file__), "..", "lambdas", "branch_pipelines"
+                )
+            ),
+            timeout=cdk.Duration.minutes(5),
+            environment=environment,
+            log_retention=logs.RetentionDays.ONE_MONTH,
+        )
+        factory_function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=[
+                    "codebuild:StartBuild",
+                    "codebuild:ListBuildsForProject",
+                    "codebuild:BatchGetBuilds",
+                ],
+                effect=iam.Effect.ALLOW,
+                resources=[deployer.project_arn],
+            )
+        )
+        factory_function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["cloudformation:DescribeStacks"],
+                effect=iam.Effect.ALLOW,
+                resources=["*"],
+            )
+        )
+        factory_function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["codepipeline:ListPipelineExecutions"],
+                effect=iam.Effect.ALLOW,
+                resources=[
+                    "arn:aws:codepipeline:"
+                    + self.region
+                    + ":"
+                    + self.account
+                    + ":pipeline-"
+                    + repo_name
+                    + "-*"
+                ],
+            )
+        )
+        # deleting what a CloudFormation branch pipeline deployed to the target account
+        if deployment_role_arn:
+            factory_function.add_to_role_policy(
+                iam.PolicyStatement(
+                    actions=["sts:AssumeRole"],
+                    effect=iam.Effect.ALLOW,
+                    resources=[cross_account_role_arn],
+                )
+            )
+
+        # the default branch is never managed here
+        factory_function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["codecommit:GetRepository"],
+                effect=iam.Effect.ALLOW,
+                resources=[code_repo.repository_arn],
+            )
+        )
+
+        events.Rule(
+            self,
+            "BranchChanged",
+            description="Branch pipelines for " + repo_name,
+            event_pattern=events.EventPattern(
+                source=["aws.codecommit"],
+                detail_type=["CodeCommit Repository State Change"],
+                resources=[code_repo.repository_arn],
+                detail={
+                    "event": [
+                        "referenceCreated",
+                        "referenceUpdated",
+                        "referenceDeleted",
+                    ],
+                    "referenceType": ["branch"],
+                },
+            ),
+            targets=[targets.LambdaFunction(factory_function)],
+        )
+        events.Rule(
+            self,
+            "IdleSweep",
+            description="Tear down idle branch pipelines for " + repo_name,
+            schedule=events.Schedule.rate(cdk.Duration.hours(1)),
+            targets=[targets.LambdaFunction(factory_function)],
+        )
+
+        cdk.CfnOutput(self, "DeployerProjectName", value=deployer.project_name)
+
+    def scope_execution_role(
+        self,
+        execution_role: iam.Role,
+        repo_name: str,
+        resource_prefix: str,
+        permissions_boundary: iam.ManagedPolicy,
+    ) -> None:
+        def arn(service, resource):
+            return (
+                "arn:aws:"
+                + service
+                + ":"
+                + self.region
+                + ":"
+                + self.account
+                + ":"
+                + resource
+            )
+
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["codepipeline:*"],
+                effect=iam.Effect.ALLOW,
+                # pooled pipelines are called pipeline-<hash>-<repo>-<branch> in CodePipeline
+                resources=[
+                    arn("codepipeline", "pipeline-????????-" + repo_name + "-*")
+                ],
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["lambda:*"],
+                effect=iam.Effect.ALLOW,
+                resources=[arn("lambda", "function:" + resource_prefix + "*")],
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["events:*"],
+                effect=iam.Effect.ALLOW,
+                resources=[arn("events", "rule/" + resource_prefix + "*")],
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["dynamodb:*"],
+                effect=iam.Effect.ALLOW,
+                resources=[arn("dynamodb", "table/" + resource_prefix + "*")],
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["logs:*"],
+                effect=iam.Effect.ALLOW,
+                resources=[
+                    arn("logs", "log-group:" + resource_prefix + "*"),
+                    arn("logs", "log-group:/aws/lambda/" + resource_prefix + "*"),
+                ],
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["logs:DescribeLogGroups"],
+                effect=iam.Effect.ALLOW,
+                resources=[arn("logs", "log-group:*")],
+            )
+        )
+        # CodeBuild names projects after the construct rather than the stack, so they're limited
+        # by the tag the deployer puts on every branch pipeline stack instead
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["codebuild:CreateProject"],
+                effect=iam.Effect.ALLOW,
+                resources=[arn("codebuild", "project/*")],
+                conditions={
+                    "StringEquals": {"aws:RequestTag/" + BRANCH_PIPELINE_TAG: repo_name}
+                },
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["codebuild:*"],
+                effect=iam.Effect.ALLOW,
+                resources=[arn("codebuild", "project/*")],
+                conditions={
+                    "StringEquals": {
+                        "aws:ResourceTag/" + BRANCH_PIPELINE_TAG: repo_name
+                    }
+                },
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["ssm:GetParameters"],
+                effect=iam.Effect.ALLOW,
+                resources=[arn("ssm", "parameter/*")],
+            )
+        )
+
+        # roles can only be created, and given policies, with the boundary in place
+        role_arn = "arn:aws:iam::" + self.account + ":role/" + resource_prefix + "*"
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    "iam:CreateRole",
+                    "iam:PutRolePermissionsBoundary",
+                    "iam:PutRolePolicy",
+                    "iam:DeleteRolePolicy",
+                    "iam:AttachRolePolicy",
+                    "iam:DetachRolePolicy",
+                ],
+                effect=iam.Effect.ALLOW,
+                resources=[role_arn],
+                conditions={
+                    "StringEquals": {
+                        "iam:PermissionsBoundary": permissions_boundary.managed_policy_arn
+                    }
+                },
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=[
+                    "iam:GetRole",
+                    "iam:GetRolePolicy",
+                    "iam:ListRolePolicies",
+                    "iam:ListAttachedRolePolicies",
+                    "iam:TagRole",
+                    "iam:UntagRole",
+                    "iam:DeleteRole",
+                    "iam:PassRole",
+                ],
+                effect=iam.Effect.ALLOW,
+                resources=[role_arn],
+            )
+        )
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["iam:DeleteRolePermissionsBoundary"],
+                effect=iam.Effect.DENY,
+                resources=[role_arn],
+            )
+        )
+        # lambda code and other assets are read from the CDK staging bucket
+        execution_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject*"],
+                effect=iam.Effect.ALLOW,
+                resources=["arn:aws:s3:::cdktoolkit-stagingbucket-*/*"],
+            )
+        )
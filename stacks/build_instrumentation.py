@@ -0,0 +1,72 @@
+import os
+
+from aws_cdk import (
+    core as cdk,
+    aws_codebuild as codebuild,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_lambda as lambda_,
+    aws_logs as logs,
+    aws_logs_destinations as logs_destinations,
+)
+
+from stacks.pipeline_telemetry_stack import METRIC_NAMESPACE
+
+
+# records how long each phase of a build takes, and cache hits/misses reported by the build,
+# as CloudWatch metrics so we can see what is eating build minutes
+class BuildInstrumentation(cdk.Construct):
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        id: str,
+        project: codebuild.IProject,
+        log_group: logs.ILogGroup = None,
+        **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        metrics_function = lambda_.Function(
+            self,
+            "BuildMetricsFunction",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            handler="index.handler",
+            code=lambda_.Code.from_asset(
+                os.path.join(
+                    os.path.dirname(__file__), "..", "lambdas", "build_metrics"
+                )
+            ),
+            timeout=cdk.Duration.seconds(30),
+            environment={
+                "METRIC_NAMESPACE": METRIC_NAMESPACE,
+                "PROJECT_NAME": project.project_name,
+            },
+            log_retention=logs.RetentionDays.ONE_MONTH,
+        )
+
+        # the finished build event lists every phase with its duration
+        events.Rule(
+            self,
+            "BuildFinished",
+            description="Phase timings for " + cdk.Stack.of(self).stack_name,
+            event_pattern=events.EventPattern(
+                source=["aws.codebuild"],
+                detail_type=["CodeBuild Build State Change"],
+                detail={
+                    "project-name": [project.project_name],
+                    "build-status": ["SUCCEEDED", "FAILED", "STOPPED"],
+                },
+            ),
+            targets=[targets.LambdaFunction(metrics_function)],
+        )
+
+        # builds print CACHE_HIT <name> / CACHE_MISS <name>, lines with those words are sent to us and
+        # the function only counts the lines that are exactly a marker
+        if log_group:
+            logs.SubscriptionFilter(
+                self,
+                "CacheMarkers",
+                log_group=log_group,
+                destination=logs_destinations.LambdaDestination(metrics_function),
+                filter_pattern=logs.FilterPattern.any_term("CACHE_HIT", "CACHE_MISS"),
+            )
@@ -0,0 +1,251 @@
+"""Generates a tuned buildspec for each deployment model.
+
+The example buildspecs in the root of this project are a starting point, but
+they reinstall their toolchains on every build. The buildspecs generated here:
+
+- pin the toolchain versions, and only install them if the build image doesn't
+  already have that version
+- install dependencies with `npm ci` (when there is a lockfile) and pip, with
+  their download caches kept between builds
+- build SAM applications with `sam build --parallel --cached`, keeping all of
+  .aws-sam (build.toml, the build directory and the cache) between builds, as
+  `--cached` only skips functions whose build.toml entry and build output are there
+- synthesize CDK apps into the cloud assembly directory instead of piping stdout,
+  and package the stack with tools/cdk_package.py, which finds its template and
+  publishes its assets like `sam package` does
+- print `CACHE_HIT <name>` / `CACHE_MISS <name>` for each cache, which the
+  build metrics pick up
+
+This module only uses the standard library, so a buildspec can also be
+generated locally and committed to a repo:
+
+    python -m stacks.buildspec_generator sam > buildspec.yml
+    python -m stacks.buildspec_generator cdk --stack-name my-stack > buildspec.yml
+"""
+
+import argparse
+import json
+import re
+import sys
+
+BUILD_MODELS = ("sam", "cdk", "s3")
+
+TOOL_VERSIONS = {
+    "python": "3.8",
+    "nodejs": "14",
+    "aws-sam-cli": "1.24.1",
+    "aws-cdk": "1.102.0",
+}
+
+# caches kept between builds, by name, relative paths are relative to the source directory
+CACHE_DIRS = {
+    "pip": "/root/.cache/pip",
+    "npm": "/root/.npm",
+    "sam": ".aws-sam",
+}
+# a cache only counts as a hit when this is there, rather than anything in its directory
+CACHE_CHECKS = {
+    "sam": ".aws-sam/build.toml",
+}
+SAM_CACHE_DIR = ".aws-sam/cache"
+
+MODEL_CACHES = {
+    "sam": ["pip", "sam"],
+    "cdk": ["pip", "npm"],
+    "s3": ["npm"],
+}
+
+# where the built artifact comes from for the s3 model
+DEFAULT_OUTPUT_DIRECTORY = "build"
+# where stacks.pipeline_tools unpacks this project's tools/ in the build container, the cdk
+# model needs them
+PIPELINE_TOOLS_DIR = "/tmp/pipeline-tools"
+# the models whose buildspecs run the pipeline tools
+PIPELINE_TOOLS_MODELS = ("cdk",)
+
+
+def cache_marker_command(name):
+    path = CACHE_CHECKS.get(name, CACHE_DIRS[name])
+    # CodeBuild logs the command before running it, so the command itself mustn't contain the
+    # marker, or the log filter would see a hit in every build
+    return (
+        'if [ -n "$(ls -A %s 2>/dev/null)" ]; then CACHE=HIT; else CACHE=MISS; fi; '
+        "printf 'CACHE_%%s %%s\\n' \"$CACHE\" %s" % (path, name)
+    )
+
+
+def _npm_install_commands():
+    # npm ci is faster and reproducible, but needs a lockfile
+    return ["if [ -f package-lock.json ]; then npm ci; else npm install; fi"]
+
+
+def _pinned_install(command, version_command, version):
+    return "%s 2>/dev/null | grep -qF %s || %s" % (version_command, version, command)
+
+
+def generate_buildspec(
+    model: str,
+    stack_name: str = None,
+    output_directory: str = None,
+    tool_versions: dict = None,
+    prelude: list = None,
+) -> dict:
+    if model not in BUILD_MODELS:
+        raise ValueError(
+            "The buildspec model must be one of "
+            + ", ".join(BUILD_MODELS)
+            + ", provided as `-c buildspec_model=<model>`"
+        )
+
+    versions = dict(TOOL_VERSIONS, **(tool_versions or {}))
+    caches = MODEL_CACHES[model]
+
+    # anything the pipeline needs to run before the build itself, eg loading parameters
+    install = {"runtime-versions": {}, "commands": list(prelude or [])}
+    pre_build = [cache_marker_command(name) for name in caches]
+    build = []
+    post_build = []
+
+    if model == "sam":
+        install["runtime-versions"]["python"] = versions["python"]
+        install["commands"].append(
+            _pinned_install(
+                "pip3 install --quiet aws-sam-cli==" + versions["aws-sam-cli"],
+                "sam --version",
+                versions["aws-sam-cli"],
+            )
+        )
+        build.append("sam build --parallel --cached --cache-dir " + SAM_CACHE_DIR)
+        post_build.append(
+            "sam package --s3-bucket $PACKAGE_BUCKET ${PACKAGE_PREFIX:+--s3-prefix $PACKAGE_PREFIX}"
+            + " --output-template-file packaged.yaml"
+        )
+        artifacts = {"files": ["packaged.yaml"]}
+
+    elif model == "cdk":
+        if stack_name == None:
+            raise ValueError(
+                "The cdk buildspec needs the stack to synthesize, provided as `-c stack_name=<stack-name>`"
+            )
+        install["runtime-versions"]["python"] = versions["python"]
+        install["runtime-versions"]["nodejs"] = versions["nodejs"]
+        install["commands"].append(
+            _pinned_install(
+                "npm install -g aws-cdk@" + versions["aws-cdk"],
+                "cdk --version",
+                versions["aws-cdk"],
+            )
+        )
+        # python apps need their requirements, typescript/javascript apps their node modules,
+        # and the packaging tool boto3
+        pre_build += [
+            "if [ -f requirements.txt ]; then pip3 install --quiet -r requirements.txt; fi",
+            "if [ -f package-lock.json ]; then npm ci; fi",
+            'python3 -c "import boto3" 2>/dev/null || pip3 install --quiet boto3',
+        ]
+        # synthesize into the assembly directory rather than stdout, which can contain more
+        # than just the template. the template there is named after the stack's construct
+        # id, so cdk_package finds it by stack name, and publishes its assets
+        build.append("cdk synth -c environment=$ENVIRONMENT -o cdk.out --quiet")
+        build.append(
+            "(cd %s && python3 -m tools.cdk_package $CODEBUILD_SRC_DIR/cdk.out %s"
+            " --output $CODEBUILD_SRC_DIR/packaged.yaml)"
+            % (PIPELINE_TOOLS_DIR, stack_name)
+        )
+        artifacts = {"files": ["packaged.yaml"]}
+
+    else:
+        install["runtime-versions"]["nodejs"] = versions["nodejs"]
+        pre_build += _npm_install_commands()
+        build.append("npm run build")
+        artifacts = {
+            "base-directory": output_directory or DEFAULT_OUTPUT_DIRECTORY,
+            "discard-paths": "no",
+            "files": ["**/*"],
+        }
+
+    if not install["commands"]:
+        del install["commands"]
+
+    phases = {"install": install, "pre_build": {"commands": pre_build}}
+    phases["build"] = {"commands": build}
+    if post_build:
+        phases["post_build"] = {"commands": post_build}
+
+    return {
+        "version": "0.2",
+        "phases": phases,
+        "artifacts": artifacts,
+        "cache": {"paths": [CACHE_DIRS[name] + "/**/*" for name in caches]},
+    }
+
+
+# strings that are safe to write without quotes, as long as they don't read as a number or boolean
+PLAIN_STRING = re.compile(r"^[A-Za-z_./$][A-Za-z0-9_./$ =-]*$")
+YAML_KEYWORDS = ("yes", "no", "true", "false", "on", "off", "null", "~")
+
+
+def _yaml_scalar(value):
+    if (
+        PLAIN_STRING.match(value)
+        and value.strip() == value
+        and value.lower() not in YAML_KEYWORDS
+    ):
+        return value
+    # a JSON string is also a valid YAML double quoted string
+    return json.dumps(value)
+
+
+def to_yaml(value, indent=0):
+    """Render nested dicts, lists and strings as YAML, without needing PyYAML."""
+    pad = "  " * indent
+    lines = []
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (dict, list)) and item:
+                lines.append("%s%s:" % (pad, key))
+                lines.append(to_yaml(item, indent + 1))
+            else:
+                lines.append("%s%s: %s" % (pad, key, _yaml_scalar(item)))
+    else:
+        # buildspecs only ever have lists of strings
+        for item in value:
+            lines.append("%s- %s" % (pad, _yaml_scalar(item)))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Print a tuned buildspec.yml for a deployment model."
+    )
+    parser.add_argument("model", choices=BUILD_MODELS)
+    parser.add_argument("--stack-name", help="the stack to synthesize (cdk model)")
+    parser.add_argument(
+        "--output-directory",
+        help="the directory to deploy (s3 model, default %s)"
+        % DEFAULT_OUTPUT_DIRECTORY,
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print JSON instead of YAML"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        buildspec = generate_buildspec(
+            args.model,
+            stack_name=args.stack_name,
+            output_directory=args.output_directory,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.json:
+        print(json.dumps(buildspec, indent=2))
+    else:
+        print("# generated by python -m stacks.buildspec_generator " + args.model)
+        print(to_yaml(buildspec))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,32 @@ from aws_cdk import (
     aws_logs as logs,
 )
 
+from stacks.artifact_lifecycle import (
+    BUILD_CACHE_PREFIX,
+    PACKAGES_PREFIX,
+    RELEASES_PREFIX,
+    artifact_lifecycle_rules,
+)
+from stacks.build_instrumentation import BuildInstrumentation
+from stacks.buildspec_generator import PIPELINE_TOOLS_MODELS, generate_buildspec
+from stacks.deployment_bake import DEFAULT_BAKE_MINUTES, DeploymentBake
+from stacks.pipeline_execution import DeployLock, configure_execution_mode
+from stacks.pipeline_names import (
+    PIPELINE_PREFIX,
+    pooled_codepipeline_name,
+    safe_branch_name,
+)
+from stacks.shared_pipeline_infra_stack import use_shared_artifact_store
+from stacks.pipeline_tools import (
+    PARAMETER_LOADER_COMMANDS,
+    PIPELINE_TOOLS_DIR,
+    PIPELINE_TOOLS_INSTALL_COMMANDS,
+    SPARSE_CHECKOUT_COMMANDS,
+    grant_full_clone,
+    grant_parameter_loading,
+    pipeline_tools_asset,
+)
+
 
 class CloudformationPipelineStack(cdk.Stack):
     def __init__(
@@ -26,6 +52,20 @@ class CloudformationPipelineStack(cdk.Stack):
         stack_name: str,
         repo_owner: str,
         approvers: str,
+        preflight: bool = False,
+        execution_mode: str = None,
+        deploy_lock: bool = None,
+        alarm_names: str = None,
+        bake_minutes: int = None,
+        build_metrics: bool = False,
+        buildspec_model: str = None,
+        pooled: bool = False,
+        artifact_retention_days: int = None,
+        package_retention_days: int = None,
+        releases_to_keep: int = None,
+        load_parameters: bool = False,
+        full_clone: bool = False,
+        sparse_paths: str = None,
         **kwargs
     ) -> None:
         super().__init__(scope, id, **kwargs)
@@ -45,23 +85,26 @@ class CloudformationPipelineStack(cdk.Stack):
                 "The cross account role this pipeline will assume must be provided as `-c cross_account_role_arn=<cross_account_role_arn>`"
             )
 
-        pipeline_key = kms.Key.from_key_arn(
-            self,
-            "DeployKey",
-            key_arn=cdk.Fn.import_value(
-                self.stack_name.replace("cf-create-pipeline", "create-pipeline-infra")
-                + ":PipelineKeyArn"
-            ),
-        )
+        if buildspec_model not in (None, "sam", "cdk"):
+            raise ValueError(
+                "The CloudFormation pipeline can generate a `sam` or `cdk` buildspec, provided as `-c buildspec_model=<sam|cdk>`"
+            )
 
-        # Create the artifacts bucket we'll use
-        artifacts_bucket = s3.Bucket(
-            self,
-            "PipelineArtifactsBucket",
-            encryption_key=pipeline_key,
-            encryption=s3.BucketEncryption.KMS,
-            removal_policy=cdk.RemovalPolicy.DESTROY,
+        if full_clone and github_oauth_token and repo_owner:
+            raise ValueError(
+                "A full clone source needs a CodeCommit repo, GitHub sources can only be passed to the build as a zip"
+            )
+
+        if sparse_paths and not full_clone:
+            raise ValueError(
+                "Sparse paths can only be checked out of a full clone, add `-c full_clone=true`"
+            )
+
+        pipeline_name = (
+            PIPELINE_PREFIX + repo_name + "-" + safe_branch_name(repo_branch)
         )
+        # what CodePipeline calls it, which is only different for pooled pipelines
+        codepipeline_name = pipeline_name
 
         cross_account_role = iam.Role.from_role_arn(
             self,
@@ -78,34 +121,83 @@ class CloudformationPipelineStack(cdk.Stack):
             role_arn=deployment_role_arn,
         )
 
-        artifacts_bucket.add_to_resource_policy(
-            iam.PolicyStatement(
-                actions=["s3:Get*", "s3:Put*"],
-                resources=[artifacts_bucket.arn_for_objects("*")],
-                principals=[iam.AccountPrincipal(account_id=target_account_id)],
+        # where this pipeline keeps its packages, build cache and releases in the artifacts bucket
+        package_prefix = PACKAGES_PREFIX.rstrip("/")
+        build_cache_prefix = BUILD_CACHE_PREFIX.rstrip("/")
+        # the bake's promoted releases, which are pruned rather than expired
+        release_prefix = RELEASES_PREFIX + pipeline_name + "/"
+
+        if pooled:
+            # use the key and bucket shared by all pipelines deploying to the target account
+            # (from the role ARN itself, the shared key and bucket names can't be tokens)
+            codepipeline_name = pooled_codepipeline_name(pipeline_name)
+            pipeline_key, artifacts_bucket = use_shared_artifact_store(
+                self,
+                pipeline_name,
+                codepipeline_name,
+                cross_account_role_arn.split(":")[4],
+            )
+            # a prefix of their own in each part of the shared bucket, so lifecycle rules still apply
+            package_prefix = PACKAGES_PREFIX + pipeline_name
+            build_cache_prefix = BUILD_CACHE_PREFIX + pipeline_name
+        else:
+            pipeline_key = kms.Key.from_key_arn(
+                self,
+                "DeployKey",
+                key_arn=cdk.Fn.import_value(
+                    self.stack_name.replace(
+                        "cf-create-pipeline", "create-pipeline-infra"
+                    )
+                    + ":PipelineKeyArn"
+                ),
             )
-        )
 
-        artifacts_bucket.add_to_resource_policy(
-            iam.PolicyStatement(
-                actions=["s3:List*"],
-                resources=[
-                    artifacts_bucket.bucket_arn,
-                    artifacts_bucket.arn_for_objects("*"),
-                ],
-                principals=[iam.AccountPrincipal(account_id=target_account_id)],
+            # Create the artifacts bucket we'll use
+            artifacts_bucket = s3.Bucket(
+                self,
+                "PipelineArtifactsBucket",
+                bucket_key_enabled=True,
+                encryption_key=pipeline_key,
+                encryption=s3.BucketEncryption.KMS,
+                removal_policy=cdk.RemovalPolicy.DESTROY,
+                lifecycle_rules=artifact_lifecycle_rules(
+                    artifact_retention_days, package_retention_days
+                ),
+            )
+
+            artifacts_bucket.add_to_resource_policy(
+                iam.PolicyStatement(
+                    actions=["s3:Get*", "s3:Put*"],
+                    resources=[artifacts_bucket.arn_for_objects("*")],
+                    principals=[iam.AccountPrincipal(account_id=target_account_id)],
+                )
+            )
+
+            artifacts_bucket.add_to_resource_policy(
+                iam.PolicyStatement(
+                    actions=["s3:List*"],
+                    resources=[
+                        artifacts_bucket.bucket_arn,
+                        artifacts_bucket.arn_for_objects("*"),
+                    ],
+                    principals=[iam.AccountPrincipal(account_id=target_account_id)],
+                )
             )
-        )
 
         # create the pipeline and tell it to use the artifacts bucket
         pipeline = codepipeline.Pipeline(
             self,
-            "Pipeline-" + repo_name + "-" + repo_branch,
+            "Pipeline-" + repo_name + "-" + safe_branch_name(repo_branch),
             artifact_bucket=artifacts_bucket,
-            pipeline_name="pipeline-" + repo_name + "-" + repo_branch,
+            pipeline_name=codepipeline_name,
             cross_account_keys=True,
             restart_execution_on_update=True,
         )
+        configure_execution_mode(pipeline, execution_mode)
+
+        # parallel executions would otherwise interleave their change sets on the same stack
+        if deploy_lock == None:
+            deploy_lock = execution_mode == "PARALLEL"
 
         # allow the pipeline to assume any role in the target account
         cross_account_access = iam.PolicyStatement(
@@ -135,47 +227,117 @@ class CloudformationPipelineStack(cdk.Stack):
                 ],
             )
         else:
+            code_repo = codecommit.Repository.from_repository_name(
+                self, "Repo", repo_name
+            )
             pipeline.add_stage(
                 stage_name="Source",
                 actions=[
                     codepipeline_actions.CodeCommitSourceAction(
                         action_name="GetSource",
-                        repository=codecommit.Repository.from_repository_name(
-                            self, "Repo", repo_name
-                        ),
+                        repository=code_repo,
                         output=source_output,
                         branch=repo_branch,
+                        # pass the build a reference to the commit instead of zipping the repo
+                        code_build_clone_output=full_clone,
                     )
                 ],
             )
 
+        # let's map some new ones to old ones so we don't get into trouble...
+        stack_name = (
+            stack_name or repo_name + "-" + safe_branch_name(repo_branch) + "-stack"
+        )
+
+        build_environment = {
+            "PACKAGE_BUCKET": codebuild.BuildEnvironmentVariable(
+                value=artifacts_bucket.bucket_name
+            ),
+            "PACKAGE_PREFIX": codebuild.BuildEnvironmentVariable(value=package_prefix),
+            "ENVIRONMENT": codebuild.BuildEnvironmentVariable(value=build_env),
+        }
+
+        # optionally have the build load this pipeline's parameters in one go, generated
+        # buildspecs do it before anything else, your own buildspec.yml can run the same commands
+        build_prelude = []
+        # generated cdk buildspecs package the stack with the tools too
+        build_tools = load_parameters or buildspec_model in PIPELINE_TOOLS_MODELS
+        if build_tools:
+            tools_asset = pipeline_tools_asset(self)
+            build_environment["PIPELINE_TOOLS_URL"] = (
+                codebuild.BuildEnvironmentVariable(value=tools_asset.s3_object_url)
+            )
+            build_prelude = list(PIPELINE_TOOLS_INSTALL_COMMANDS)
+        if load_parameters:
+            build_environment["PARAMETER_PATH"] = codebuild.BuildEnvironmentVariable(
+                value="/" + pipeline_name
+            )
+            build_prelude += PARAMETER_LOADER_COMMANDS
+
+        # big repos can be cloned by the build, and optionally narrowed to the paths it needs
+        if full_clone:
+            if sparse_paths:
+                build_environment["SOURCE_SPARSE_PATHS"] = (
+                    codebuild.BuildEnvironmentVariable(
+                        value=" ".join(path.strip() for path in sparse_paths.split(","))
+                    )
+                )
+            build_prelude = SPARSE_CHECKOUT_COMMANDS + build_prelude
+
+        # use the repo's own buildspec.yml, unless we've been asked to generate a tuned one,
+        # in which case its caches are kept in the artifacts bucket between builds
+        build_spec = codebuild.BuildSpec.from_source_filename("buildspec.yml")
+        build_cache = None
+        if buildspec_model:
+            build_spec = codebuild.BuildSpec.from_object(
+                generate_buildspec(
+                    buildspec_model, stack_name=stack_name, prelude=build_prelude
+                )
+            )
+            build_cache = codebuild.Cache.bucket(
+                artifacts_bucket, prefix=build_cache_prefix
+            )
+
         # create the build stage which takes the source artifact and outputs the built artifact
         # to allow use of docker, need privileged flag to be set to True
         build_output = codepipeline.Artifact()
+        build_log_group = logs.LogGroup(
+            self,
+            "PipelineLogs",
+        )
         build_project = codebuild.PipelineProject(
             self,
             "Build",
-            build_spec=codebuild.BuildSpec.from_source_filename("buildspec.yml"),
+            build_spec=build_spec,
+            cache=build_cache,
             logging=codebuild.LoggingOptions(
                 cloud_watch=codebuild.CloudWatchLoggingOptions(
                     enabled=True,
-                    log_group=logs.LogGroup(
-                        self,
-                        "PipelineLogs",
-                    ),
+                    log_group=build_log_group,
                 )
             ),
             environment={
                 "build_image": codebuild.LinuxBuildImage.AMAZON_LINUX_2_3,
                 "privileged": True,
             },
-            environment_variables={
-                "PACKAGE_BUCKET": codebuild.BuildEnvironmentVariable(
-                    value=artifacts_bucket.bucket_name
-                ),
-                "ENVIRONMENT": codebuild.BuildEnvironmentVariable(value=build_env),
-            },
+            environment_variables=build_environment,
         )
+        if build_tools:
+            tools_asset.grant_read(build_project)
+        if load_parameters:
+            grant_parameter_loading(build_project, pipeline_name)
+        if full_clone:
+            grant_full_clone(build_project, code_repo)
+
+        # optionally turn the build into phase timing and cache metrics
+        if build_metrics:
+            BuildInstrumentation(
+                self,
+                "BuildInstrumentation",
+                project=build_project,
+                log_group=build_log_group,
+            )
+
         pipeline.add_stage(
             stage_name="Build",
             actions=[
@@ -188,38 +350,97 @@ class CloudformationPipelineStack(cdk.Stack):
             ],
         )
 
+        cfn_capabilities = [
+            cdk.CfnCapabilities.NAMED_IAM,
+            cdk.CfnCapabilities.AUTO_EXPAND,
+        ]
+
+        # optionally check the packaged template before we go anywhere near the target account,
+        # so template errors fail the pipeline in seconds rather than after CreateChangeSet
+        if preflight:
+            tools_asset = pipeline_tools_asset(self)
+            preflight_command = (
+                "python3 -m tools.template_preflight $CODEBUILD_SRC_DIR/packaged.yaml"
+                + " --capabilities "
+                + ",".join(capability.value for capability in cfn_capabilities)
+            )
+            if build_env:
+                preflight_command += " --parameter Environment=" + build_env
+
+            preflight_project = codebuild.PipelineProject(
+                self,
+                "Preflight",
+                build_spec=codebuild.BuildSpec.from_object(
+                    {
+                        "version": "0.2",
+                        "phases": {
+                            "install": {
+                                "commands": PIPELINE_TOOLS_INSTALL_COMMANDS
+                                + ["pip3 install --quiet pyyaml"]
+                            },
+                            "build": {
+                                "commands": [
+                                    "cd " + PIPELINE_TOOLS_DIR,
+                                    preflight_command,
+                                ]
+                            },
+                        },
+                    }
+                ),
+                environment={"build_image": codebuild.LinuxBuildImage.AMAZON_LINUX_2_3},
+                environment_variables={
+                    "PIPELINE_TOOLS_URL": codebuild.BuildEnvironmentVariable(
+                        value=tools_asset.s3_object_url
+                    ),
+                },
+            )
+            tools_asset.grant_read(preflight_project)
+
+            pipeline.add_stage(
+                stage_name="Preflight",
+                actions=[
+                    codepipeline_actions.CodeBuildAction(
+                        action_name="ValidateTemplate",
+                        project=preflight_project,
+                        input=build_output,
+                    )
+                ],
+            )
+
         # create the deployment stages that take the built artifact and create a change set then deploy it
 
         ##########################################################
         # CLOUDFORMATION DEPLOYMENT
         ##########################################################
 
-        # let's map some new ones to old ones so we don't get into trouble...
-        stack_name = stack_name or repo_name + "-" + repo_branch + "-stack"
-
         # only set Environment is build_env is set
         if build_env:
             parameters = {"Environment": build_env}
         else:
             parameters = None
 
+        # each execution gets a change set of its own, so parallel executions can't replace the
+        # one another is waiting to have approved, and the change set that's executed is the one
+        # that was reviewed
+        change_set_name = stack_name + "-#{codepipeline.PipelineExecutionId}"
+
+        # the change set approvers review is created without the lock, so an execution waiting
+        # for approval doesn't hold up the others
         pipeline.add_stage(
             stage_name="CreateChangeSet",
             actions=[
                 codepipeline_actions.CloudFormationCreateReplaceChangeSetAction(
-                    change_set_name=stack_name + "-changeset",
+                    change_set_name=change_set_name,
                     action_name="CreateChangeSet",
                     template_path=build_output.at_path("packaged.yaml"),
                     stack_name=stack_name,
-                    cfn_capabilities=[
-                        cdk.CfnCapabilities.NAMED_IAM,
-                        cdk.CfnCapabilities.AUTO_EXPAND,
-                    ],
+                    cfn_capabilities=cfn_capabilities,
                     admin_permissions=True,
                     parameter_overrides=parameters,
                     role=cross_account_role,
                     deployment_role=deployment_role,
-                ),
+                    run_order=1,
+                )
             ],
         )
 
@@ -234,17 +455,69 @@ class CloudformationPipelineStack(cdk.Stack):
                 ],
             )
 
+        deploy_change_set_actions = [
+            codepipeline_actions.CloudFormationExecuteChangeSetAction(
+                change_set_name=change_set_name,
+                stack_name=stack_name,
+                action_name="Deploy",
+                role=cross_account_role,
+                run_order=2 if deploy_lock else 1,
+            ),
+        ]
+
+        # the lock is taken after approval, and held until the change set has been executed
+        if deploy_lock:
+            # use the literal name, the pipeline's own Ref here would be a circular dependency
+            lock = DeployLock(
+                self,
+                "DeployLock",
+                pipeline_name=codepipeline_name,
+            )
+            # if another execution deployed while this one waited, CloudFormation has deleted this
+            # change set and the deploy fails, rather than deploying something nobody reviewed
+            deploy_change_set_actions.insert(0, lock.acquire_action(run_order=1))
+
+        # optionally watch alarms after the deploy, rolling back to the last good release if one fires
+        bake_actions = []
+        if alarm_names:
+            bake = DeploymentBake(
+                self,
+                "DeploymentBake",
+                pipeline_name=pipeline_name,
+                artifacts_bucket=artifacts_bucket,
+                release_prefix=release_prefix,
+                releases_to_keep=releases_to_keep,
+                cross_account_role_arn=cross_account_role_arn,
+                stack_name=stack_name,
+                deployment_role_arn=deployment_role_arn,
+                parameters=parameters,
+                capabilities=cfn_capabilities,
+            )
+            bake_actions.append(
+                bake.bake_action(
+                    input=build_output,
+                    alarm_names=alarm_names.split(","),
+                    bake_minutes=bake_minutes or DEFAULT_BAKE_MINUTES,
+                )
+            )
+
+        if deploy_lock:
+            # hold the lock through the bake so a rollback can't clash with the next deploy
+            if bake_actions:
+                bake_actions.append(lock.release_action(run_order=2))
+            else:
+                deploy_change_set_actions.append(lock.release_action(run_order=3))
+
         pipeline.add_stage(
             stage_name="DeployChangeSet",
-            actions=[
-                codepipeline_actions.CloudFormationExecuteChangeSetAction(
-                    change_set_name=stack_name + "-changeset",
-                    stack_name=stack_name,
-                    action_name="Deploy",
-                    role=cross_account_role,
-                ),
-            ],
+            actions=deploy_change_set_actions,
         )
 
+        if bake_actions:
+            pipeline.add_stage(
+                stage_name="Bake",
+                actions=bake_actions,
+            )
+
         cdk.CfnOutput(self, "ArtifactBucketArn", value=artifacts_bucket.bucket_arn)
         cdk.CfnOutput(self, "ArtifactBucketName", value=artifacts_bucket.bucket_name)
@@ -10,8 +10,15 @@ from aws_cdk import (
     aws_kms as kms,
 )
 
+from stacks.policy_compactor import DEFAULT_MAX_RESOURCES, compacted_policies
+
 ####################################################################################################
 # This stack needs to be created in the target account the pipeline will deploy to
+#
+# The buckets and key can be comma separated lists, so one role can serve every pipeline deploying
+# to the account. The policies are compacted to stay inside IAM's size limits, and resources are
+# collapsed to a wildcard (eg myapp-*) once there are more than max_policy_resources of them, unless
+# collapse_policy_resources is false
 ####################################################################################################
 
 
@@ -24,6 +31,8 @@ class CrossAccountRoleStack(cdk.Stack):
         pipeline_key_arn: str,
         target_bucket: str = None,
         artifact_bucket: str = None,
+        max_policy_resources: int = None,
+        collapse_policy_resources: bool = True,
         **kwargs
     ) -> None:
         super().__init__(scope, id, **kwargs)
@@ -38,14 +47,20 @@ class CrossAccountRoleStack(cdk.Stack):
                 "The KMS key from the devops account needs to be provided as `-c pipeline_key_arn=<key-arn>`"
             )
 
+        pipeline_key_arns = pipeline_key_arn.split(",")
+        artifact_buckets = artifact_bucket.split(",") if artifact_bucket else []
+        target_buckets = target_bucket.split(",") if target_bucket else []
+
         # if no artifact bucket is provided, allow access to all buckets
-        # otherwise specify only the artifact bucket
-        pipeline_s3_resources = "arn:aws:s3:::*"
-        if artifact_bucket:
-            art_bucket = s3.Bucket.from_bucket_name(
-                self, "ArtBucketByAtt", bucket_name=artifact_bucket
-            )
-            pipeline_s3_resources = art_bucket.arn_for_objects("*")
+        # otherwise specify only the artifact buckets
+        pipeline_s3_resources = ["arn:aws:s3:::*"]
+        if artifact_buckets:
+            pipeline_s3_resources = [
+                s3.Bucket.from_bucket_name(
+                    self, "ArtBucketByAtt" + str(index or ""), bucket_name=name
+                ).arn_for_objects("*")
+                for index, name in enumerate(artifact_buckets)
+            ]
 
         # Start with an empty policy statements list
         policy_statements = []
@@ -68,17 +83,37 @@ class CrossAccountRoleStack(cdk.Stack):
             iam.PolicyStatement(
                 actions=["s3:Get*", "s3:Put*", "s3:ListBucket"],
                 effect=iam.Effect.ALLOW,
-                resources=[pipeline_s3_resources],
+                resources=pipeline_s3_resources,
             )
         )
 
+        # the key is only ever used by S3 on our behalf, to read artifacts. with an S3 Bucket Key the
+        # encryption context is the bucket rather than the object, so allow both
+        kms_conditions = {
+            "StringEquals": {"kms:ViaService": "s3." + self.region + ".amazonaws.com"}
+        }
+        if artifact_buckets:
+            kms_conditions["StringLike"] = {
+                "kms:EncryptionContext:aws:s3:arn": [
+                    "arn:aws:s3:::" + name + "*" for name in artifact_buckets
+                ]
+            }
         policy_statements.append(
             iam.PolicyStatement(
                 actions=[
                     "kms:Decrypt",
                 ],
                 effect=iam.Effect.ALLOW,
-                resources=[pipeline_key_arn],
+                resources=pipeline_key_arns,
+                conditions=kms_conditions,
+            )
+        )
+        # allow the pipeline to check alarms in this account while it bakes a deployment
+        policy_statements.append(
+            iam.PolicyStatement(
+                actions=["cloudwatch:DescribeAlarms"],
+                effect=iam.Effect.ALLOW,
+                resources=["*"],
             )
         )
         # allow this role to get items from the parameter store
@@ -93,20 +128,25 @@ class CrossAccountRoleStack(cdk.Stack):
         ####################################################################################################
         # If you pass a target_bucket value, then we build a cross account role for S3Deploy
         ####################################################################################################
-        if target_bucket:
-            dep_bucket = s3.Bucket.from_bucket_name(
-                self,
-                "BucketByAtt",
-                bucket_name=target_bucket,
-            )
-            # Add the S3 deploy action to put objects in the deployment bucket
-            policy_statements.append(
-                iam.PolicyStatement(
-                    actions=["s3:DeleteObject*", "s3:PutObject*", "s3:Abort*"],
-                    effect=iam.Effect.ALLOW,
-                    resources=[dep_bucket.bucket_arn, dep_bucket.arn_for_objects("*")],
+        if target_buckets:
+            for index, name in enumerate(target_buckets):
+                dep_bucket = s3.Bucket.from_bucket_name(
+                    self,
+                    "BucketByAtt" + str(index or ""),
+                    bucket_name=name,
+                )
+                # Add the S3 deploy action to put objects in the deployment bucket. the compactor
+                # merges these into one statement however many buckets there are
+                policy_statements.append(
+                    iam.PolicyStatement(
+                        actions=["s3:DeleteObject*", "s3:PutObject*", "s3:Abort*"],
+                        effect=iam.Effect.ALLOW,
+                        resources=[
+                            dep_bucket.bucket_arn,
+                            dep_bucket.arn_for_objects("*"),
+                        ],
+                    )
                 )
-            )
 
         ####################################################################################################
         # Otherwise, we build a cross account role for Cloudformation Deploy
@@ -313,27 +353,41 @@ class CrossAccountRoleStack(cdk.Stack):
                 )
             )
 
+        max_policy_resources = int(max_policy_resources or DEFAULT_MAX_RESOURCES)
+        if not collapse_policy_resources:
+            max_policy_resources = None
+
         # allow the cross account role to be assumed by the devops account
+        inline_policies, managed_policies = compacted_policies(
+            self,
+            "CrossAccountRole",
+            policy_statements,
+            max_resources=max_policy_resources,
+        )
         cross_account_role = iam.Role(
             self,
             "CrossAccountRole",
             assumed_by=iam.AccountPrincipal(devops_account_id),
-            inline_policies=[
-                iam.PolicyDocument(statements=policy_statements),
-            ],
+            inline_policies=inline_policies,
+            managed_policies=managed_policies,
         )
 
-        if target_bucket == None:
-            # merge the basic permissions with the extra cloudformation permissions
-            policy_statements.extend(deploy_policy_statements)
+        if not target_buckets:
+            # merge the basic permissions with the extra cloudformation permissions, compacted
+            # separately so that the cross account role doesn't get the deploy permissions
+            inline_policies, managed_policies = compacted_policies(
+                self,
+                "DeploymentRole",
+                policy_statements + deploy_policy_statements,
+                max_resources=max_policy_resources,
+            )
             # create the deployment role, and allow it to be assumed by the Cloudformation service principal
             deployment_role = iam.Role(
                 self,
                 "DeploymentRole",
                 assumed_by=iam.ServicePrincipal(service="cloudformation.amazonaws.com"),
-                inline_policies=[
-                    iam.PolicyDocument(statements=policy_statements),
-                ],
+                inline_policies=inline_policies,
+                managed_policies=managed_policies,
             )
             cdk.CfnOutput(
                 self,
@@ -0,0 +1,109 @@
+import json
+import os
+
+from aws_cdk import (
+    core as cdk,
+    aws_codepipeline as codepipeline,
+    aws_codepipeline_actions as codepipeline_actions,
+    aws_iam as iam,
+    aws_lambda as lambda_,
+    aws_s3 as s3,
+)
+
+from stacks.artifact_lifecycle import DEFAULT_RELEASES_TO_KEEP
+
+DEFAULT_BAKE_MINUTES = 10
+
+
+# watches alarms in the target account after a deploy. if they stay quiet for the bake
+# window the build artifact is recorded as the last known good release in the artifact
+# bucket, if one fires the last known good release is redeployed without a rebuild
+class DeploymentBake(cdk.Construct):
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        id: str,
+        pipeline_name: str,
+        artifacts_bucket: s3.IBucket,
+        cross_account_role_arn: str,
+        target_bucket: str = None,
+        target_prefix: str = None,
+        stack_name: str = None,
+        deployment_role_arn: str = None,
+        parameters: dict = None,
+        capabilities: list = None,
+        release_prefix: str = None,
+        releases_to_keep: int = None,
+        **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        environment = {
+            "ARTIFACT_BUCKET": artifacts_bucket.bucket_name,
+            "PIPELINE_NAME": pipeline_name,
+            "CROSS_ACCOUNT_ROLE_ARN": cross_account_role_arn,
+            "RELEASES_TO_KEEP": str(releases_to_keep or DEFAULT_RELEASES_TO_KEEP),
+        }
+        # where in the artifacts bucket the last known good release is kept
+        if release_prefix:
+            environment["RELEASE_PREFIX"] = release_prefix
+        if target_bucket:
+            environment["DEPLOY_MODEL"] = "s3"
+            environment["TARGET_BUCKET"] = target_bucket
+            if target_prefix:
+                environment["TARGET_PREFIX"] = target_prefix
+        else:
+            environment["DEPLOY_MODEL"] = "cloudformation"
+            environment["STACK_NAME"] = stack_name
+            environment["DEPLOYMENT_ROLE_ARN"] = deployment_role_arn
+            environment["STACK_PARAMETERS"] = json.dumps(parameters or {})
+            environment["CAPABILITIES"] = ",".join(
+                capability.value for capability in capabilities or []
+            )
+
+        self.bake_function = lambda_.Function(
+            self,
+            "BakeFunction",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            handler="index.handler",
+            code=lambda_.Code.from_asset(
+                os.path.join(
+                    os.path.dirname(__file__), "..", "lambdas", "deployment_bake"
+                )
+            ),
+            # long enough to redeploy a large S3 site on rollback
+            timeout=cdk.Duration.minutes(15),
+            memory_size=512,
+            environment=environment,
+        )
+
+        # read the artifacts being baked, and read/write the last known good release
+        artifacts_bucket.grant_read_write(self.bake_function)
+
+        # alarms are checked, and rollbacks done, in the target account
+        self.bake_function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["sts:AssumeRole"],
+                effect=iam.Effect.ALLOW,
+                resources=[cross_account_role_arn],
+            )
+        )
+
+    def bake_action(
+        self,
+        input: codepipeline.Artifact,
+        alarm_names: list,
+        bake_minutes: int = DEFAULT_BAKE_MINUTES,
+        run_order: int = 1,
+    ):
+        return codepipeline_actions.LambdaInvokeAction(
+            action_name="WatchAlarms",
+            lambda_=self.bake_function,
+            inputs=[input],
+            run_order=run_order,
+            user_parameters={
+                "alarms": alarm_names,
+                "bake_seconds": int(bake_minutes) * 60,
+                "execution_id": "#{codepipeline.PipelineExecutionId}",
+            },
+        )
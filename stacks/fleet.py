@@ -0,0 +1,166 @@
+import json
+
+from stacks.pipeline_names import pipeline_name, shared_artifact_bucket_name
+
+# keys a fleet file can set for all of its targets, and each target can override
+FLEET_DEFAULTS = (
+    "region",
+    "pipeline_key_arn",
+    "artifact_bucket",
+)
+# CloudFormation only allows this much stack description
+MAX_DESCRIPTION_LENGTH = 1024
+
+
+####################################################################################################
+# Creates the cross account roles for a whole fleet of target accounts in one synth, from a file
+# listing the pipelines that deploy to each of them:
+#
+# {
+#     "region": "ap-southeast-2",
+#     "pipeline_key_arn": "<pipeline-key-arn>",
+#     "targets": [
+#         {"account": "<account-id>", "repo": "site", "branch": "main", "target_bucket": "site-prod"},
+#         {"account": "<account-id>", "repo": "api", "branch": "main"},
+#         ...
+#     ]
+# }
+#
+# Pipelines deploying to the same account and region share a role stack, one for S3 pipelines
+# (targets with a target_bucket) and one for CloudFormation pipelines. The stack's role covers
+# every bucket and key its pipelines need. Those are listed one by one, and only collapsed to a
+# wildcard when -c max_policy_resources is given, as a fleet role easily has enough of them to.
+#
+# load_fleet and group_fleet only need the standard library, CDK is imported when the stacks are made
+####################################################################################################
+
+
+def load_fleet(path: str) -> list:
+    with open(path) as f:
+        fleet = json.load(f)
+
+    # a bare list of targets is fine too
+    if isinstance(fleet, list):
+        fleet = {"targets": fleet}
+
+    targets = []
+    for index, target in enumerate(fleet.get("targets", [])):
+        target = dict(
+            {key: fleet[key] for key in FLEET_DEFAULTS if key in fleet}, **target
+        )
+        for key in ("account", "region", "pipeline_key_arn"):
+            if not target.get(key):
+                raise ValueError(
+                    "Target "
+                    + str(index)
+                    + " in "
+                    + path
+                    + " needs a `"
+                    + key
+                    + "`, either of its own or at the top of the file"
+                )
+        target["account"] = str(target["account"])
+        targets.append(target)
+
+    if not targets:
+        raise ValueError(path + " doesn't list any targets")
+    return targets
+
+
+def group_fleet(
+    targets: list, devops_account_id: str = None, pooled: bool = False
+) -> dict:
+    # one role per account, region and pipeline type, keyed by (account, region, "s3" or "cloudformation")
+    groups = {}
+    for target in targets:
+        account = target["account"]
+        region = target["region"]
+        kind = "s3" if target.get("target_bucket") else "cloudformation"
+        group = groups.setdefault(
+            (account, region, kind),
+            {
+                "target_buckets": set(),
+                "pipeline_key_arns": set(),
+                "artifact_buckets": set(),
+                "all_artifact_buckets": False,
+                "pipelines": set(),
+            },
+        )
+
+        if target.get("target_bucket"):
+            group["target_buckets"].add(target["target_bucket"])
+        group["pipeline_key_arns"].add(target["pipeline_key_arn"])
+
+        artifact_bucket = target.get("artifact_bucket")
+        if pooled and not artifact_bucket and devops_account_id:
+            artifact_bucket = shared_artifact_bucket_name(
+                devops_account_id, account, region
+            )
+        if artifact_bucket:
+            group["artifact_buckets"].add(artifact_bucket)
+        else:
+            # one pipeline that hasn't said where its artifacts are means the role can't be limited
+            group["all_artifact_buckets"] = True
+
+        if target.get("repo") and target.get("branch"):
+            group["pipelines"].add(pipeline_name(target["repo"], target["branch"]))
+
+    return {
+        key: {
+            "target_buckets": sorted(group["target_buckets"]),
+            "pipeline_key_arns": sorted(group["pipeline_key_arns"]),
+            "artifact_buckets": (
+                []
+                if group["all_artifact_buckets"]
+                else sorted(group["artifact_buckets"])
+            ),
+            "pipelines": sorted(group["pipelines"]),
+        }
+        for key, group in sorted(groups.items())
+    }
+
+
+def fleet_stack_name(account: str, region: str, kind: str) -> str:
+    return "create-cross-account-role-" + account + "-" + region + "-" + kind
+
+
+def create_fleet_role_stacks(
+    scope,
+    fleet_file: str,
+    devops_account_id: str,
+    pooled: bool = False,
+    max_policy_resources: int = None,
+) -> list:
+    from aws_cdk import core as cdk
+
+    from stacks.cross_account_role_stack import CrossAccountRoleStack
+
+    if devops_account_id == None:
+        raise ValueError(
+            "The AWS account ID to be trusted needs to be provided as `-c devops_account_id=<account-id>`"
+        )
+
+    stacks = []
+    groups = group_fleet(load_fleet(fleet_file), devops_account_id, pooled)
+    for (account, region, kind), group in groups.items():
+        description = "Cross account roles for " + (
+            ", ".join(group["pipelines"]) or "pipelines deploying to " + account
+        )
+        if len(description) > MAX_DESCRIPTION_LENGTH:
+            description = description[: MAX_DESCRIPTION_LENGTH - 3] + "..."
+
+        stacks.append(
+            CrossAccountRoleStack(
+                scope,
+                fleet_stack_name(account, region, kind),
+                devops_account_id=devops_account_id,
+                pipeline_key_arn=",".join(group["pipeline_key_arns"]),
+                artifact_bucket=",".join(group["artifact_buckets"]) or None,
+                target_bucket=",".join(group["target_buckets"]) or None,
+                max_policy_resources=max_policy_resources,
+                collapse_policy_resources=max_policy_resources != None,
+                description=description,
+                env=cdk.Environment(account=account, region=region),
+            )
+        )
+    return stacks
@@ -1,8 +1,18 @@
+import json
+
 from aws_cdk import (
     core as cdk,
     aws_ssm as ssm,
 )
 
+from stacks.pipeline_names import safe_branch_name
+
+PARAMETER_FORMATS = ("hierarchy", "json")
+# the json format stores everything in one parameter with this name, see tools/parameter_loader.py
+PARAMETER_DOCUMENT = "parameters.json"
+# standard parameters hold up to 4KB, advanced ones 8KB
+STANDARD_PARAMETER_LIMIT = 4096
+
 
 class ParameterStack(cdk.Stack):
     def __init__(
@@ -12,6 +22,7 @@ class ParameterStack(cdk.Stack):
         parameter_list: str,
         repo_name: str,
         repo_branch: str,
+        parameter_format: str = None,
         **kwargs
     ) -> None:
         super().__init__(scope, id, **kwargs)
@@ -33,6 +44,18 @@ class ParameterStack(cdk.Stack):
                 "The branch this pipeline will deploy must be provided as `-c branch=<branch-name>`"
             )
 
+        parameter_format = parameter_format or "hierarchy"
+        if parameter_format not in PARAMETER_FORMATS:
+            raise ValueError(
+                "The parameter format needs to be one of "
+                + ", ".join(PARAMETER_FORMATS)
+                + ", provided as `-c parameter_format=<format>`"
+            )
+
+        pipeline_name = "pipeline-" + "-".join(
+            (repo_name, safe_branch_name(repo_branch))
+        )
+        parameters = {}
         for param in params_to_create:
             split_params = param.split(":")
             name = split_params[0]
@@ -40,7 +63,35 @@ class ParameterStack(cdk.Stack):
                 value = split_params[1]
             except IndexError:
                 value = "placeholder"
-            pipeline_name = "pipeline-" + "-".join((repo_name, repo_branch))
+            parameters[name] = value
+
+        # one parameter holding all the values as json, so builds can read them in a single call
+        if parameter_format == "json":
+            param_name = "/" + "/".join((pipeline_name, PARAMETER_DOCUMENT))
+            document = json.dumps(parameters, sort_keys=True)
+
+            ssm.StringParameter(
+                self,
+                "ParameterDocument",
+                description="Params for " + pipeline_name,
+                parameter_name=param_name,
+                string_value=document,
+                tier=(
+                    ssm.ParameterTier.ADVANCED
+                    if len(document) > STANDARD_PARAMETER_LIMIT
+                    else ssm.ParameterTier.STANDARD
+                ),
+            )
+
+            cdk.CfnOutput(
+                self,
+                "ParameterDocumentOutput",
+                value=param_name,
+                export_name=self.stack_name + ":" + pipeline_name + "-parameters",
+            )
+            return
+
+        for name, value in parameters.items():
             param_name = "/" + "/".join((pipeline_name, name))
 
             ssm.StringParameter(
@@ -0,0 +1,103 @@
+import os
+
+from aws_cdk import (
+    core as cdk,
+    aws_codepipeline as codepipeline,
+    aws_codepipeline_actions as codepipeline_actions,
+    aws_dynamodb as dynamodb,
+    aws_iam as iam,
+    aws_lambda as lambda_,
+)
+
+EXECUTION_MODES = ["SUPERSEDED", "QUEUED", "PARALLEL"]
+
+
+def configure_execution_mode(
+    pipeline: codepipeline.Pipeline, execution_mode: str
+) -> None:
+    if execution_mode == None:
+        return
+
+    if execution_mode not in EXECUTION_MODES:
+        raise ValueError(
+            "The execution mode must be one of "
+            + ", ".join(EXECUTION_MODES)
+            + " but was given as `-c execution_mode="
+            + execution_mode
+            + "`"
+        )
+
+    # the L2 Pipeline construct doesn't know about pipeline types or execution modes yet,
+    # so set them on the underlying CfnPipeline. QUEUED and PARALLEL need a V2 pipeline
+    cfn_pipeline = pipeline.node.default_child
+    if execution_mode != "SUPERSEDED":
+        cfn_pipeline.add_property_override("PipelineType", "V2")
+    cfn_pipeline.add_property_override("ExecutionMode", execution_mode)
+
+
+# serializes the deploy stages of a pipeline whose executions otherwise run in parallel.
+# wrap the deploy stages with acquire_action() and release_action(), after any approval so an
+# execution waiting to be approved doesn't hold the lock. an execution that can't get the lock
+# waits in the acquire action until the holder releases it or finishes
+class DeployLock(cdk.Construct):
+    def __init__(
+        self, scope: cdk.Construct, id: str, pipeline_name: str, **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.pipeline_name = pipeline_name
+
+        lock_table = dynamodb.Table(
+            self,
+            "LockTable",
+            partition_key=dynamodb.Attribute(
+                name="lock_id", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        self.lock_function = lambda_.Function(
+            self,
+            "LockFunction",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            handler="index.handler",
+            code=lambda_.Code.from_asset(
+                os.path.join(os.path.dirname(__file__), "..", "lambdas", "deploy_lock")
+            ),
+            timeout=cdk.Duration.minutes(1),
+            environment={"LOCK_TABLE": lock_table.table_name},
+        )
+        lock_table.grant_read_write_data(self.lock_function)
+
+        # needed to tell whether the execution holding the lock is still running
+        self.lock_function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["codepipeline:GetPipelineExecution"],
+                effect=iam.Effect.ALLOW,
+                resources=[
+                    cdk.Stack.of(self).format_arn(
+                        service="codepipeline", resource=pipeline_name
+                    )
+                ],
+            )
+        )
+
+    def _action(self, operation: str, lock_name: str, run_order: int):
+        return codepipeline_actions.LambdaInvokeAction(
+            action_name=operation.capitalize() + "DeployLock",
+            lambda_=self.lock_function,
+            run_order=run_order,
+            user_parameters={
+                "operation": operation,
+                "lock": self.pipeline_name + "/" + lock_name,
+                "pipeline": self.pipeline_name,
+                "execution_id": "#{codepipeline.PipelineExecutionId}",
+            },
+        )
+
+    def acquire_action(self, lock_name: str = "deploy", run_order: int = 1):
+        return self._action("acquire", lock_name, run_order)
+
+    def release_action(self, lock_name: str = "deploy", run_order: int = 1):
+        return self._action("release", lock_name, run_order)
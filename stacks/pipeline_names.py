@@ -0,0 +1,76 @@
+"""Names derived from a repo and branch.
+
+Only needs the standard library, so the tools and tests can use it too. The
+branch pipelines Lambda keeps its own copy of the functions it needs (it's
+deployed on its own), which the tests check against these.
+"""
+
+import hashlib
+import re
+
+PIPELINE_PREFIX = "pipeline-"
+# CodePipeline keeps a pipeline's artifacts in a folder named after the first 20 characters of its
+# name, and the artifact store can't be given a prefix of its own
+CODEPIPELINE_FOLDER_LENGTH = 20
+HASH_LENGTH = 8
+# stack names (and stack ids) can only have letters, numbers and dashes
+STACK_SAFE_BRANCH = re.compile(r"^[A-Za-z0-9][A-Za-z0-9-]*$")
+BRANCH_HASH_LENGTH = 6
+
+
+def short_hash(value: str, length: int = HASH_LENGTH) -> str:
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()[:length]
+
+
+def safe_branch_name(branch: str) -> str:
+    """The branch as it goes into stack and pipeline names, eg feature/x becomes feature-x-<hash>.
+
+    Names that are already safe are left as they are. The hash of the real name keeps
+    feature/x and feature_x apart, and a safe name maps to itself, so a name taken from a
+    stack can be passed back in.
+    """
+    if STACK_SAFE_BRANCH.match(branch):
+        return branch
+    safe = re.sub(r"[^A-Za-z0-9-]+", "-", branch).strip("-")
+    return (safe + "-" if safe else "") + short_hash(branch, BRANCH_HASH_LENGTH)
+
+
+def pipeline_name(repo_name: str, branch: str) -> str:
+    return PIPELINE_PREFIX + repo_name + "-" + safe_branch_name(branch)
+
+
+def pooled_codepipeline_name(name: str) -> str:
+    """The CodePipeline name for a pooled pipeline, pipeline-<hash>-<repo>-<branch>.
+
+    Pooled pipelines share a bucket, and `pipeline-` already takes 9 of the 20 characters
+    CodePipeline names its folder with, so most branches of a repo would share a folder.
+    The hash of the whole name goes inside those 20 characters, so every pipeline gets a
+    folder of its own. Everything else (prefixes, tags, parameters) keeps using `name`.
+    """
+    return PIPELINE_PREFIX + short_hash(name) + "-" + name[len(PIPELINE_PREFIX) :]
+
+
+def unpooled_pipeline_name(codepipeline_name: str) -> str:
+    """The name a pooled CodePipeline name was made from, or the name itself if it isn't one."""
+    rest = codepipeline_name[len(PIPELINE_PREFIX) :]
+    digest, separator, name = rest.partition("-")
+    if (
+        codepipeline_name.startswith(PIPELINE_PREFIX)
+        and separator
+        and digest == short_hash(PIPELINE_PREFIX + name)
+    ):
+        return PIPELINE_PREFIX + name
+    return codepipeline_name
+
+
+def artifact_folder(codepipeline_name: str) -> str:
+    return codepipeline_name[:CODEPIPELINE_FOLDER_LENGTH]
+
+
+def shared_artifact_bucket_name(
+    devops_account_id: str, target_account_id: str, region: str
+) -> str:
+    # deterministic, so pipelines and cross-account roles can refer to it without an export
+    return (
+        "cicd-artifacts-" + devops_account_id + "-" + target_account_id + "-" + region
+    )
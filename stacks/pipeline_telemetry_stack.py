@@ -0,0 +1,159 @@
+import os
+
+from aws_cdk import (
+    core as cdk,
+    aws_cloudwatch as cloudwatch,
+    aws_dynamodb as dynamodb,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_lambda as lambda_,
+    aws_logs as logs,
+)
+
+# shared with anything else that publishes pipeline performance metrics
+METRIC_NAMESPACE = "CodePipeline/Telemetry"
+
+# all the pipelines created by this project are named pipeline-<repo>-<branch>
+PIPELINE_PREFIX = "pipeline-"
+
+
+class PipelineTelemetryStack(cdk.Stack):
+    def __init__(self, scope: cdk.Construct, id: str, **kwargs) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        # start times of executions, stages and actions until their terminal event arrives
+        state_table = dynamodb.Table(
+            self,
+            "TelemetryState",
+            partition_key=dynamodb.Attribute(
+                name="key", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        telemetry_function = lambda_.Function(
+            self,
+            "TelemetryFunction",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            handler="index.handler",
+            code=lambda_.Code.from_asset(
+                os.path.join(
+                    os.path.dirname(__file__), "..", "lambdas", "pipeline_telemetry"
+                )
+            ),
+            timeout=cdk.Duration.seconds(30),
+            environment={
+                "STATE_TABLE": state_table.table_name,
+                "METRIC_NAMESPACE": METRIC_NAMESPACE,
+                "PIPELINE_PREFIX": PIPELINE_PREFIX,
+            },
+            log_retention=logs.RetentionDays.ONE_MONTH,
+        )
+        state_table.grant_read_write_data(telemetry_function)
+
+        events.Rule(
+            self,
+            "PipelineStateChanges",
+            description="Pipeline, stage and action state changes for telemetry",
+            event_pattern=events.EventPattern(
+                source=["aws.codepipeline"],
+                detail_type=[
+                    "CodePipeline Pipeline Execution State Change",
+                    "CodePipeline Stage Execution State Change",
+                    "CodePipeline Action Execution State Change",
+                ],
+                detail={"pipeline": [{"prefix": PIPELINE_PREFIX}]},
+            ),
+            targets=[targets.LambdaFunction(telemetry_function)],
+        )
+
+        dashboard_name = "pipeline-telemetry-" + self.region
+        dashboard = cloudwatch.Dashboard(
+            self,
+            "TelemetryDashboard",
+            dashboard_name=dashboard_name,
+        )
+
+        def search(dimensions, metric_name, statistic, label):
+            return cloudwatch.MathExpression(
+                expression="SEARCH('{%s,%s} MetricName=\"%s\"', '%s', 300)"
+                % (METRIC_NAMESPACE, ",".join(dimensions), metric_name, statistic),
+                using_metrics={},
+                label=label,
+                period=cdk.Duration.minutes(5),
+            )
+
+        dashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Execution duration (p95, seconds)",
+                left=[
+                    search(["Pipeline"], "ExecutionDuration", "p95", "Execution p95")
+                ],
+                width=12,
+            ),
+            cloudwatch.GraphWidget(
+                title="Failed executions",
+                left=[search(["Pipeline"], "ExecutionFailed", "Sum", "Failures")],
+                width=12,
+            ),
+        )
+        dashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Stage duration (p95, seconds)",
+                left=[
+                    search(["Pipeline", "Stage"], "StageDuration", "p95", "Stage p95")
+                ],
+                width=12,
+            ),
+            cloudwatch.GraphWidget(
+                title="Stage queue time (p95, seconds)",
+                left=[
+                    search(["Pipeline", "Stage"], "StageQueueTime", "p95", "Queued p95")
+                ],
+                width=12,
+            ),
+        )
+        dashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Action duration (p95, seconds)",
+                left=[
+                    search(
+                        ["Pipeline", "Stage", "Action"],
+                        "ActionDuration",
+                        "p95",
+                        "Action p95",
+                    )
+                ],
+                width=12,
+            ),
+            cloudwatch.GraphWidget(
+                title="Approval wait (max, seconds)",
+                left=[search(["Pipeline"], "ApprovalWait", "Maximum", "Approval")],
+                width=12,
+            ),
+        )
+
+        # published by builds in pipelines created with -c build_metrics=true
+        dashboard.add_widgets(
+            cloudwatch.GraphWidget(
+                title="Build phase duration (p95, seconds)",
+                left=[
+                    search(["Project", "Phase"], "PhaseDuration", "p95", "Phase p95")
+                ],
+                width=12,
+            ),
+            cloudwatch.GraphWidget(
+                title="Build cache misses",
+                left=[search(["Project"], "CacheMiss", "Sum", "Misses")],
+                right=[search(["Project"], "CacheHit", "Sum", "Hits")],
+                width=12,
+            ),
+        )
+
+        cdk.CfnOutput(
+            self,
+            "TelemetryDashboardName",
+            value=dashboard_name,
+        )
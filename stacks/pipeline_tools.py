@@ -0,0 +1,83 @@
+import os
+
+from aws_cdk import (
+    core as cdk,
+    aws_codebuild as codebuild,
+    aws_codecommit as codecommit,
+    aws_iam as iam,
+    aws_s3_assets as s3_assets,
+)
+
+from stacks.buildspec_generator import PIPELINE_TOOLS_DIR
+
+# the tools/ directory of this project, shipped to CodeBuild so builds can run the same helpers we run locally
+PIPELINE_TOOLS_PATH = os.path.join(os.path.dirname(__file__), "..", "tools")
+
+# the tools are unpacked in the build container at PIPELINE_TOOLS_DIR, run them as
+# `python3 -m tools.<module>` from there
+PIPELINE_TOOLS_INSTALL_COMMANDS = [
+    "aws s3 cp $PIPELINE_TOOLS_URL /tmp/pipeline-tools.zip --quiet",
+    "mkdir -p " + PIPELINE_TOOLS_DIR + "/tools",
+    "unzip -q -o /tmp/pipeline-tools.zip -d " + PIPELINE_TOOLS_DIR + "/tools",
+]
+
+# exports the pipeline's parameters (everything under $PARAMETER_PATH) into the build's environment
+PARAMETER_LOADER_COMMANDS = [
+    'python3 -c "import boto3" 2>/dev/null || pip3 install --quiet boto3',
+    'eval "$(cd '
+    + PIPELINE_TOOLS_DIR
+    + ' && python3 -m tools.parameter_loader --format shell)"',
+]
+
+# narrows a full clone's working tree down to $SOURCE_SPARSE_PATHS (space separated), when it's set
+SPARSE_CHECKOUT_COMMANDS = [
+    'if [ -n "$SOURCE_SPARSE_PATHS" ]; then git sparse-checkout init --cone'
+    + " && git sparse-checkout set $SOURCE_SPARSE_PATHS; fi",
+]
+
+
+def pipeline_tools_asset(scope: cdk.Construct) -> s3_assets.Asset:
+    # reuse the asset if something in this stack has already created it
+    existing = scope.node.try_find_child("PipelineTools")
+    if existing:
+        return existing
+
+    return s3_assets.Asset(
+        scope,
+        "PipelineTools",
+        path=PIPELINE_TOOLS_PATH,
+        exclude=["__pycache__", "*.pyc"],
+    )
+
+
+def grant_parameter_loading(project: codebuild.IProject, pipeline_name: str) -> None:
+    # get-by-path is authorised against the path itself, the values against the parameters under it
+    stack = cdk.Stack.of(project)
+    parameter_path_arn = (
+        "arn:aws:ssm:"
+        + stack.region
+        + ":"
+        + stack.account
+        + ":parameter/"
+        + pipeline_name
+    )
+    project.add_to_role_policy(
+        iam.PolicyStatement(
+            actions=["ssm:GetParametersByPath", "ssm:GetParameter"],
+            effect=iam.Effect.ALLOW,
+            resources=[parameter_path_arn, parameter_path_arn + "/*"],
+        )
+    )
+
+
+def grant_full_clone(
+    project: codebuild.IProject, repository: codecommit.IRepository
+) -> None:
+    # with a full clone source the build clones the repo itself, rather than downloading a zip
+    project.add_to_role_policy(
+        iam.PolicyStatement(
+            actions=["codecommit:GitPull"],
+            effect=iam.Effect.ALLOW,
+            resources=[repository.repository_arn],
+        )
+    )
@@ -0,0 +1,299 @@
+"""Compacts IAM policy statements so one role can cover many buckets, keys and stacks.
+
+Roles built up from lots of separate statements run into the IAM size limits
+long before they run out of things to allow: 10,240 characters for all of a
+role's inline policies, and 6,144 for each managed policy. compact_statements:
+
+- drops actions and resources already covered by a wildcard in the same statement
+- merges statements with the same effect and conditions that allow the same
+  resources (or the same actions)
+- within bounds, collapses lists of resources to a wildcard on their common prefix,
+  and read-only actions (Describe*, Get*, List*) to a wildcard on their verb. The
+  prefix has to keep part of the resources' names, not just their type (eg key/ or
+  stack/), and KMS keys are never collapsed, as their ids are random
+
+and plan_policies packs what's left into an inline policy, spilling into
+managed policies when it won't fit.
+
+The statement functions work on plain policy JSON, so they only need the
+standard library. compacted_policies does the same for CDK PolicyStatements.
+"""
+
+import fnmatch
+import json
+import re
+
+# IAM doesn't count whitespace towards these
+INLINE_POLICY_LIMIT = 10240
+MANAGED_POLICY_LIMIT = 6144
+MAX_MANAGED_POLICIES = 10
+# leave room for the role's own policies that CDK adds later, eg grants
+POLICY_HEADROOM = 512
+
+# resources are only collapsed to a wildcard when a statement has more than this many
+DEFAULT_MAX_RESOURCES = 10
+# and the wildcard still names at least this much of the resource, eg myapp-* but not m*
+DEFAULT_MIN_WILDCARD_PREFIX = 4
+# collapsing actions to a wildcard only ever adds other read-only actions
+READ_ONLY_VERBS = ("Describe", "Get", "List")
+MIN_ACTIONS_TO_COLLAPSE = 3
+# the resource type an ARN's resource starts with, eg key/, stack/, role/ or function:
+RESOURCE_TYPE = re.compile(r"^[A-Za-z0-9-]+[/:]")
+# S3 ARNs are only a bucket and key, without a type
+UNTYPED_SERVICES = ("s3",)
+# (service, resource type) pairs whose names are random, so any wildcard on them is all of them
+NEVER_COLLAPSE = (("kms", "key/"),)
+# statements using these are passed through untouched
+UNMERGEABLE_KEYS = ("Principal", "NotPrincipal", "NotAction", "NotResource")
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _is_wildcard(value):
+    return "*" in value or "?" in value
+
+
+def _covered(value, wildcards, case_sensitive=True):
+    for wildcard in wildcards:
+        if wildcard == value:
+            continue
+        if case_sensitive:
+            if fnmatch.fnmatchcase(value, wildcard):
+                return True
+        elif fnmatch.fnmatchcase(value.lower(), wildcard.lower()):
+            return True
+    return False
+
+
+def _dedupe(values, case_sensitive=True):
+    seen = {}
+    for value in values:
+        seen.setdefault(value if case_sensitive else value.lower(), value)
+    values = list(seen.values())
+    wildcards = [v for v in values if _is_wildcard(v)]
+    return sorted(
+        v for v in values if not _covered(v, wildcards, case_sensitive=case_sensitive)
+    )
+
+
+def _condition_key(statement):
+    return json.dumps(statement.get("Condition"), sort_keys=True)
+
+
+def _arn_head(resource):
+    # everything up to the resource itself, eg arn:aws:s3::: or arn:aws:kms:region:account:
+    parts = resource.split(":", 5)
+    if len(parts) < 6:
+        return ""
+    return ":".join(parts[:5]) + ":"
+
+
+def _resource_type(head, resource):
+    if not head or head.split(":")[2] in UNTYPED_SERVICES:
+        return ""
+    match = RESOURCE_TYPE.match(resource[len(head) :])
+    return match.group(0) if match else ""
+
+
+def _common_prefix(values):
+    prefix = values[0]
+    for value in values[1:]:
+        while not value.startswith(prefix):
+            prefix = prefix[:-1]
+    return prefix
+
+
+def _common_suffix(values):
+    return _common_prefix([v[::-1] for v in values])[::-1]
+
+
+def collapse_resources(resources, max_resources, min_wildcard_prefix):
+    """Replace more than `max_resources` resources of the same kind with one wildcard, as
+    long as the wildcard keeps at least `min_wildcard_prefix` characters of their names
+    (after the resource type, eg the key/ of a KMS key). A `max_resources` of None never
+    collapses them.
+    """
+    if max_resources == None or len(resources) <= max_resources:
+        return resources
+
+    by_type = {}
+    for resource in resources:
+        head = _arn_head(resource)
+        by_type.setdefault((head, _resource_type(head, resource)), []).append(resource)
+
+    collapsed = []
+    for (head, resource_type), group in by_type.items():
+        service = head.split(":")[2] if head else ""
+        if not head or len(group) < 2 or (service, resource_type) in NEVER_COLLAPSE:
+            collapsed += group
+            continue
+        head += resource_type
+        names = [r[len(head) :] for r in group]
+        prefix = _common_prefix(names)
+        suffix = _common_suffix([n[len(prefix) :] for n in names])
+        # a wildcard can't be put in the middle of a bucket and its objects, eg a*/* covers a/b*
+        if len(prefix) < min_wildcard_prefix or "*" in prefix:
+            collapsed += group
+            continue
+        collapsed.append(head + prefix + "*" + suffix)
+    return _dedupe(collapsed)
+
+
+def collapse_actions(actions):
+    by_verb = {}
+    for action in actions:
+        service, _, name = action.partition(":")
+        verb = next((v for v in READ_ONLY_VERBS if name.startswith(v)), None)
+        if verb and not _is_wildcard(name):
+            by_verb.setdefault(service + ":" + verb + "*", []).append(action)
+
+    actions = set(actions)
+    for wildcard, group in by_verb.items():
+        if len(group) >= MIN_ACTIONS_TO_COLLAPSE:
+            actions -= set(group)
+            actions.add(wildcard)
+    return _dedupe(actions, case_sensitive=False)
+
+
+def _normalize(statement):
+    return {
+        "Effect": statement.get("Effect", "Allow"),
+        "Action": _dedupe(_as_list(statement.get("Action")), case_sensitive=False),
+        "Resource": _dedupe(_as_list(statement.get("Resource"))),
+        "Condition": statement.get("Condition"),
+    }
+
+
+def _merge_pass(statements, same, merge):
+    merged = []
+    for statement in statements:
+        for existing in merged:
+            if (
+                existing["Effect"] == statement["Effect"]
+                and _condition_key(existing) == _condition_key(statement)
+                and existing[same] == statement[same]
+            ):
+                existing[merge] = sorted(set(existing[merge]) | set(statement[merge]))
+                break
+        else:
+            merged.append(statement)
+    return merged
+
+
+def compact_statements(
+    statements,
+    max_resources=DEFAULT_MAX_RESOURCES,
+    min_wildcard_prefix=DEFAULT_MIN_WILDCARD_PREFIX,
+    collapse=True,
+):
+    """Compact a list of policy statements (as JSON dicts), returning new statements
+    that allow the same things (or, when collapsing, a bounded superset of them)."""
+    passthrough = [s for s in statements if any(k in s for k in UNMERGEABLE_KEYS)]
+    working = [_normalize(s) for s in statements if s not in passthrough]
+
+    while True:
+        before = json.dumps(working, sort_keys=True)
+        working = _merge_pass(working, "Resource", "Action")
+        working = _merge_pass(working, "Action", "Resource")
+        for statement in working:
+            if collapse:
+                statement["Action"] = collapse_actions(statement["Action"])
+                statement["Resource"] = collapse_resources(
+                    statement["Resource"], max_resources, min_wildcard_prefix
+                )
+            statement["Action"] = _dedupe(statement["Action"], case_sensitive=False)
+            statement["Resource"] = _dedupe(statement["Resource"])
+        if json.dumps(working, sort_keys=True) == before:
+            break
+
+    compacted = []
+    for statement in working:
+        output = {"Effect": statement["Effect"]}
+        for key in ("Action", "Resource"):
+            values = statement[key]
+            output[key] = values[0] if len(values) == 1 else values
+        if statement["Condition"]:
+            output["Condition"] = statement["Condition"]
+        compacted.append(output)
+    return compacted + passthrough
+
+
+def policy_size(statements):
+    return len(
+        json.dumps(
+            {"Version": "2012-10-17", "Statement": statements}, separators=(",", ":")
+        )
+    )
+
+
+def plan_policies(
+    statements,
+    inline_limit=INLINE_POLICY_LIMIT - POLICY_HEADROOM,
+    managed_limit=MANAGED_POLICY_LIMIT,
+    max_managed=MAX_MANAGED_POLICIES,
+):
+    """Split statements into one inline policy and as few managed policies as possible,
+    returning (inline statements, [managed policy statements, ...])."""
+    inline = []
+    managed = []
+    # biggest first packs tighter
+    for statement in sorted(statements, key=lambda s: -policy_size([s])):
+        if policy_size(inline + [statement]) <= inline_limit:
+            inline.append(statement)
+            continue
+        for policy in managed:
+            if policy_size(policy + [statement]) <= managed_limit:
+                policy.append(statement)
+                break
+        else:
+            if policy_size([statement]) > managed_limit:
+                raise ValueError(
+                    "A policy statement is too big for a managed policy even on its own ("
+                    + str(policy_size([statement]))
+                    + " characters)"
+                )
+            managed.append([statement])
+
+    if len(managed) > max_managed:
+        raise ValueError(
+            "The role's permissions need %d managed policies, more than the %d a role can have"
+            % (len(managed), max_managed)
+        )
+    return inline, managed
+
+
+def compacted_policies(
+    scope,
+    id,
+    statements,
+    max_resources=DEFAULT_MAX_RESOURCES,
+    min_wildcard_prefix=DEFAULT_MIN_WILDCARD_PREFIX,
+):
+    """Compact CDK PolicyStatements, returning the inline policies and managed policies
+    to give a role, eg iam.Role(..., inline_policies=inline, managed_policies=managed).
+    """
+    from aws_cdk import aws_iam as iam
+
+    inline, managed = plan_policies(
+        compact_statements(
+            [statement.to_statement_json() for statement in statements],
+            max_resources=max_resources,
+            min_wildcard_prefix=min_wildcard_prefix,
+        )
+    )
+
+    def document(policy_statements):
+        return iam.PolicyDocument(
+            statements=[iam.PolicyStatement.from_json(s) for s in policy_statements]
+        )
+
+    inline_policies = {id + "Policy": document(inline)} if inline else {}
+    managed_policies = [
+        iam.ManagedPolicy(scope, id + "Policy" + str(index + 1), document=document(p))
+        for index, p in enumerate(managed)
+    ]
+    return inline_policies, managed_policies
@@ -1,5 +1,9 @@
+import json
+import os
+
 from aws_cdk import (
     core,
+    aws_apigateway as apigateway,
     aws_codebuild as codebuild,
     aws_codecommit as codecommit,
     aws_codepipeline as codepipeline,
@@ -7,12 +11,21 @@ from aws_cdk import (
     aws_lambda as lambda_,
     aws_s3 as s3,
     aws_iam as iam,
+    aws_logs as logs,
+    aws_secretsmanager as secretsmanager,
 )
 
 
 class RepoStack(core.Stack):
     def __init__(
-        self, scope: core.Construct, id: str, repo_name: str, **kwargs
+        self,
+        scope: core.Construct,
+        id: str,
+        repo_name: str,
+        gitlab_webhook: bool = False,
+        gitlab_repo_url: str = None,
+        git_layer_arn: str = None,
+        **kwargs
     ) -> None:
         super().__init__(scope, id, **kwargs)
 
@@ -59,3 +72,111 @@ class RepoStack(core.Stack):
             value=code_repo.repository_clone_url_http,
         )
         core.CfnOutput(self, "IamUserForGitlab", value=gitlab_user.user_name)
+
+        if gitlab_webhook:
+            self.create_gitlab_webhook(code_repo, gitlab_repo_url, git_layer_arn)
+
+    # a webhook GitLab calls on every push, which syncs the branch into CodeCommit straight
+    # away rather than waiting for the next mirror update
+    def create_gitlab_webhook(
+        self,
+        code_repo: codecommit.IRepository,
+        gitlab_repo_url: str,
+        git_layer_arn: str,
+    ):
+        if gitlab_repo_url == None:
+            raise ValueError(
+                "The GitLab repo's https clone URL needs to be provided as `-c gitlab_repo_url=<url>`"
+            )
+        if git_layer_arn == None:
+            raise ValueError(
+                "The Lambda runtime doesn't include git, provide a layer that does as `-c git_layer_arn=<layer version arn>`"
+            )
+
+        # the webhook token is generated, the GitLab token (read_repository) is filled in by hand
+        webhook_secret = secretsmanager.Secret(
+            self,
+            "GitlabWebhookSecret",
+            description="GitLab webhook token and repo read token for "
+            + code_repo.repository_name,
+            generate_secret_string=secretsmanager.SecretStringGenerator(
+                secret_string_template=json.dumps({"gitlab_token": ""}),
+                generate_string_key="webhook_token",
+                exclude_punctuation=True,
+                password_length=32,
+            ),
+        )
+
+        sync_function = lambda_.Function(
+            self,
+            "GitlabSyncFunction",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            handler="index.sync_handler",
+            code=lambda_.Code.from_asset(
+                os.path.join(
+                    os.path.dirname(__file__), "..", "lambdas", "gitlab_mirror"
+                )
+            ),
+            layers=[
+                lambda_.LayerVersion.from_layer_version_arn(
+                    self, "GitLayer", git_layer_arn
+                )
+            ],
+            # the first fetch of a big repo takes a while, later ones reuse what's in /tmp
+            timeout=core.Duration.minutes(5),
+            memory_size=1024,
+            environment={
+                "REPO_NAME": code_repo.repository_name,
+                "GITLAB_REPO_URL": gitlab_repo_url,
+                "SECRET_ARN": webhook_secret.secret_arn,
+            },
+            # a failed sync is tried again twice, then left to the mirror
+            retry_attempts=2,
+            log_retention=logs.RetentionDays.ONE_MONTH,
+        )
+        webhook_secret.grant_read(sync_function)
+        sync_function.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=["codecommit:GitPull", "codecommit:GitPush"],
+                effect=iam.Effect.ALLOW,
+                resources=[code_repo.repository_arn],
+            )
+        )
+
+        # GitLab gives up on a webhook after 10 seconds (and API Gateway after 29), so the webhook
+        # only checks the push and hands it to the sync function asynchronously
+        webhook_function = lambda_.Function(
+            self,
+            "GitlabWebhookFunction",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            handler="index.handler",
+            code=lambda_.Code.from_asset(
+                os.path.join(
+                    os.path.dirname(__file__), "..", "lambdas", "gitlab_mirror"
+                )
+            ),
+            timeout=core.Duration.seconds(10),
+            environment={
+                "SECRET_ARN": webhook_secret.secret_arn,
+                "SYNC_FUNCTION_NAME": sync_function.function_name,
+            },
+            log_retention=logs.RetentionDays.ONE_MONTH,
+        )
+        webhook_secret.grant_read(webhook_function)
+        sync_function.grant_invoke(webhook_function)
+
+        webhook_api = apigateway.LambdaRestApi(
+            self,
+            "GitlabWebhookApi",
+            rest_api_name=code_repo.repository_name + "-gitlab-webhook",
+            handler=webhook_function,
+            proxy=False,
+        )
+        webhook_api.root.add_resource("push").add_method("POST")
+
+        core.CfnOutput(
+            self, "GitlabWebhookUrl", value=webhook_api.url_for_path("/push")
+        )
+        core.CfnOutput(
+            self, "GitlabWebhookSecretName", value=webhook_secret.secret_name
+        )
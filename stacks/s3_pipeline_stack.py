@@ -7,8 +7,34 @@ from aws_cdk import (
     aws_s3 as s3,
     aws_iam as iam,
     aws_kms as kms,
+    aws_logs as logs,
 )
 
+from stacks.artifact_lifecycle import (
+    BUILD_CACHE_PREFIX,
+    PACKAGES_PREFIX,
+    RELEASES_PREFIX,
+    artifact_lifecycle_rules,
+)
+from stacks.build_instrumentation import BuildInstrumentation
+from stacks.buildspec_generator import generate_buildspec
+from stacks.deployment_bake import DEFAULT_BAKE_MINUTES, DeploymentBake
+from stacks.pipeline_execution import DeployLock, configure_execution_mode
+from stacks.pipeline_names import (
+    PIPELINE_PREFIX,
+    pooled_codepipeline_name,
+    safe_branch_name,
+)
+from stacks.pipeline_tools import (
+    PARAMETER_LOADER_COMMANDS,
+    PIPELINE_TOOLS_INSTALL_COMMANDS,
+    SPARSE_CHECKOUT_COMMANDS,
+    grant_full_clone,
+    grant_parameter_loading,
+    pipeline_tools_asset,
+)
+from stacks.shared_pipeline_infra_stack import use_shared_artifact_store
+
 
 class S3PipelineStack(cdk.Stack):
     def __init__(
@@ -23,6 +49,20 @@ class S3PipelineStack(cdk.Stack):
         cross_account_role_arn: str,
         github_oauth_token: str,
         repo_owner: str,
+        execution_mode: str = None,
+        deploy_lock: bool = None,
+        alarm_names: str = None,
+        bake_minutes: int = None,
+        build_metrics: bool = False,
+        buildspec_model: str = None,
+        pooled: bool = False,
+        artifact_retention_days: int = None,
+        package_retention_days: int = None,
+        releases_to_keep: int = None,
+        load_parameters: bool = False,
+        full_clone: bool = False,
+        sparse_paths: str = None,
+        target_prefix: str = None,
         **kwargs
     ) -> None:
         super().__init__(scope, id, **kwargs)
@@ -47,36 +87,86 @@ class S3PipelineStack(cdk.Stack):
                 "The cross account role this pipeline will assume must be provided as `-c cross_account_role_arn=<cross_account_role_arn>`"
             )
 
+        if buildspec_model not in (None, "s3"):
+            raise ValueError(
+                "The S3 pipeline can only generate an `s3` buildspec, provided as `-c buildspec_model=s3`"
+            )
+
         deploy_bucket = s3.Bucket.from_bucket_name(
             self, "BucketByAtt", bucket_name=target_bucket
         )
 
-        # get the key ARN from the create-pipeline-infra stack
-        pipeline_key = kms.Key.from_key_arn(
-            self,
-            "DeployKey",
-            key_arn=cdk.Fn.import_value(
-                self.stack_name.replace("s3-create-pipeline", "create-pipeline-infra")
-                + ":PipelineKeyArn"
-            ),
-        )
-        # Create the artifacts bucket we'll use
-        artifacts_bucket = s3.Bucket(
-            self,
-            "PipelineArtifactsBucket",
-            bucket_key_enabled=True,
-            encryption_key=pipeline_key,
-            encryption=s3.BucketEncryption.KMS,
+        if full_clone and github_oauth_token and repo_owner:
+            raise ValueError(
+                "A full clone source needs a CodeCommit repo, GitHub sources can only be passed to the build as a zip"
+            )
+
+        if sparse_paths and not full_clone:
+            raise ValueError(
+                "Sparse paths can only be checked out of a full clone, add `-c full_clone=true`"
+            )
+
+        pipeline_name = (
+            PIPELINE_PREFIX + repo_name + "-" + safe_branch_name(repo_branch)
         )
+        # what CodePipeline calls it, which is only different for pooled pipelines
+        codepipeline_name = pipeline_name
+
+        # where this pipeline keeps its packages, build cache and releases in the artifacts bucket
+        package_prefix = PACKAGES_PREFIX.rstrip("/")
+        build_cache_prefix = BUILD_CACHE_PREFIX.rstrip("/")
+        # the bake's promoted releases, which are pruned rather than expired
+        release_prefix = RELEASES_PREFIX + pipeline_name + "/"
+
+        if pooled:
+            # use the key and bucket shared by all pipelines deploying to the target account
+            codepipeline_name = pooled_codepipeline_name(pipeline_name)
+            pipeline_key, artifacts_bucket = use_shared_artifact_store(
+                self,
+                pipeline_name,
+                codepipeline_name,
+                cross_account_role_arn.split(":")[4],
+            )
+            # a prefix of their own in each part of the shared bucket, so lifecycle rules still apply
+            package_prefix = PACKAGES_PREFIX + pipeline_name
+            build_cache_prefix = BUILD_CACHE_PREFIX + pipeline_name
+        else:
+            # get the key ARN from the create-pipeline-infra stack
+            pipeline_key = kms.Key.from_key_arn(
+                self,
+                "DeployKey",
+                key_arn=cdk.Fn.import_value(
+                    self.stack_name.replace(
+                        "s3-create-pipeline", "create-pipeline-infra"
+                    )
+                    + ":PipelineKeyArn"
+                ),
+            )
+            # Create the artifacts bucket we'll use
+            artifacts_bucket = s3.Bucket(
+                self,
+                "PipelineArtifactsBucket",
+                bucket_key_enabled=True,
+                encryption_key=pipeline_key,
+                encryption=s3.BucketEncryption.KMS,
+                lifecycle_rules=artifact_lifecycle_rules(
+                    artifact_retention_days, package_retention_days
+                ),
+            )
 
         # create the pipeline and tell it to use the artifacts bucket
         pipeline = codepipeline.Pipeline(
             self,
-            "Pipeline-" + repo_name + "-" + repo_branch,
+            "Pipeline-" + repo_name + "-" + safe_branch_name(repo_branch),
             artifact_bucket=artifacts_bucket,
-            pipeline_name="pipeline-" + repo_name + "-" + repo_branch,
+            pipeline_name=codepipeline_name,
             cross_account_keys=True,
         )
+        configure_execution_mode(pipeline, execution_mode)
+
+        # parallel executions would otherwise race each other into the target bucket
+        if deploy_lock == None:
+            deploy_lock = execution_mode == "PARALLEL"
 
         # create the source stage, which grabs the code from the repo and outputs it as an artifact
         source_output = codepipeline.Artifact()
@@ -97,33 +187,85 @@ class S3PipelineStack(cdk.Stack):
                 ],
             )
         else:
+            code_repo = codecommit.Repository.from_repository_name(
+                self, "Repo", repo_name
+            )
             pipeline.add_stage(
                 stage_name="Source",
                 actions=[
                     codepipeline_actions.CodeCommitSourceAction(
                         action_name="GetSource",
-                        repository=codecommit.Repository.from_repository_name(
-                            self, "Repo", repo_name
-                        ),
+                        repository=code_repo,
                         output=source_output,
                         branch=repo_branch,
+                        # pass the build a reference to the commit instead of zipping the repo
+                        code_build_clone_output=full_clone,
                     )
                 ],
             )
 
+        build_environment = {
+            "PACKAGE_BUCKET": codebuild.BuildEnvironmentVariable(
+                value=artifacts_bucket.bucket_name
+            ),
+            "PACKAGE_PREFIX": codebuild.BuildEnvironmentVariable(value=package_prefix),
+            "ENVIRONMENT": codebuild.BuildEnvironmentVariable(value=build_env),
+        }
+
+        # optionally have the build load this pipeline's parameters in one go, generated
+        # buildspecs do it before anything else, your own buildspec.yml can run the same commands
+        build_prelude = []
+        if load_parameters:
+            tools_asset = pipeline_tools_asset(self)
+            build_environment["PIPELINE_TOOLS_URL"] = (
+                codebuild.BuildEnvironmentVariable(value=tools_asset.s3_object_url)
+            )
+            build_environment["PARAMETER_PATH"] = codebuild.BuildEnvironmentVariable(
+                value="/" + pipeline_name
+            )
+            build_prelude = PIPELINE_TOOLS_INSTALL_COMMANDS + PARAMETER_LOADER_COMMANDS
+
+        # big repos can be cloned by the build, and optionally narrowed to the paths it needs
+        if full_clone:
+            if sparse_paths:
+                build_environment["SOURCE_SPARSE_PATHS"] = (
+                    codebuild.BuildEnvironmentVariable(
+                        value=" ".join(path.strip() for path in sparse_paths.split(","))
+                    )
+                )
+            build_prelude = SPARSE_CHECKOUT_COMMANDS + build_prelude
+
+        # use the repo's own buildspec.yml, unless we've been asked to generate a tuned one,
+        # in which case its caches are kept in the artifacts bucket between builds
+        build_spec = codebuild.BuildSpec.from_source_filename("buildspec.yml")
+        build_cache = None
+        if buildspec_model:
+            build_spec = codebuild.BuildSpec.from_object(
+                generate_buildspec(buildspec_model, prelude=build_prelude)
+            )
+            build_cache = codebuild.Cache.bucket(
+                artifacts_bucket, prefix=build_cache_prefix
+            )
+
         # create the build stage which takes the source artifact and outputs the built artifact
         build_output = codepipeline.Artifact()
+        build_log_group = logs.LogGroup(
+            self,
+            "PipelineLogs",
+        )
         build_project = codebuild.PipelineProject(
             self,
             "Build",
-            build_spec=codebuild.BuildSpec.from_source_filename("buildspec.yml"),
+            build_spec=build_spec,
+            cache=build_cache,
+            logging=codebuild.LoggingOptions(
+                cloud_watch=codebuild.CloudWatchLoggingOptions(
+                    enabled=True,
+                    log_group=build_log_group,
+                )
+            ),
             environment={"build_image": codebuild.LinuxBuildImage.AMAZON_LINUX_2_3},
-            environment_variables={
-                "PACKAGE_BUCKET": codebuild.BuildEnvironmentVariable(
-                    value=artifacts_bucket.bucket_name
-                ),
-                "ENVIRONMENT": codebuild.BuildEnvironmentVariable(value=build_env),
-            },
+            environment_variables=build_environment,
         )
         # add permission to get parameter store values
         ssm_access = iam.PolicyStatement(
@@ -131,6 +273,21 @@ class S3PipelineStack(cdk.Stack):
         )
         build_project.add_to_role_policy(ssm_access)
 
+        if load_parameters:
+            tools_asset.grant_read(build_project)
+            grant_parameter_loading(build_project, pipeline_name)
+        if full_clone:
+            grant_full_clone(build_project, code_repo)
+
+        # optionally turn the build into phase timing and cache metrics
+        if build_metrics:
+            BuildInstrumentation(
+                self,
+                "BuildInstrumentation",
+                project=build_project,
+                log_group=build_log_group,
+            )
+
         pipeline.add_stage(
             stage_name="Build",
             actions=[
@@ -163,16 +320,63 @@ class S3PipelineStack(cdk.Stack):
             role_arn=cross_account_role_arn,
         )
 
+        deploy_actions = [
+            codepipeline_actions.S3DeployAction(
+                bucket=deploy_bucket,
+                # deploy under a prefix rather than the root, eg for branch previews
+                object_key=target_prefix,
+                input=build_output,
+                action_name="S3Deploy",
+                role=cross_account_role,
+                run_order=2 if deploy_lock else 1,
+            ),
+        ]
+
+        # optionally watch alarms after the deploy, rolling back to the last good release if one fires
+        bake_actions = []
+        if alarm_names:
+            bake = DeploymentBake(
+                self,
+                "DeploymentBake",
+                pipeline_name=pipeline_name,
+                artifacts_bucket=artifacts_bucket,
+                release_prefix=release_prefix,
+                releases_to_keep=releases_to_keep,
+                cross_account_role_arn=cross_account_role_arn,
+                target_bucket=target_bucket,
+                target_prefix=target_prefix,
+            )
+            bake_actions.append(
+                bake.bake_action(
+                    input=build_output,
+                    alarm_names=alarm_names.split(","),
+                    bake_minutes=bake_minutes or DEFAULT_BAKE_MINUTES,
+                )
+            )
+
+        if deploy_lock:
+            # use the literal name, the pipeline's own Ref here would be a circular dependency
+            lock = DeployLock(
+                self,
+                "DeployLock",
+                pipeline_name=codepipeline_name,
+            )
+            deploy_actions.insert(0, lock.acquire_action(run_order=1))
+            # hold the lock through the bake so a rollback can't clash with the next deploy
+            if bake_actions:
+                bake_actions.append(lock.release_action(run_order=2))
+            else:
+                deploy_actions.append(lock.release_action(run_order=3))
+
         pipeline.add_stage(
             stage_name="Deploy",
-            actions=[
-                codepipeline_actions.S3DeployAction(
-                    bucket=deploy_bucket,
-                    input=build_output,
-                    action_name="S3Deploy",
-                    role=cross_account_role,
-                ),
-            ],
+            actions=deploy_actions,
         )
 
+        if bake_actions:
+            pipeline.add_stage(
+                stage_name="Bake",
+                actions=bake_actions,
+            )
+
         cdk.CfnOutput(self, "ArtifactBucketArn", value=artifacts_bucket.bucket_arn)
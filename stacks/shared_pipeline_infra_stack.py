@@ -0,0 +1,211 @@
+from aws_cdk import (
+    core as cdk,
+    aws_s3 as s3,
+    aws_iam as iam,
+    aws_kms as kms,
+    aws_ssm as ssm,
+)
+
+from stacks.artifact_lifecycle import (
+    BUILD_CACHE_PREFIX,
+    CODEPIPELINE_ARTIFACTS_PREFIX,
+    PACKAGES_PREFIX,
+    RELEASES_PREFIX,
+    artifact_lifecycle_rules,
+)
+
+from stacks.pipeline_names import artifact_folder, shared_artifact_bucket_name
+
+# pipelines tag their roles with these so the shared bucket can keep each one to its own prefixes
+PIPELINE_TAG = "pipeline"
+# CodePipeline keeps its artifacts in a folder named after the first 20 characters of the pipeline name
+PIPELINE_ARTIFACTS_TAG = "pipeline-artifacts"
+
+
+def shared_key_parameter_name(target_account_id: str) -> str:
+    return "/cicd/shared-pipeline-key/" + target_account_id
+
+
+def use_shared_artifact_store(
+    scope: cdk.Stack,
+    pipeline_name: str,
+    codepipeline_name: str,
+    target_account_id: str,
+):
+    """Import the pooled key and bucket for a target account, and tag the calling stack's
+    roles so they can only use this pipeline's prefixes in the bucket. `codepipeline_name`
+    is the pipeline's pooled_codepipeline_name(), which gives it a folder of its own."""
+    pipeline_key = kms.Key.from_key_arn(
+        scope,
+        "DeployKey",
+        key_arn=ssm.StringParameter.value_for_string_parameter(
+            scope, shared_key_parameter_name(target_account_id)
+        ),
+    )
+    artifacts_bucket = s3.Bucket.from_bucket_attributes(
+        scope,
+        "PipelineArtifactsBucket",
+        bucket_name=shared_artifact_bucket_name(
+            scope.account, target_account_id, scope.region
+        ),
+        encryption_key=pipeline_key,
+    )
+
+    cdk.Tags.of(scope).add(PIPELINE_TAG, pipeline_name)
+    cdk.Tags.of(scope).add(PIPELINE_ARTIFACTS_TAG, artifact_folder(codepipeline_name))
+
+    return pipeline_key, artifacts_bucket
+
+
+####################################################################################################
+# One of these is created in the devops account for each target account (and region), and shared
+# by every pipeline deploying to that account that is created with `-c pooled=true`
+####################################################################################################
+
+
+class SharedPipelineInfraStack(cdk.Stack):
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        id: str,
+        target_account_id: str,
+        artifact_retention_days: int = None,
+        package_retention_days: int = None,
+        **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        if target_account_id == None:
+            raise ValueError(
+                "The target account ID needs to be provided as `-c target_account_id=<account-id>`"
+            )
+
+        pipeline_key = kms.Key(
+            self,
+            "PipelineKey",
+            description="CICD CMK shared by all pipelines deploying to "
+            + target_account_id,
+            alias="cicd-shared-" + target_account_id,
+            enable_key_rotation=False,
+            trust_account_identities=True,
+        )
+
+        artifacts_bucket = s3.Bucket(
+            self,
+            "SharedArtifactsBucket",
+            bucket_name=shared_artifact_bucket_name(
+                self.account, target_account_id, self.region
+            ),
+            # one KMS request per bucket key rather than per object, so fleet releases don't get throttled
+            bucket_key_enabled=True,
+            encryption_key=pipeline_key,
+            encryption=s3.BucketEncryption.KMS,
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            # every pipeline for the target account keeps its artifacts here
+            removal_policy=cdk.RemovalPolicy.RETAIN,
+            lifecycle_rules=artifact_lifecycle_rules(
+                artifact_retention_days, package_retention_days
+            ),
+        )
+
+        # the target account needs to be able to use the key to decrypt the artifacts,
+        # but only through S3 and only for objects in this bucket
+        pipeline_key.add_to_resource_policy(
+            iam.PolicyStatement(
+                actions=["kms:Decrypt", "kms:DescribeKey"],
+                effect=iam.Effect.ALLOW,
+                resources=["*"],
+                principals=[iam.AccountPrincipal(account_id=target_account_id)],
+                conditions={
+                    "StringEquals": {
+                        "kms:ViaService": "s3." + self.region + ".amazonaws.com"
+                    },
+                    "StringLike": {
+                        "kms:EncryptionContext:aws:s3:arn": artifacts_bucket.bucket_arn
+                        + "*"
+                    },
+                },
+            )
+        )
+
+        # deploys in the target account read the pipelines' build output, the packaged code it
+        # refers to and, when rolling back, promoted releases, and write deploy action output
+        artifacts_bucket.add_to_resource_policy(
+            iam.PolicyStatement(
+                actions=["s3:Get*"],
+                resources=[
+                    artifacts_bucket.arn_for_objects(prefix + "*")
+                    for prefix in (
+                        CODEPIPELINE_ARTIFACTS_PREFIX,
+                        PACKAGES_PREFIX,
+                        RELEASES_PREFIX,
+                    )
+                ],
+                principals=[iam.AccountPrincipal(account_id=target_account_id)],
+            )
+        )
+        artifacts_bucket.add_to_resource_policy(
+            iam.PolicyStatement(
+                actions=["s3:Put*"],
+                resources=[
+                    artifacts_bucket.arn_for_objects(
+                        CODEPIPELINE_ARTIFACTS_PREFIX + "*"
+                    )
+                ],
+                principals=[iam.AccountPrincipal(account_id=target_account_id)],
+            )
+        )
+
+        artifacts_bucket.add_to_resource_policy(
+            iam.PolicyStatement(
+                actions=["s3:List*"],
+                resources=[
+                    artifacts_bucket.bucket_arn,
+                    artifacts_bucket.arn_for_objects("*"),
+                ],
+                principals=[iam.AccountPrincipal(account_id=target_account_id)],
+            )
+        )
+
+        # keep each pipeline's roles (tagged by use_shared_artifact_store) to their own prefixes
+        artifacts_bucket.add_to_resource_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject*", "s3:PutObject*", "s3:DeleteObject*"],
+                effect=iam.Effect.DENY,
+                principals=[iam.AnyPrincipal()],
+                not_resources=[
+                    artifacts_bucket.arn_for_objects(
+                        "${aws:PrincipalTag/" + PIPELINE_ARTIFACTS_TAG + "}/*"
+                    )
+                ]
+                + [
+                    artifacts_bucket.arn_for_objects(
+                        prefix + "${aws:PrincipalTag/" + PIPELINE_TAG + "}/*"
+                    )
+                    for prefix in (PACKAGES_PREFIX, BUILD_CACHE_PREFIX, RELEASES_PREFIX)
+                ],
+                conditions={
+                    "StringEquals": {"aws:PrincipalAccount": self.account},
+                    "Null": {"aws:PrincipalTag/" + PIPELINE_TAG: "false"},
+                },
+            )
+        )
+
+        # pipelines look the key up when they deploy, rather than importing an export from here
+        ssm.StringParameter(
+            self,
+            "PipelineKeyArnParameter",
+            parameter_name=shared_key_parameter_name(target_account_id),
+            string_value=pipeline_key.key_arn,
+        )
+
+        cdk.CfnOutput(
+            self,
+            "PipelineKeyArnOutput",
+            value=pipeline_key.key_arn,
+        )
+        cdk.CfnOutput(
+            self,
+            "ArtifactBucketName",
+            value=artifacts_bucket.bucket_name,
+        )
@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+sys.path.insert(0, ROOT)
+# the lambdas create their clients when they're imported
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-southeast-2")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+
+def load_lambda(name, **environment):
+    """Import lambdas/<name>/index.py as its own module, with its environment set first.
+    The lambdas are all index.py, so they can't be imported by name."""
+    os.environ.update(environment)
+    spec = importlib.util.spec_from_file_location(
+        "lambda_" + name, os.path.join(ROOT, "lambdas", name, "index.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def fixture_path(*parts):
+    return os.path.join(FIXTURES, *parts)
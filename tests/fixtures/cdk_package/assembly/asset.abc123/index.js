@@ -0,0 +1 @@
+exports.handler = async () => "ok";
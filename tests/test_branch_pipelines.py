@@ -0,0 +1,342 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from botocore.stub import Stubber
+
+from conftest import load_lambda
+from stacks.pipeline_names import (
+    artifact_folder,
+    pipeline_name,
+    pooled_codepipeline_name,
+    safe_branch_name,
+)
+
+branch_pipelines = load_lambda(
+    "branch_pipelines",
+    REPO_NAME="myrepo",
+    PROJECT_NAME="deployer",
+    STACK_PREFIX="cf-create-pipeline-",
+    BRANCH_PATTERN="*",
+    IDLE_HOURS="72",
+    CROSS_ACCOUNT_ROLE_ARN="arn:aws:iam::222222222222:role/cross-account",
+    DEPLOYMENT_ROLE_ARN="arn:aws:iam::222222222222:role/deployment",
+)
+
+NOW = datetime(2021, 6, 1, tzinfo=timezone.utc)
+TAGS = [{"Key": "branch-pipeline-factory", "Value": "myrepo"}]
+
+
+def stack(branch, tags=TAGS, age_hours=1, status="CREATE_COMPLETE"):
+    return {
+        "StackName": "cf-create-pipeline-myrepo-" + branch,
+        "StackStatus": status,
+        "CreationTime": NOW - timedelta(hours=age_hours),
+        "Tags": tags,
+    }
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    stubs = {
+        name: Stubber(getattr(branch_pipelines, name))
+        for name in ("cloudformation", "codebuild", "codepipeline", "codecommit")
+    }
+    monkeypatch.setattr(branch_pipelines, "_default_branch", None)
+    deleted = []
+    monkeypatch.setattr(branch_pipelines, "delete_deployed_stack", deleted.append)
+    stubs["codecommit"].add_response(
+        "get_repository",
+        {
+            "repositoryMetadata": {
+                "repositoryName": "myrepo",
+                "defaultBranch": "main",
+            }
+        },
+        {"repositoryName": "myrepo"},
+    )
+    for stub in stubs.values():
+        stub.activate()
+    yield stubs, deleted
+    for name, stub in stubs.items():
+        # the default branch lookup is cached, so not every test uses it
+        if name != "codecommit":
+            stub.assert_no_pending_responses()
+        stub.deactivate()
+
+
+def expect_stack(stubs, branch, response):
+    name = "cf-create-pipeline-myrepo-" + safe_branch_name(branch)
+    if response is None:
+        stubs["cloudformation"].add_client_error(
+            "describe_stacks",
+            service_error_code="ValidationError",
+            service_message="Stack with id " + name + " does not exist",
+            expected_params={"StackName": name},
+        )
+    else:
+        stubs["cloudformation"].add_response(
+            "describe_stacks", {"Stacks": [response]}, {"StackName": name}
+        )
+
+
+def expect_build(stubs, action, branch):
+    # an earlier build, for another branch, that has finished
+    stubs["codebuild"].add_response(
+        "list_builds_for_project",
+        {"ids": ["deployer:0"]},
+        {"projectName": "deployer", "sortOrder": "DESCENDING"},
+    )
+    stubs["codebuild"].add_response(
+        "batch_get_builds",
+        {"builds": [{"id": "deployer:0", "buildStatus": "SUCCEEDED"}]},
+        {"ids": ["deployer:0"]},
+    )
+    stubs["codebuild"].add_response(
+        "start_build",
+        {"build": {"id": "deployer:" + action + "-" + branch}},
+        {
+            "projectName": "deployer",
+            "environmentVariablesOverride": [
+                {"name": "ACTION", "value": action, "type": "PLAINTEXT"},
+                {"name": "BRANCH", "value": branch, "type": "PLAINTEXT"},
+                {
+                    "name": "STACK",
+                    "value": "cf-create-pipeline-myrepo-" + safe_branch_name(branch),
+                    "type": "PLAINTEXT",
+                },
+            ],
+        },
+    )
+
+
+def branch_event(event, branch):
+    return {"event": event, "referenceType": "branch", "referenceName": branch}
+
+
+def test_new_branch_gets_a_pipeline(clients):
+    stubs, deleted = clients
+    expect_stack(stubs, "feature-a", None)
+    expect_build(stubs, "deploy", "feature-a")
+
+    build = branch_pipelines.handle_branch_change(
+        branch_event("referenceCreated", "feature-a")
+    )
+    assert build == "deployer:deploy-feature-a"
+
+
+def test_branches_of_one_repo_get_pipelines_of_their_own(clients):
+    stubs, deleted = clients
+    # feature-a's pipeline is already there when feature-b is created
+    expect_stack(stubs, "feature-a", None)
+    expect_build(stubs, "deploy", "feature-a")
+    expect_stack(stubs, "feature-b", None)
+    expect_build(stubs, "deploy", "feature-b")
+
+    for branch in ("feature-a", "feature-b"):
+        assert branch_pipelines.handle_branch_change(
+            branch_event("referenceCreated", branch)
+        ) == ("deployer:deploy-" + branch)
+
+    # the pooled pipelines the stacks create, which keep their artifacts in separate folders
+    names = [branch_pipelines.pipeline_name(b) for b in ("feature-a", "feature-b")]
+    assert names == [
+        pooled_codepipeline_name(pipeline_name("myrepo", b))
+        for b in ("feature-a", "feature-b")
+    ]
+    assert artifact_folder(names[0]) != artifact_folder(names[1])
+
+
+def test_push_to_a_branch_with_a_pipeline_does_nothing(clients):
+    stubs, deleted = clients
+    expect_stack(stubs, "feature-a", stack("feature-a"))
+
+    assert (
+        branch_pipelines.handle_branch_change(
+            branch_event("referenceUpdated", "feature-a")
+        )
+        is None
+    )
+
+
+def test_default_branch_is_never_managed(clients):
+    stubs, deleted = clients
+    for event in ("referenceCreated", "referenceDeleted"):
+        assert (
+            branch_pipelines.handle_branch_change(branch_event(event, "main")) is None
+        )
+
+
+@pytest.mark.parametrize(
+    "branch", ["feature-a", "feature/a", "feature_a", "feature//a.b", "_", "/"]
+)
+def test_safe_branch_names_match_the_stacks(branch):
+    assert branch_pipelines.safe_branch_name(branch) == safe_branch_name(branch)
+    assert branch_pipelines.pipeline_name(branch) == pooled_codepipeline_name(
+        pipeline_name("myrepo", branch)
+    )
+
+
+def test_safe_branch_names():
+    assert safe_branch_name("feature-a") == "feature-a"
+    assert safe_branch_name("feature/a").startswith("feature-a-")
+    assert safe_branch_name("feature/a") != safe_branch_name("feature_a")
+    for branch in ("feature/a", "_", "/"):
+        safe = safe_branch_name(branch)
+        assert branch_pipelines.STACK_SAFE_BRANCH.match(safe)
+        # so the sweep can use the name it gets from a stack
+        assert safe_branch_name(safe) == safe
+
+
+def test_branch_names_that_cant_be_stack_names_get_a_safe_one(clients):
+    stubs, deleted = clients
+    expect_stack(stubs, "feature/a", None)
+    expect_build(stubs, "deploy", "feature/a")
+
+    build = branch_pipelines.handle_branch_change(
+        branch_event("referenceCreated", "feature/a")
+    )
+    assert build == "deployer:deploy-feature/a"
+
+
+def test_deleting_a_branch_uses_its_safe_name(clients):
+    stubs, deleted = clients
+    safe = safe_branch_name("feature/a")
+    expect_stack(stubs, "feature/a", stack(safe))
+    expect_build(stubs, "destroy", "feature/a")
+
+    branch_pipelines.handle_branch_change(branch_event("referenceDeleted", "feature/a"))
+    assert deleted == ["feature/a"]
+
+
+def test_deployed_stack_of_a_branch_is_found_by_its_safe_name(monkeypatch):
+    deleted = []
+
+    class Client:
+        def assume_role(self, **kwargs):
+            deleted.append(kwargs["RoleSessionName"])
+            return {
+                "Credentials": {
+                    "AccessKeyId": "id",
+                    "SecretAccessKey": "secret",
+                    "SessionToken": "token",
+                }
+            }
+
+        def delete_stack(self, **kwargs):
+            deleted.append(kwargs["StackName"])
+
+    monkeypatch.setattr(branch_pipelines.boto3, "client", lambda *a, **kw: Client())
+    branch_pipelines.delete_deployed_stack("feature/a")
+    safe = safe_branch_name("feature/a")
+    assert deleted == ["teardown-" + safe, "myrepo-" + safe + "-stack"]
+
+
+def test_deleted_branch_tears_down_pipeline_and_deployment(clients):
+    stubs, deleted = clients
+    expect_stack(stubs, "feature-a", stack("feature-a"))
+    expect_build(stubs, "destroy", "feature-a")
+
+    branch_pipelines.handle_branch_change(branch_event("referenceDeleted", "feature-a"))
+    assert deleted == ["feature-a"]
+
+
+def test_deleted_branch_leaves_hand_made_pipelines_alone(clients):
+    stubs, deleted = clients
+    expect_stack(stubs, "feature-a", stack("feature-a", tags=[]))
+
+    assert (
+        branch_pipelines.handle_branch_change(
+            branch_event("referenceDeleted", "feature-a")
+        )
+        is None
+    )
+    assert deleted == []
+
+
+def expect_sweep(stubs, stacks):
+    stubs["cloudformation"].add_response("describe_stacks", {"Stacks": stacks}, {})
+
+
+def expect_last_execution(stubs, branch, hours_ago):
+    stubs["codepipeline"].add_response(
+        "list_pipeline_executions",
+        {
+            "pipelineExecutionSummaries": (
+                [{"startTime": NOW - timedelta(hours=hours_ago)}]
+                if hours_ago is not None
+                else []
+            )
+        },
+        {
+            "pipelineName": pooled_codepipeline_name(pipeline_name("myrepo", branch)),
+            "maxResults": 1,
+        },
+    )
+
+
+def test_sweep_tears_down_idle_pipelines_but_not_their_deployments(clients):
+    stubs, deleted = clients
+    expect_sweep(
+        stubs,
+        [
+            stack("idle", age_hours=200),
+            stack("busy", age_hours=200),
+            stack("hand-made", tags=[], age_hours=200),
+            stack("main", age_hours=200),
+            stack("updating", age_hours=200, status="UPDATE_IN_PROGRESS"),
+        ],
+    )
+    expect_last_execution(stubs, "idle", 100)
+    expect_build(stubs, "destroy", "idle")
+    expect_last_execution(stubs, "busy", 2)
+
+    assert branch_pipelines.sweep_idle(now=NOW) == ["idle"]
+    assert deleted == []
+
+
+def test_sweep_deletes_idle_deployments_when_asked(clients, monkeypatch):
+    stubs, deleted = clients
+    monkeypatch.setattr(branch_pipelines, "DELETE_IDLE_DEPLOYMENTS", True)
+    expect_sweep(stubs, [stack("idle", age_hours=200)])
+    expect_last_execution(stubs, "idle", None)
+    expect_build(stubs, "destroy", "idle")
+
+    assert branch_pipelines.sweep_idle(now=NOW) == ["idle"]
+    assert deleted == ["idle"]
+
+
+def test_no_second_build_while_one_is_running(clients):
+    stubs, deleted = clients
+    expect_stack(stubs, "feature-a", None)
+    stubs["codebuild"].add_response(
+        "list_builds_for_project",
+        {"ids": ["deployer:1"]},
+        {"projectName": "deployer", "sortOrder": "DESCENDING"},
+    )
+    stubs["codebuild"].add_response(
+        "batch_get_builds",
+        {
+            "builds": [
+                {
+                    "id": "deployer:1",
+                    "buildStatus": "IN_PROGRESS",
+                    "environment": {
+                        "type": "LINUX_CONTAINER",
+                        "image": "image",
+                        "computeType": "BUILD_GENERAL1_SMALL",
+                        "environmentVariables": [
+                            {"name": "BRANCH", "value": "feature-a"}
+                        ],
+                    },
+                }
+            ]
+        },
+        {"ids": ["deployer:1"]},
+    )
+
+    assert (
+        branch_pipelines.handle_branch_change(
+            branch_event("referenceCreated", "feature-a")
+        )
+        is None
+    )
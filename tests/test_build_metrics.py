@@ -0,0 +1,53 @@
+from conftest import load_lambda
+from stacks.buildspec_generator import cache_marker_command
+
+build_metrics = load_lambda("build_metrics")
+
+
+def log_data(*messages):
+    return {
+        "logStream": "build-1",
+        "logEvents": [
+            {"id": str(i), "timestamp": 1600000000000 + i, "message": message}
+            for i, message in enumerate(messages)
+        ],
+    }
+
+
+def test_counts_marker_lines():
+    records = build_metrics.cache_metrics(
+        log_data("CACHE_HIT pip\n", "CACHE_MISS npm\n"), "project"
+    )
+    assert [(r["Cache"], r["CacheHit"], r["CacheMiss"]) for r in records] == [
+        ("pip", 1, 0),
+        ("npm", 0, 1),
+    ]
+
+
+def test_ignores_the_command_that_prints_the_marker():
+    # CodeBuild logs each command before running it
+    command = "[Container] 2021/01/01 00:00:00 Running command " + cache_marker_command(
+        "pip"
+    )
+    records = build_metrics.cache_metrics(
+        log_data(command, "CACHE_MISS pip\n"), "project"
+    )
+    assert [(r["CacheHit"], r["CacheMiss"]) for r in records] == [(0, 1)]
+
+
+def test_ignores_markers_echoed_in_a_command():
+    records = build_metrics.cache_metrics(
+        log_data(
+            '[Container] Running command if [ -d x ]; then echo "CACHE_HIT sam"; else echo "CACHE_MISS sam"; fi',
+            "CACHE_MISS sam",
+        ),
+        "project",
+    )
+    assert [(r["CacheHit"], r["CacheMiss"]) for r in records] == [(0, 1)]
+
+
+def test_marker_command_never_contains_the_marker():
+    for name in ("pip", "npm", "sam"):
+        command = cache_marker_command(name)
+        assert "CACHE_HIT" not in command
+        assert "CACHE_MISS" not in command
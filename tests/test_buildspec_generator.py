@@ -0,0 +1,102 @@
+import json
+import subprocess
+
+import pytest
+
+from stacks import buildspec_generator
+from stacks.buildspec_generator import (
+    cache_marker_command,
+    generate_buildspec,
+    to_yaml,
+)
+
+
+def commands(buildspec, phase):
+    return buildspec["phases"][phase]["commands"]
+
+
+def test_sam_keeps_everything_sam_build_cached_reads():
+    buildspec = generate_buildspec("sam")
+    assert buildspec["cache"]["paths"] == ["/root/.cache/pip/**/*", ".aws-sam/**/*"]
+    assert commands(buildspec, "build") == [
+        "sam build --parallel --cached --cache-dir .aws-sam/cache"
+    ]
+    assert commands(buildspec, "post_build")[0].startswith(
+        "sam package --s3-bucket $PACKAGE_BUCKET"
+    )
+    assert buildspec["artifacts"] == {"files": ["packaged.yaml"]}
+
+
+def test_sam_cache_is_only_a_hit_with_its_build_toml(tmp_path):
+    def marker():
+        return subprocess.run(
+            ["sh", "-c", cache_marker_command("sam")],
+            cwd=str(tmp_path),
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    assert marker() == "CACHE_MISS sam\n"
+    # the cache alone doesn't let sam skip anything
+    (tmp_path / ".aws-sam" / "cache").mkdir(parents=True)
+    (tmp_path / ".aws-sam" / "cache" / "function").write_text("")
+    assert marker() == "CACHE_MISS sam\n"
+    (tmp_path / ".aws-sam" / "build.toml").write_text("")
+    assert marker() == "CACHE_HIT sam\n"
+
+
+def test_cdk_packages_the_stack_by_its_name():
+    buildspec = generate_buildspec("cdk", stack_name="my-stack")
+    build = commands(buildspec, "build")
+    # the whole app, as the template's file is named after the construct id
+    assert build[0] == "cdk synth -c environment=$ENVIRONMENT -o cdk.out --quiet"
+    assert build[1] == (
+        "(cd /tmp/pipeline-tools && python3 -m tools.cdk_package"
+        " $CODEBUILD_SRC_DIR/cdk.out my-stack --output $CODEBUILD_SRC_DIR/packaged.yaml)"
+    )
+    assert buildspec["phases"]["install"]["runtime-versions"] == {
+        "python": "3.8",
+        "nodejs": "14",
+    }
+    assert buildspec["cache"]["paths"] == ["/root/.cache/pip/**/*", "/root/.npm/**/*"]
+    assert buildspec["artifacts"] == {"files": ["packaged.yaml"]}
+
+
+def test_cdk_needs_a_stack_name():
+    with pytest.raises(ValueError, match="stack_name"):
+        generate_buildspec("cdk")
+
+
+def test_s3_deploys_the_output_directory():
+    buildspec = generate_buildspec("s3", output_directory="dist")
+    assert commands(buildspec, "build") == ["npm run build"]
+    assert buildspec["artifacts"]["base-directory"] == "dist"
+    assert "post_build" not in buildspec["phases"]
+    assert generate_buildspec("s3")["artifacts"]["base-directory"] == "build"
+
+
+def test_unknown_models_are_an_error():
+    with pytest.raises(ValueError, match="sam, cdk, s3"):
+        generate_buildspec("make")
+
+
+@pytest.mark.parametrize("model", ["sam", "cdk", "s3"])
+def test_the_prelude_runs_first(model):
+    buildspec = generate_buildspec(model, stack_name="my-stack", prelude=["echo first"])
+    assert commands(buildspec, "install")[0] == "echo first"
+
+
+def test_tool_versions_can_be_overridden():
+    buildspec = generate_buildspec("sam", tool_versions={"aws-sam-cli": "1.30.0"})
+    assert "aws-sam-cli==1.30.0" in commands(buildspec, "install")[0]
+
+
+def test_to_yaml_quotes_what_needs_it():
+    assert to_yaml({"a": {"b": ["plain", "yes", "has: colon", "1.0"]}}) == (
+        'a:\n  b:\n    - plain\n    - "yes"\n    - "has: colon"\n    - "1.0"'
+    )
+
+
+def test_main_prints_json(capsys):
+    assert buildspec_generator.main(["s3", "--json"]) == 0
+    assert json.loads(capsys.readouterr().out) == generate_buildspec("s3")
@@ -0,0 +1,142 @@
+import json
+import shutil
+import zipfile
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from conftest import fixture_path
+from tools import cdk_package
+from tools.cdk_package import package_stack, s3_uploader
+
+ASSEMBLY = fixture_path("cdk_package", "assembly")
+
+
+def test_stacks_are_found_by_stack_name_or_construct_id():
+    template = package_stack(ASSEMBLY, "OtherStack", None, None, None)
+    assert template == {"Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}}
+
+    uploads = []
+    package_stack(
+        ASSEMBLY,
+        "myrepo-main-stack",
+        "bucket",
+        "packages",
+        lambda path, key: uploads.append(key),
+    )
+    assert uploads == ["packages/abc123.zip"]
+
+
+def test_an_unknown_stack_is_an_error():
+    with pytest.raises(ValueError, match="it has MyStack, OtherStack"):
+        package_stack(ASSEMBLY, "missing", None, None, None)
+
+
+def test_assets_are_uploaded_and_resolved_into_the_template():
+    uploads = []
+    template = package_stack(
+        ASSEMBLY,
+        "myrepo-main-stack",
+        "artifacts",
+        "packages/pipeline-myrepo-main",
+        lambda path, key: uploads.append((path, key)),
+    )
+    assert uploads == [
+        (
+            fixture_path("cdk_package", "assembly", "asset.abc123"),
+            "packages/pipeline-myrepo-main/abc123.zip",
+        )
+    ]
+    assert template["Resources"]["Function76856677"]["Properties"]["Code"] == {
+        "S3Bucket": "artifacts",
+        "S3Key": "packages/pipeline-myrepo-main/abc123.zip",
+    }
+    # only the asset parameters go
+    assert template["Parameters"] == {"Environment": {"Type": "String"}}
+    assert template["Resources"]["Function76856677"]["Properties"]["Role"] == {
+        "Fn::GetAtt": ["FunctionRole", "Arn"]
+    }
+
+
+def test_assets_need_a_bucket():
+    with pytest.raises(ValueError, match="needs a bucket"):
+        package_stack(ASSEMBLY, "MyStack", None, None, None)
+
+
+def new_style_assembly(tmp_path):
+    assembly = tmp_path / "assembly"
+    shutil.copytree(ASSEMBLY, str(assembly))
+    manifest = json.loads((assembly / "manifest.json").read_text())
+    manifest["artifacts"]["OtherStack.assets"] = {
+        "type": "cdk:asset-manifest",
+        "properties": {"file": "OtherStack.assets.json"},
+    }
+    manifest["artifacts"]["OtherStack"]["dependencies"] = ["OtherStack.assets"]
+    (assembly / "manifest.json").write_text(json.dumps(manifest))
+    return assembly
+
+
+def test_new_style_assets_are_an_error(tmp_path):
+    assembly = new_style_assembly(tmp_path)
+    files = {
+        "template": {"source": {"path": "OtherStack.template.json"}},
+        "code": {"source": {"path": "asset.def456"}},
+    }
+    (assembly / "OtherStack.assets.json").write_text(json.dumps({"files": files}))
+    with pytest.raises(ValueError, match="LegacyStackSynthesizer"):
+        package_stack(str(assembly), "OtherStack", None, None, None)
+
+    # the template is always listed, and doesn't count
+    del files["code"]
+    (assembly / "OtherStack.assets.json").write_text(json.dumps({"files": files}))
+    assert package_stack(str(assembly), "OtherStack", None, None, None)
+
+
+@pytest.fixture
+def s3():
+    client = boto3.client("s3")
+    with Stubber(client) as stub:
+        yield client, stub
+        stub.assert_no_pending_responses()
+
+
+def test_uploader_zips_directories(s3, monkeypatch):
+    client, stub = s3
+    stub.add_client_error(
+        "head_object",
+        service_error_code="404",
+        http_status_code=404,
+        expected_params={"Bucket": "artifacts", "Key": "packages/abc123.zip"},
+    )
+    uploaded = []
+
+    def upload_file(path, bucket, key):
+        with zipfile.ZipFile(path) as archive:
+            uploaded.append((archive.namelist(), bucket, key))
+
+    monkeypatch.setattr(client, "upload_file", upload_file)
+    s3_uploader("artifacts", client)(
+        fixture_path("cdk_package", "assembly", "asset.abc123"),
+        "packages/abc123.zip",
+    )
+    assert uploaded == [(["index.js"], "artifacts", "packages/abc123.zip")]
+
+
+def test_uploader_skips_what_is_already_there(s3, monkeypatch):
+    client, stub = s3
+    stub.add_response(
+        "head_object", {}, {"Bucket": "artifacts", "Key": "packages/abc123.zip"}
+    )
+    monkeypatch.setattr(client, "upload_file", pytest.fail)
+    s3_uploader("artifacts", client)("asset.abc123", "packages/abc123.zip")
+
+
+def test_main_writes_the_packaged_template(tmp_path, monkeypatch):
+    output = tmp_path / "packaged.yaml"
+    monkeypatch.delenv("PACKAGE_BUCKET", raising=False)
+    assert cdk_package.main([ASSEMBLY, "OtherStack", "--output", str(output)]) == 0
+    assert json.loads(output.read_text()) == {
+        "Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}
+    }
+    assert cdk_package.main([ASSEMBLY, "MyStack", "--output", str(output)]) == 1
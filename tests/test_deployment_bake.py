@@ -0,0 +1,197 @@
+import io
+import zipfile
+from datetime import datetime, timezone
+
+import pytest
+from botocore.stub import ANY, Stubber
+
+from conftest import fixture_path, load_lambda
+
+deployment_bake = load_lambda(
+    "deployment_bake",
+    ARTIFACT_BUCKET="artifacts-bucket",
+    PIPELINE_NAME="pipeline-site-main",
+    RELEASE_PREFIX="releases/pipeline-site-main/",
+    DEPLOY_MODEL="cloudformation",
+    RELEASES_TO_KEEP="3",
+)
+
+RELEASE_KEY = "releases/pipeline-site-main/exec-2/"
+PACKAGES = "packages/pipeline-site-main/"
+NESTED_TEMPLATE = b"""Resources:
+  Table:
+    Type: AWS::Serverless::Function
+    Properties:
+      CodeUri: s3://artifacts-bucket/packages/pipeline-site-main/c0ffee
+"""
+
+
+def packaged_template():
+    with open(fixture_path("deployment_bake", "packaged.yaml"), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def s3():
+    with Stubber(deployment_bake.s3) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def expect_copy(s3, key):
+    s3.add_response(
+        "copy_object",
+        {},
+        {
+            "Bucket": "artifacts-bucket",
+            "Key": RELEASE_KEY + key,
+            "CopySource": {"Bucket": "artifacts-bucket", "Key": key},
+        },
+    )
+
+
+def expect_nested_template(s3):
+    key = PACKAGES + "5b7a91e0.template"
+    s3.add_response(
+        "get_object",
+        {"Body": io.BytesIO(NESTED_TEMPLATE)},
+        {"Bucket": "artifacts-bucket", "Key": key},
+    )
+    expect_copy(s3, PACKAGES + "c0ffee")
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "artifacts-bucket",
+            "Key": RELEASE_KEY + key,
+            "Body": NESTED_TEMPLATE.replace(
+                b"artifacts-bucket/" + PACKAGES.encode(),
+                b"artifacts-bucket/" + RELEASE_KEY.encode() + PACKAGES.encode(),
+            ),
+        },
+    )
+
+
+def test_keeps_the_packaged_code_with_the_release(s3):
+    # the same code referred to twice is only copied once, and keys are copied in order
+    expect_copy(s3, PACKAGES + "3e1c4f7a9b2d")
+    expect_nested_template(s3)
+    expect_copy(s3, PACKAGES + "8d0f2b61c5e4")
+
+    template = deployment_bake.keep_packages(packaged_template(), RELEASE_KEY).decode()
+
+    assert (
+        "s3://artifacts-bucket/" + RELEASE_KEY + PACKAGES + "3e1c4f7a9b2d" in template
+    )
+    assert "S3Key: " + RELEASE_KEY + PACKAGES + "3e1c4f7a9b2d" in template
+    assert (
+        "s3://artifacts-bucket/" + RELEASE_KEY + PACKAGES + "8d0f2b61c5e4" in template
+    )
+    assert (
+        "amazonaws.com/artifacts-bucket/" + RELEASE_KEY + PACKAGES + "5b7a91e0.template"
+        in template
+    )
+    # only references to packaged code are rewritten
+    assert "s3://artifacts-bucket/" + PACKAGES not in template
+    assert "S3Bucket: artifacts-bucket" in template
+    assert "code is kept under packages/ for a while" in template
+
+
+def test_promote_writes_the_rewritten_template(s3):
+    artifact = io.BytesIO()
+    with zipfile.ZipFile(artifact, "w") as archive:
+        archive.writestr(
+            "packaged.yaml",
+            "Resources:\n  Fn:\n    Properties:\n      CodeUri: s3://artifacts-bucket/"
+            + PACKAGES
+            + "abc\n",
+        )
+    artifact = artifact.getvalue()
+    location = {
+        "bucketName": "artifacts-bucket",
+        "objectKey": "pipeline-site-m/Build/x",
+    }
+
+    s3.add_response(
+        "get_object",
+        {"Body": io.BytesIO(artifact)},
+        {"Bucket": "artifacts-bucket", "Key": location["objectKey"]},
+    )
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "artifacts-bucket",
+            "Key": RELEASE_KEY + "artifact.zip",
+            "Body": artifact,
+        },
+    )
+    expect_copy(s3, PACKAGES + "abc")
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "artifacts-bucket",
+            "Key": RELEASE_KEY + "packaged.yaml",
+            "Body": (
+                "Resources:\n  Fn:\n    Properties:\n      CodeUri: s3://artifacts-bucket/"
+                + RELEASE_KEY
+                + PACKAGES
+                + "abc\n"
+            ).encode(),
+        },
+    )
+    s3.add_response(
+        "put_object",
+        {},
+        {
+            "Bucket": "artifacts-bucket",
+            "Key": "releases/pipeline-site-main/release.json",
+            "Body": ANY,
+        },
+    )
+    s3.add_response(
+        "list_objects_v2",
+        {"Contents": []},
+        {"Bucket": "artifacts-bucket", "Prefix": "releases/pipeline-site-main/"},
+    )
+
+    deployment_bake.promote(location, "exec-2")
+
+
+def test_prune_keeps_the_newest_releases_and_the_pointer_to_them(s3):
+    prefix = "releases/pipeline-site-main/"
+    contents = [
+        {
+            "Key": prefix + name,
+            "LastModified": datetime(2021, 6, day, tzinfo=timezone.utc),
+        }
+        for name, day in (
+            ("release.json", 1),
+            ("exec-1/artifact.zip", 1),
+            ("exec-1/packaged.yaml", 1),
+            ("exec-2/artifact.zip", 2),
+            ("exec-3/artifact.zip", 3),
+        )
+    ]
+    s3.add_response(
+        "list_objects_v2",
+        {"Contents": contents},
+        {"Bucket": "artifacts-bucket", "Prefix": prefix},
+    )
+    s3.add_response(
+        "delete_objects",
+        {},
+        {
+            "Bucket": "artifacts-bucket",
+            "Delete": {
+                "Objects": [
+                    {"Key": prefix + "exec-1/artifact.zip"},
+                    {"Key": prefix + "exec-1/packaged.yaml"},
+                ],
+                "Quiet": True,
+            },
+        },
+    )
+
+    deployment_bake.prune_releases(prefix, 2)
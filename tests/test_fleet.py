@@ -0,0 +1,145 @@
+import json
+
+import pytest
+
+from stacks.fleet import group_fleet, load_fleet
+
+KEY = "arn:aws:kms:ap-southeast-2:111111111111:key/default"
+OTHER_KEY = "arn:aws:kms:us-east-1:111111111111:key/other"
+
+
+def write_fleet(tmp_path, fleet):
+    path = tmp_path / "fleet.json"
+    path.write_text(json.dumps(fleet))
+    return str(path)
+
+
+def test_targets_get_the_defaults_at_the_top_of_the_file(tmp_path):
+    targets = load_fleet(
+        write_fleet(
+            tmp_path,
+            {
+                "region": "ap-southeast-2",
+                "pipeline_key_arn": KEY,
+                "artifact_bucket": "artifacts",
+                "ignored": "not a default",
+                "targets": [
+                    {"account": 222222222222, "repo": "site", "branch": "main"},
+                    {
+                        "account": "333333333333",
+                        "region": "us-east-1",
+                        "pipeline_key_arn": OTHER_KEY,
+                        "artifact_bucket": "other-artifacts",
+                    },
+                ],
+            },
+        )
+    )
+    assert targets == [
+        {
+            "account": "222222222222",
+            "region": "ap-southeast-2",
+            "pipeline_key_arn": KEY,
+            "artifact_bucket": "artifacts",
+            "repo": "site",
+            "branch": "main",
+        },
+        {
+            "account": "333333333333",
+            "region": "us-east-1",
+            "pipeline_key_arn": OTHER_KEY,
+            "artifact_bucket": "other-artifacts",
+        },
+    ]
+
+
+def test_a_bare_list_of_targets_is_a_fleet(tmp_path):
+    target = {"account": "222222222222", "region": "us-east-1", "pipeline_key_arn": KEY}
+    assert load_fleet(write_fleet(tmp_path, [target])) == [target]
+
+
+@pytest.mark.parametrize("key", ["account", "region", "pipeline_key_arn"])
+def test_a_target_missing_a_required_key_is_an_error(tmp_path, key):
+    target = {"account": "222222222222", "region": "us-east-1", "pipeline_key_arn": KEY}
+    del target[key]
+    with pytest.raises(ValueError, match="Target 0 .* needs a `" + key + "`"):
+        load_fleet(write_fleet(tmp_path, {"targets": [target]}))
+
+
+def test_a_fleet_without_targets_is_an_error(tmp_path):
+    with pytest.raises(ValueError, match="doesn't list any targets"):
+        load_fleet(write_fleet(tmp_path, {"region": "us-east-1", "targets": []}))
+
+
+def target(**extra):
+    return dict(
+        {
+            "account": "222222222222",
+            "region": "ap-southeast-2",
+            "pipeline_key_arn": KEY,
+        },
+        **extra
+    )
+
+
+def test_targets_are_grouped_by_account_region_and_kind():
+    groups = group_fleet(
+        [
+            target(repo="site", branch="main", target_bucket="site-prod"),
+            target(repo="docs", branch="main", target_bucket="docs-prod"),
+            target(repo="api", branch="main", pipeline_key_arn=OTHER_KEY),
+            target(repo="api", branch="main", account="333333333333"),
+        ]
+    )
+    assert list(groups) == [
+        ("222222222222", "ap-southeast-2", "cloudformation"),
+        ("222222222222", "ap-southeast-2", "s3"),
+        ("333333333333", "ap-southeast-2", "cloudformation"),
+    ]
+    s3 = groups[("222222222222", "ap-southeast-2", "s3")]
+    assert s3["target_buckets"] == ["docs-prod", "site-prod"]
+    assert s3["pipeline_key_arns"] == [KEY]
+    assert s3["pipelines"] == ["pipeline-docs-main", "pipeline-site-main"]
+    cloudformation = groups[("222222222222", "ap-southeast-2", "cloudformation")]
+    assert cloudformation["pipeline_key_arns"] == [OTHER_KEY]
+
+
+def test_artifact_buckets_limit_the_role():
+    groups = group_fleet(
+        [target(artifact_bucket="artifacts-a"), target(artifact_bucket="artifacts-b")]
+    )
+    assert list(groups.values())[0]["artifact_buckets"] == [
+        "artifacts-a",
+        "artifacts-b",
+    ]
+
+
+def test_one_target_without_an_artifact_bucket_unlimits_its_whole_group():
+    groups = group_fleet(
+        [
+            target(artifact_bucket="artifacts-a"),
+            target(artifact_bucket="artifacts-b"),
+            target(),
+            target(account="333333333333", artifact_bucket="artifacts-c"),
+        ]
+    )
+    assert (
+        groups[("222222222222", "ap-southeast-2", "cloudformation")]["artifact_buckets"]
+        == []
+    )
+    # but not other groups
+    assert groups[("333333333333", "ap-southeast-2", "cloudformation")][
+        "artifact_buckets"
+    ] == ["artifacts-c"]
+
+
+def test_pooled_targets_without_an_artifact_bucket_use_the_shared_bucket():
+    groups = group_fleet(
+        [target(), target(artifact_bucket="artifacts-a")],
+        devops_account_id="111111111111",
+        pooled=True,
+    )
+    assert list(groups.values())[0]["artifact_buckets"] == [
+        "artifacts-a",
+        "cicd-artifacts-111111111111-222222222222-ap-southeast-2",
+    ]
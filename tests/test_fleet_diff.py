@@ -0,0 +1,224 @@
+import copy
+import json
+
+import pytest
+
+from conftest import fixture_path
+from tools import fleet_diff
+from tools.fleet_diff import (
+    Stack,
+    deploy_waves,
+    diff,
+    load_assembly,
+    normalize_template,
+    state_key,
+    template_hash,
+)
+
+ASSEMBLY = fixture_path("fleet_diff", "assembly")
+ENVIRONMENT = "aws://111111111111/ap-southeast-2"
+
+
+def load_template(name):
+    with open(fixture_path("fleet_diff", "assembly", name + ".template.json")) as f:
+        return json.load(f)
+
+
+def test_cdk_metadata_and_the_bootstrap_check_are_ignored():
+    template = load_template("s3-create-pipeline-site-main")
+    assert normalize_template(template) == {
+        "Parameters": {"AssetParametersabc123S3Bucket": {"Type": "String"}},
+        "Resources": {
+            "Pipeline": {
+                "Type": "AWS::CodePipeline::Pipeline",
+                "Properties": {
+                    "Name": "pipeline-site-main",
+                    "EncryptionKey": {"Fn::ImportValue": "site-main-key"},
+                    "Code": {"Ref": "AssetParametersabc123S3Bucket"},
+                },
+            }
+        },
+    }
+    # and the template itself is left alone
+    assert "BootstrapVersion" in template["Parameters"]
+
+
+def test_what_only_changes_with_cdk_doesnt_change_the_hash():
+    template = load_template("create-pipeline-infra-site-main")
+    other = copy.deepcopy(template)
+    other["Resources"]["CDKMetadata"]["Properties"]["Analytics"] = "v2:deflate64:xyz"
+    other["Resources"]["Key"]["Metadata"]["aws:cdk:path"] = "elsewhere/Key/Resource"
+    del other["Conditions"]
+    # key order doesn't count either
+    other["Resources"] = dict(reversed(list(other["Resources"].items())))
+    assert template_hash(other) == template_hash(template)
+
+
+def test_asset_parameter_changes_count():
+    template = load_template("s3-create-pipeline-site-main")
+    other = json.loads(json.dumps(template).replace("abc123", "def456"))
+    assert template_hash(other) != template_hash(template)
+
+
+def test_real_changes_count():
+    template = load_template("create-pipeline-infra-site-main")
+    other = copy.deepcopy(template)
+    other["Resources"]["Key"]["Properties"]["EnableKeyRotation"] = True
+    assert template_hash(other) != template_hash(template)
+
+
+def test_load_assembly():
+    stacks = {s.name: s for s in load_assembly(ASSEMBLY)}
+    assert sorted(stacks) == [
+        "create-pipeline-infra-site-main",
+        "parameter-stack-site-main",
+        "s3-create-pipeline-site-main",
+    ]
+    site = stacks["s3-create-pipeline-site-main"]
+    assert (site.account, site.region) == ("111111111111", "ap-southeast-2")
+    # the asset manifest isn't a stack to deploy first
+    assert site.dependencies == set()
+    assert site.imports() == {"site-main-key"}
+    assert stacks["create-pipeline-infra-site-main"].exports() == {"site-main-key"}
+    assert stacks["parameter-stack-site-main"].exports() == {
+        "ssm:/pipeline-site-main/config"
+    }
+    assert stacks["parameter-stack-site-main"].dependencies == {
+        "create-pipeline-infra-site-main"
+    }
+
+
+def stack(name, template=None, dependencies=()):
+    return Stack(
+        name,
+        ENVIRONMENT,
+        template or {"Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}},
+        dependencies,
+    )
+
+
+def exporting(name, export):
+    return {
+        "Resources": {},
+        "Outputs": {"Out": {"Value": "x", "Export": {"Name": export}}},
+    }
+
+
+def test_infra_is_deployed_before_pipelines_before_everything_else():
+    stacks = [
+        stack("something-else"),
+        stack("cf-create-pipeline-api-main"),
+        stack("s3-create-pipeline-site-main"),
+        stack("create-pipeline-infra-site-main"),
+        stack("create-pipeline-infra-api-main"),
+    ]
+    assert deploy_waves(stacks, stacks) == [
+        ["create-pipeline-infra-api-main", "create-pipeline-infra-site-main"],
+        ["s3-create-pipeline-site-main"],
+        ["cf-create-pipeline-api-main"],
+        ["something-else"],
+    ]
+
+
+def test_imports_are_deployed_before_the_stacks_importing_them():
+    # would otherwise go first, by its name
+    importer = stack(
+        "create-pipeline-infra-a",
+        {"Resources": {"Key": {"Properties": {"Arn": {"Fn::ImportValue": "value"}}}}},
+    )
+    exporter = stack("zzz-exporter", exporting("zzz-exporter", "value"))
+    assert deploy_waves([importer, exporter], [importer, exporter]) == [
+        ["zzz-exporter"],
+        ["create-pipeline-infra-a"],
+    ]
+
+
+def test_ssm_parameters_are_deployed_before_the_stacks_reading_them():
+    reader = stack(
+        "create-pipeline-infra-a",
+        {
+            "Parameters": {
+                "Config": {
+                    "Type": "AWS::SSM::Parameter::Value<String>",
+                    "Default": "/config",
+                }
+            },
+            "Resources": {},
+        },
+    )
+    writer = stack(
+        "zzz-writer",
+        {
+            "Resources": {
+                "Config": {
+                    "Type": "AWS::SSM::Parameter",
+                    "Properties": {"Name": "/config"},
+                }
+            }
+        },
+    )
+    assert deploy_waves([reader, writer], [reader, writer]) == [
+        ["zzz-writer"],
+        ["create-pipeline-infra-a"],
+    ]
+
+
+def test_stacks_not_being_deployed_are_already_there():
+    importer = stack(
+        "a", {"Resources": {"R": {"Properties": {"V": {"Fn::ImportValue": "value"}}}}}
+    )
+    exporter = stack("b", exporting("b", "value"))
+    assert deploy_waves([importer, exporter], [importer]) == [["a"]]
+
+
+def test_stacks_that_depend_on_each_other_are_an_error():
+    a = stack("a", dependencies=["b"])
+    b = stack("b", dependencies=["a"])
+    with pytest.raises(ValueError, match="These stacks depend on each other: a, b"):
+        deploy_waves([a, b], [a, b])
+
+
+def test_diff():
+    stacks = load_assembly(ASSEMBLY)
+    by_name = {s.name: s for s in stacks}
+    previous = {
+        state_key(by_name["create-pipeline-infra-site-main"]): by_name[
+            "create-pipeline-infra-site-main"
+        ].hash,
+        state_key(by_name["s3-create-pipeline-site-main"]): "an older hash",
+        state_key(by_name["parameter-stack-site-main"]): None,
+        ENVIRONMENT + "/removed-stack": "hash",
+    }
+    assert diff(stacks, previous) == {
+        "changed": ["s3-create-pipeline-site-main"],
+        "new": [],
+        "unknown": ["parameter-stack-site-main"],
+        "unchanged": 1,
+        "missing": [ENVIRONMENT + "/removed-stack"],
+        "waves": [["parameter-stack-site-main"], ["s3-create-pipeline-site-main"]],
+    }
+
+
+def test_diff_with_no_state_deploys_everything():
+    report = diff(load_assembly(ASSEMBLY), {})
+    assert report["new"] == [
+        "create-pipeline-infra-site-main",
+        "parameter-stack-site-main",
+        "s3-create-pipeline-site-main",
+    ]
+    assert report["waves"] == [
+        ["create-pipeline-infra-site-main"],
+        ["parameter-stack-site-main"],
+        ["s3-create-pipeline-site-main"],
+    ]
+
+
+def test_recorded_state_is_unchanged(tmp_path, capsys):
+    state = str(tmp_path / "state.json")
+    assert fleet_diff.main([ASSEMBLY, "--state", state, "--record"]) == 0
+    capsys.readouterr()
+
+    assert fleet_diff.main([ASSEMBLY, "--state", state, "--json"]) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["unchanged"] == 3
+    assert report["waves"] == []
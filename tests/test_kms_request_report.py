@@ -0,0 +1,66 @@
+from stacks.pipeline_names import pooled_codepipeline_name
+from tools.kms_request_report import UNATTRIBUTED, KmsRequestReport
+
+
+def report(*pipelines, **bucket_pipelines):
+    report = KmsRequestReport(bucket_pipelines=bucket_pipelines)
+    report.known_pipelines |= set(pipelines)
+    return report
+
+
+def test_credits_codepipeline_folders_to_their_pipeline():
+    # CodePipeline's folder is the first 20 characters of the pipeline name
+    assert (
+        report("pipeline-myrepo-main").pipeline_for(
+            "bucket", "pipeline-myrepo-main/BuildOutp/abc"
+        )
+        == "pipeline-myrepo-main"
+    )
+    assert (
+        report("pipeline-myrepo-feature").pipeline_for(
+            "bucket", "pipeline-myrepo-feat/BuildOutp/abc"
+        )
+        == "pipeline-myrepo-feature"
+    )
+    # a prefix that isn't a whole folder isn't one of CodePipeline's
+    assert (
+        report("pipeline-myrepo-feature").pipeline_for(
+            "bucket", "pipeline-myrepo-featu/BuildOutp/abc"
+        )
+        == "pipeline-myrepo-featu"
+    )
+
+
+def test_credits_pooled_prefixes_to_their_pipeline():
+    kms_report = report()
+    for key in (
+        "packages/pipeline-myrepo-feature-a/3e1c4f7a9b2d",
+        "build-cache/pipeline-myrepo-feature-a/cache.zip",
+        "releases/pipeline-myrepo-feature-a/exec-1/artifact.zip",
+        "releases/pipeline-myrepo-feature-a/release.json",
+    ):
+        assert kms_report.pipeline_for("shared", key) == "pipeline-myrepo-feature-a"
+
+
+def test_falls_back_to_the_bucket():
+    kms_report = report(shared="pipeline-myrepo-main")
+    # packages uploaded without a pipeline prefix of their own
+    assert kms_report.pipeline_for("shared", "packages/3e1c4f7a9b2d") == (
+        "pipeline-myrepo-main"
+    )
+    assert kms_report.pipeline_for("shared", None) == "pipeline-myrepo-main"
+    assert kms_report.pipeline_for("other", "site/index.html") == UNATTRIBUTED
+
+
+def test_credits_pooled_codepipeline_folders_to_their_pipeline():
+    pooled = pooled_codepipeline_name("pipeline-myrepo-feature-a")
+    other = pooled_codepipeline_name("pipeline-myrepo-feature-b")
+    kms_report = report("pipeline-myrepo-feature-a", "pipeline-myrepo-feature-b")
+    assert (
+        kms_report.pipeline_for("shared", pooled[:20] + "/BuildOutp/abc")
+        == "pipeline-myrepo-feature-a"
+    )
+    assert (
+        kms_report.pipeline_for("shared", other[:20] + "/BuildOutp/abc")
+        == "pipeline-myrepo-feature-b"
+    )
@@ -0,0 +1,144 @@
+import json
+import os
+import stat
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from tools.parameter_loader import (
+    fetch_parameters,
+    load_parameters,
+    render,
+    variable_name,
+    with_backoff,
+)
+
+PATH = "/pipeline-myrepo-main"
+
+
+def parameter(name, value):
+    return {"Name": PATH + "/" + name, "Value": value, "Type": "String"}
+
+
+def stub_pages(stubber, *pages):
+    kwargs = {"Path": PATH, "Recursive": True, "WithDecryption": True}
+    for i, parameters in enumerate(pages):
+        response = {"Parameters": parameters}
+        if i < len(pages) - 1:
+            response["NextToken"] = "page%d" % (i + 1)
+        stubber.add_response("get_parameters_by_path", response, dict(kwargs))
+        kwargs["NextToken"] = "page%d" % (i + 1)
+
+
+def test_every_page_is_read():
+    client = boto3.client("ssm")
+    with Stubber(client) as stubber:
+        stub_pages(
+            stubber,
+            [parameter("api_key", "abc")],
+            [parameter("nested/user_pool", "pool")],
+        )
+        parameters = fetch_parameters(client, "pipeline-myrepo-main/")
+        stubber.assert_no_pending_responses()
+    assert parameters == {"api_key": "abc", "nested/user_pool": "pool"}
+
+
+def test_a_json_document_is_expanded_and_separate_parameters_win():
+    client = boto3.client("ssm")
+    with Stubber(client) as stubber:
+        stub_pages(
+            stubber,
+            [
+                parameter("parameters.json", json.dumps({"a": "1", "b": "2"})),
+                parameter("b", "override"),
+            ],
+        )
+        parameters = fetch_parameters(client, PATH)
+    assert parameters == {"a": "1", "b": "override"}
+
+
+def test_throttling_is_retried_with_backoff():
+    client = boto3.client("ssm")
+    sleeps = []
+    with Stubber(client) as stubber:
+        stubber.add_client_error("get_parameters_by_path", "ThrottlingException")
+        stubber.add_client_error("get_parameters_by_path", "ThrottlingException")
+        stub_pages(stubber, [parameter("a", "1")])
+        assert fetch_parameters(client, PATH, sleep=sleeps.append) == {"a": "1"}
+    assert len(sleeps) == 2
+    assert sleeps[0] <= 0.2 and sleeps[1] <= 0.4
+
+
+def test_other_errors_arent_retried():
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ValueError("nope")
+
+    with pytest.raises(ValueError):
+        with_backoff(fail, sleep=lambda seconds: None)
+    assert len(calls) == 1
+
+
+def test_throttling_gives_up_eventually():
+    client = boto3.client("ssm")
+    with Stubber(client) as stubber:
+        for _ in range(3):
+            stubber.add_client_error("get_parameters_by_path", "ThrottlingException")
+        with pytest.raises(client.exceptions.ClientError):
+            with_backoff(
+                lambda: client.get_parameters_by_path(Path=PATH),
+                max_attempts=3,
+                sleep=lambda seconds: None,
+            )
+
+
+def test_values_are_cached_privately_until_they_expire(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    client = boto3.client("ssm")
+    with Stubber(client) as stubber:
+        stub_pages(stubber, [parameter("a", "1")])
+        assert load_parameters(PATH, client, cache_dir) == {"a": "1"}
+        # no more responses, so this has to come from the cache
+        assert load_parameters(PATH, client, cache_dir) == {"a": "1"}
+
+    (cache_file,) = os.listdir(cache_dir)
+    cache_file = os.path.join(cache_dir, cache_file)
+    assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0o700
+
+    os.utime(cache_file, (0, 0))
+    with Stubber(client) as stubber:
+        stub_pages(stubber, [parameter("a", "2")])
+        assert load_parameters(PATH, client, cache_dir) == {"a": "2"}
+        stubber.assert_no_pending_responses()
+
+
+def test_a_ttl_of_zero_always_fetches(tmp_path):
+    client = boto3.client("ssm")
+    with Stubber(client) as stubber:
+        stub_pages(stubber, [parameter("a", "1")])
+        stub_pages(stubber, [parameter("a", "2")])
+        assert load_parameters(PATH, client, str(tmp_path), ttl=0) == {"a": "1"}
+        assert load_parameters(PATH, client, str(tmp_path), ttl=0) == {"a": "2"}
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_keys_become_variable_names():
+    assert variable_name("api-key") == "API_KEY"
+    assert (
+        variable_name("nested/user.pool", "REACT_APP_") == "REACT_APP_NESTED_USER_POOL"
+    )
+
+
+def test_rendering():
+    parameters = {"api_key": "it's", "url": "https://example.com"}
+    assert render(parameters, "shell") == (
+        "export API_KEY='it'\"'\"'s'\nexport URL=https://example.com"
+    )
+    assert render(parameters, "dotenv", "VITE_") == (
+        'VITE_API_KEY="it\'s"\nVITE_URL="https://example.com"'
+    )
+    assert json.loads(render(parameters, "json")) == parameters
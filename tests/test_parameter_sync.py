@@ -0,0 +1,166 @@
+import json
+
+import boto3
+from botocore.stub import Stubber
+
+from tools.parameter_sync import apply, parameter_tier, plan, plan_pipeline
+
+PATH = "/pipeline-myrepo-main"
+
+
+def existing(**values):
+    return {
+        name: {"Name": PATH + "/" + name, "Value": value, "Type": "String"}
+        for name, value in values.items()
+    }
+
+
+def test_only_what_differs_is_changed():
+    changes, unchanged = plan_pipeline(
+        "pipeline-myrepo-main",
+        {"same": "a", "changed": "new", "added": "b"},
+        existing(same="a", changed="old", extra="c"),
+    )
+    assert [(c.action, c.name, c.value) for c in changes] == [
+        ("create", PATH + "/added", "b"),
+        ("update", PATH + "/changed", "new"),
+    ]
+    assert unchanged == 1
+
+
+def test_nulls_keep_what_is_there_or_create_a_placeholder():
+    changes, unchanged = plan_pipeline(
+        "pipeline-myrepo-main", {"kept": None, "missing": None}, existing(kept="value")
+    )
+    assert [(c.action, c.name, c.value) for c in changes] == [
+        ("create", PATH + "/missing", "placeholder")
+    ]
+    assert unchanged == 1
+
+
+def test_prune_deletes_parameters_that_arent_in_the_file():
+    changes, _ = plan_pipeline(
+        "pipeline-myrepo-main", {"a": "1"}, existing(a="1", b="2"), prune=True
+    )
+    assert [(c.action, c.name) for c in changes] == [("delete", PATH + "/b")]
+
+
+def test_updates_keep_securestrings_secure():
+    current = existing(secret="old")
+    current["secret"]["Type"] = "SecureString"
+    (change,), _ = plan_pipeline("pipeline-myrepo-main", {"secret": "new"}, current)
+    assert change.type == "SecureString"
+
+
+def test_json_documents_are_compared_by_content():
+    document = json.dumps({"b": "2", "a": "1"}, indent=2)
+    changes, unchanged = plan_pipeline(
+        "pipeline-myrepo-main",
+        {"a": "1", "b": "2"},
+        existing(**{"parameters.json": document}),
+        parameter_format="json",
+    )
+    assert changes == []
+    assert unchanged == 1
+
+
+def test_the_tier_is_picked_by_size_in_bytes():
+    assert parameter_tier("x" * 4096) == "Standard"
+    assert parameter_tier("x" * 4097) == "Advanced"
+    # 2 bytes each, so 4 KB of characters is 8 KB
+    assert parameter_tier("é" * 2048) == "Standard"
+    assert parameter_tier("é" * 2049) == "Advanced"
+
+
+def test_advanced_parameters_are_never_made_standard():
+    current = existing(big="old")
+    current["big"]["Tier"] = "Advanced"
+    (change,), _ = plan_pipeline("pipeline-myrepo-main", {"big": "small now"}, current)
+    assert change.tier == "Advanced"
+
+
+def test_tiers_are_only_looked_up_when_something_is_updated():
+    client = boto3.client("ssm")
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "get_parameters_by_path",
+            {"Parameters": [{"Name": PATH + "/a", "Value": "1", "Type": "String"}]},
+            {"Path": PATH, "Recursive": True, "WithDecryption": True},
+        )
+        changes, unchanged = plan(client, {"pipeline-myrepo-main": {"a": "1"}})
+        stubber.assert_no_pending_responses()
+    assert (changes, unchanged) == ([], 1)
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "get_parameters_by_path",
+            {"Parameters": [{"Name": PATH + "/a", "Value": "1", "Type": "String"}]},
+            {"Path": PATH, "Recursive": True, "WithDecryption": True},
+        )
+        stubber.add_response(
+            "describe_parameters",
+            {"Parameters": [{"Name": PATH + "/a", "Tier": "Advanced"}]},
+            {
+                "ParameterFilters": [
+                    {"Key": "Path", "Option": "Recursive", "Values": [PATH]}
+                ]
+            },
+        )
+        (change,), _ = plan(client, {"pipeline-myrepo-main": {"a": "2"}})
+        stubber.assert_no_pending_responses()
+    assert (change.action, change.tier) == ("update", "Advanced")
+
+
+def test_apply_puts_then_deletes_in_batches():
+    changes, _ = plan_pipeline(
+        "pipeline-myrepo-main",
+        {"new": "x" * 5000, "changed": "b"},
+        existing(changed="a", **{"old%02d" % i: "value" for i in range(11)}),
+        prune=True,
+    )
+    client = boto3.client("ssm")
+    with Stubber(client) as stubber:
+        # one at a time, so the responses come back in order
+        stubber.add_response(
+            "put_parameter",
+            {"Version": 2},
+            {
+                "Name": PATH + "/changed",
+                "Value": "b",
+                "Type": "String",
+                "Tier": "Standard",
+                "Overwrite": True,
+            },
+        )
+        stubber.add_response(
+            "put_parameter",
+            {"Version": 1},
+            {
+                "Name": PATH + "/new",
+                "Value": "x" * 5000,
+                "Type": "String",
+                "Tier": "Advanced",
+                "Overwrite": False,
+            },
+        )
+        old = [PATH + "/old%02d" % i for i in range(11)]
+        stubber.add_response(
+            "delete_parameters", {"DeletedParameters": old[:10]}, {"Names": old[:10]}
+        )
+        stubber.add_response(
+            "delete_parameters", {"DeletedParameters": old[10:]}, {"Names": old[10:]}
+        )
+        apply(client, changes, concurrency=1, sleep=lambda seconds: None)
+        stubber.assert_no_pending_responses()
+
+
+def test_throttled_puts_are_retried():
+    (change,), _ = plan_pipeline("pipeline-myrepo-main", {"a": "1"}, {})
+    client = boto3.client("ssm")
+    sleeps = []
+    with Stubber(client) as stubber:
+        stubber.add_client_error("put_parameter", "ThrottlingException")
+        stubber.add_response("put_parameter", {"Version": 1})
+        apply(client, [change], sleep=sleeps.append)
+        stubber.assert_no_pending_responses()
+    assert len(sleeps) == 1
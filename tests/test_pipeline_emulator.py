@@ -0,0 +1,181 @@
+import io
+import json
+
+import pytest
+
+from conftest import fixture_path
+from tools.pipeline_emulator import LocalState, PipelineEmulator, Template, main
+
+
+def emulator(tmp_path, stack, source, parameters=None, **kwargs):
+    with open(fixture_path("pipeline_emulator", stack + ".template.json")) as fp:
+        template = Template(json.load(fp), stack)
+    state = LocalState(str(tmp_path / "state"), parameters)
+    return PipelineEmulator(
+        template,
+        template.pipelines()[0],
+        state,
+        str(source),
+        out=io.StringIO(),
+        **kwargs
+    )
+
+
+def statuses(result):
+    return {
+        stage["stage"] + "/" + action["action"]: action["status"]
+        for stage in result["stages"]
+        for action in stage["actions"]
+    }
+
+
+@pytest.fixture
+def site(tmp_path):
+    source = tmp_path / "site"
+    source.mkdir()
+    (source / "index.html").write_text("<h1>hello</h1>")
+    return source
+
+
+def test_an_s3_pipeline_builds_and_deploys_offline(tmp_path, site):
+    pipeline = emulator(
+        tmp_path,
+        "s3-create-pipeline-site-main",
+        site,
+        {"/pipeline-site-main/api_key": "abc", "/pipeline-other-main/api_key": "nope"},
+        skip_commands=["*npm install -g*"],
+    )
+    result = pipeline.run()
+
+    assert result["status"] == "Succeeded", result
+    assert statuses(result) == {
+        "Source/Source": "Succeeded",
+        "Build/Build": "Succeeded",
+        "Deploy/AcquireDeployLock": "Skipped",
+        "Deploy/Deploy": "Succeeded",
+        "Deploy/ReleaseDeployLock": "Skipped",
+    }
+    bucket = tmp_path / "state" / "s3" / "site-main-bucket"
+    assert (bucket / "index.html").read_text() == "<h1>hello</h1>"
+    # the parameter came from the loader, which downloaded the local tools
+    assert (bucket / "api_key.txt").read_text() == "abc\n"
+
+    (log,) = (tmp_path / "state" / "executions").glob("*/*/Build/build.log")
+    assert "skipped: node --version" in log.read_text()
+
+
+def test_a_cloudformation_pipeline_creates_and_executes_its_change_set(tmp_path, site):
+    template = {
+        "Parameters": {"Environment": {"Type": "String"}},
+        "Resources": {"Topic": {"Type": "AWS::SNS::Topic"}},
+    }
+    (site / "template.json").write_text(json.dumps(template))
+    pipeline = emulator(
+        tmp_path,
+        "cf-create-pipeline-site-main",
+        site,
+        skip_commands=["pip3 install *"],
+    )
+
+    first = pipeline.run()
+    assert first["status"] == "Succeeded", first
+    assert statuses(first)["Preflight/ValidateTemplate"] == "Succeeded"
+    assert statuses(first)["DeployChangeSet/Deploy"] == "Succeeded"
+    change_set = first["stages"][3]["actions"][0]["detail"]
+    assert change_set == "change set: 1 to add, 0 to modify, 0 to remove"
+
+    template["Resources"]["Queue"] = {"Type": "AWS::SQS::Queue"}
+    (site / "template.json").write_text(json.dumps(template))
+    second = pipeline.run()
+    assert second["status"] == "Succeeded", second
+    deploy = second["stages"][-1]["actions"][1]
+    assert deploy["detail"] == "1 to add, 0 to modify, 0 to remove"
+
+    stack = pipeline.state.load_stack("site-main-stack")
+    assert sorted(stack["resources"]) == ["Queue", "Topic"]
+    assert stack["change_sets"] == {}
+
+
+def test_an_execution_deploys_its_own_change_set(tmp_path, site):
+    (site / "template.json").write_text(
+        json.dumps(
+            {
+                "Parameters": {"Environment": {"Type": "String"}},
+                "Resources": {"Topic": {"Type": "AWS::SNS::Topic"}},
+            }
+        )
+    )
+    pipeline = emulator(
+        tmp_path, "cf-create-pipeline-site-main", site, skip_commands=["pip3 install *"]
+    )
+    # another execution is waiting for its change set to be approved
+    pipeline.state.save_stack(
+        "site-main-stack",
+        {
+            "resources": {},
+            "parameters": None,
+            "change_sets": {
+                "site-main-stack-other": {
+                    "resources": {"Queue": "abc"},
+                    "parameters": {},
+                    "changes": {"add": ["Queue"], "modify": [], "remove": []},
+                }
+            },
+        },
+    )
+
+    result = pipeline.run()
+    assert result["status"] == "Succeeded", result
+    stack = pipeline.state.load_stack("site-main-stack")
+    assert list(stack["resources"]) == ["Topic"]
+    # and executing it deleted the other execution's
+    assert stack["change_sets"] == {}
+
+
+def test_a_failing_build_stops_the_pipeline(tmp_path, site):
+    (site / "index.html").unlink()
+    pipeline = emulator(
+        tmp_path,
+        "s3-create-pipeline-site-main",
+        site,
+        skip_commands=["*npm install -g*"],
+    )
+    result = pipeline.run()
+    assert result["status"] == "Failed"
+    assert [stage["stage"] for stage in result["stages"]] == ["Source", "Build"]
+    assert "build phase failed" in result["stages"][-1]["actions"][0]["detail"]
+
+
+def test_main_reports_each_stage(tmp_path, site, capsys):
+    (site / "template.json").write_text(
+        json.dumps(
+            {
+                "Parameters": {"Environment": {"Type": "String"}},
+                "Resources": {"Topic": {"Type": "AWS::SNS::Topic"}},
+            }
+        )
+    )
+    code = main(
+        [
+            fixture_path("pipeline_emulator"),
+            "--stack",
+            "cf-create-pipeline-site-main",
+            "--source",
+            str(site),
+            "--state-dir",
+            str(tmp_path / "state"),
+            "--skip-command",
+            "pip3 install *",
+            "--json",
+        ]
+    )
+    assert code == 0
+    output = json.loads(capsys.readouterr().out)
+    assert [stage["stage"] for stage in output["runs"][0]["stages"]] == [
+        "Source",
+        "Build",
+        "Preflight",
+        "CreateChangeSet",
+        "ApproveChangeSet",
+        "DeployChangeSet",
+    ]
@@ -0,0 +1,33 @@
+import pytest
+
+from stacks.pipeline_names import (
+    artifact_folder,
+    pipeline_name,
+    pooled_codepipeline_name,
+    unpooled_pipeline_name,
+)
+
+
+@pytest.mark.parametrize("repo", ["myservice", "a-much-longer-repository-name"])
+def test_pooled_branches_of_a_repo_get_folders_of_their_own(repo):
+    names = [pipeline_name(repo, branch) for branch in ("feature-a", "feature-b")]
+    # without the hash, CodePipeline would keep both in the same folder
+    assert artifact_folder(names[0]) == artifact_folder(names[1])
+
+    pooled = [pooled_codepipeline_name(name) for name in names]
+    assert artifact_folder(pooled[0]) != artifact_folder(pooled[1])
+    assert all(len(artifact_folder(name)) == 20 for name in pooled)
+
+
+def test_pooled_name_keeps_the_name_it_was_made_from():
+    pooled = pooled_codepipeline_name("pipeline-myservice-feature-a")
+    assert pooled.startswith("pipeline-")
+    assert pooled.endswith("-myservice-feature-a")
+    assert unpooled_pipeline_name(pooled) == "pipeline-myservice-feature-a"
+
+
+def test_unpooled_leaves_other_names_alone():
+    # looks like a hash, but isn't the hash of the rest of the name
+    assert unpooled_pipeline_name("pipeline-deadbeef-main") == "pipeline-deadbeef-main"
+    assert unpooled_pipeline_name("pipeline-myrepo-main") == "pipeline-myrepo-main"
+    assert unpooled_pipeline_name("other") == "other"
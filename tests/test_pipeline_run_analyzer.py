@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from conftest import fixture_path
+from tools import pipeline_run_analyzer
+from tools.pipeline_run_analyzer import parse_time
+
+# 2021-03-01T00:00:00Z
+START = 1614556800
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "2021-03-01T00:00:00Z",
+        "2021-03-01T00:00:00.000Z",
+        "2021-03-01T11:00:00+11:00",
+        "2021-03-01T11:00:00.000000+11:00",
+        "2021-03-01T11:00:00+1100",
+        "2021-02-28T19:00:00-05:00",
+        # no offset is UTC
+        "2021-03-01T00:00:00",
+        "2021-03-01 00:00:00",
+        START,
+    ],
+)
+def test_parse_time(value):
+    assert parse_time(value) == START
+
+
+def test_parse_time_keeps_fractions():
+    assert parse_time("2021-03-01T00:00:00.141Z") == pytest.approx(START + 0.141)
+    assert parse_time(None) is None
+
+
+def test_parse_time_rejects_other_formats():
+    with pytest.raises(ValueError):
+        parse_time("1 March 2021")
+
+
+def test_recorded_run(capsys):
+    # one execution in CLI times (+11:00), and one with a failed build retried, in UTC (Z)
+    assert (
+        pipeline_run_analyzer.main(["--json", fixture_path("pipeline_run_analyzer")])
+        == 0
+    )
+    report = json.loads(capsys.readouterr().out)
+
+    assert report["pipelines"] == 1
+    assert report["execution_statuses"] == {"execution": {"Succeeded": 2}}
+    executions = report["executions"]["execution"]
+    assert executions["count"] == 2
+    assert executions["total"] == pytest.approx(760.9 + 2220.9)
+
+    stages = report["stages"]
+    assert sorted(stages) == ["Approve", "Build", "Deploy", "Source"]
+    # the retried build stage runs from the first attempt to the retry finishing
+    assert stages["Build"]["max"] == pytest.approx(1940.446)
+    assert stages["Build"]["total"] == pytest.approx(180.446 + 1940.446)
+    assert report["approvals"]["approval"]["max"] == pytest.approx(420.446)
+
+    assert report["failed_attempts"] == {"Build": 1}
+    assert report["retry_loss_seconds"] == {"Build/Build": pytest.approx(60.446)}
+    assert [p["path"] for p in report["common_critical_paths"]] == [
+        "Source/Source > Build/Build > Build/Build > Approve/Approve > Deploy/Deploy",
+        "Source/Source > Build/Build > Approve/Approve > Deploy/Deploy",
+    ]
@@ -0,0 +1,214 @@
+import json
+
+from botocore.stub import ANY, Stubber
+
+from conftest import fixture_path, load_lambda
+
+pipeline_telemetry = load_lambda("pipeline_telemetry")
+
+EXECUTION = "6f0a3f7e-0000-4000-8000-000000000001"
+RETRIED = "6f0a3f7e-0000-4000-8000-000000000002"
+# 2021-03-01T00:00:00Z, when the recorded executions start
+START = 1614556800
+
+
+def recorded_events(name):
+    with open(fixture_path("pipeline_telemetry", name + ".jsonl")) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(events, store=None):
+    store = store or pipeline_telemetry.MemoryStore()
+    records = []
+    for event in events:
+        records += pipeline_telemetry.process_event(event, store)
+    return records
+
+
+def metric_values(records):
+    """(metric name, dimension values, value) for every metric in the records."""
+    values = []
+    for record in records:
+        directive = record["_aws"]["CloudWatchMetrics"][0]
+        dimensions = tuple(record[name] for name in directive["Dimensions"][0])
+        for metric in directive["Metrics"]:
+            values.append((metric["Name"], dimensions, record[metric["Name"]]))
+    return values
+
+
+def test_emits_embedded_metric_format():
+    records = replay(recorded_events("execution"))
+
+    execution = records[-1]
+    assert execution["_aws"] == {
+        "Timestamp": (START + 810) * 1000,
+        "CloudWatchMetrics": [
+            {
+                "Namespace": "CodePipeline/Telemetry",
+                "Dimensions": [["Pipeline"]],
+                "Metrics": [
+                    {"Name": "ExecutionSucceeded", "Unit": "Count"},
+                    {"Name": "ExecutionFailed", "Unit": "Count"},
+                    {"Name": "ExecutionDuration", "Unit": "Seconds"},
+                ],
+            }
+        ],
+    }
+    assert execution["Pipeline"] == "pipeline-site-main"
+    assert execution["ExecutionId"] == EXECUTION
+    # every record serializes, as it's printed to the log
+    assert all(json.loads(json.dumps(record)) == record for record in records)
+
+
+def test_times_an_execution():
+    assert metric_values(replay(recorded_events("execution"))) == [
+        ("StageQueueTime", ("pipeline-site-main", "Source"), 2),
+        ("ActionDuration", ("pipeline-site-main", "Source", "Source"), 8),
+        ("StageDuration", ("pipeline-site-main", "Source"), 9),
+        ("StageQueueTime", ("pipeline-site-main", "Build"), 4),
+        ("ActionDuration", ("pipeline-site-main", "Build", "Build"), 180),
+        ("StageDuration", ("pipeline-site-main", "Build"), 181),
+        ("StageQueueTime", ("pipeline-site-main", "Approve"), 4),
+        ("ActionDuration", ("pipeline-site-main", "Approve", "Approve"), 600),
+        ("ApprovalWait", ("pipeline-site-main",), 600),
+        ("StageDuration", ("pipeline-site-main", "Approve"), 601),
+        ("ExecutionSucceeded", ("pipeline-site-main",), 1),
+        ("ExecutionFailed", ("pipeline-site-main",), 0),
+        ("ExecutionDuration", ("pipeline-site-main",), 810),
+    ]
+
+
+def test_events_out_of_order_give_the_same_durations():
+    in_order = metric_values(replay(recorded_events("execution")))
+    out_of_order = metric_values(replay(recorded_events("out_of_order")))
+
+    # the Source stage's finish got there before its start, so its queue time isn't known
+    assert sorted(out_of_order) == sorted(
+        value
+        for value in in_order
+        if value != ("StageQueueTime", ("pipeline-site-main", "Source"), 2)
+    )
+
+
+def test_a_late_start_is_published_at_the_finish():
+    records = replay(recorded_events("out_of_order"))
+    stage = next(
+        r for r in records if r.get("StageDuration") and r["Stage"] == "Source"
+    )
+    assert stage["_aws"]["Timestamp"] == (START + 11) * 1000
+    assert "State" not in stage
+
+
+def test_retried_execution_is_timed_from_the_retry():
+    values = metric_values(replay(recorded_events("retried")))
+    build = [
+        (name, value)
+        for name, dimensions, value in values
+        if dimensions[1:2] == ("Build",)
+    ]
+    assert build == [
+        ("StageQueueTime", 4),
+        ("ActionDuration", 60),
+        ("StageDuration", 61),
+        # the retry
+        ("ActionDuration", 120),
+        ("StageDuration", 122),
+    ]
+    executions = [
+        (name, value)
+        for name, dimensions, value in values
+        if name.startswith("Execution")
+    ]
+    assert executions == [
+        ("ExecutionSucceeded", 0),
+        ("ExecutionFailed", 1),
+        ("ExecutionDuration", 77),
+        ("ExecutionSucceeded", 1),
+        ("ExecutionFailed", 0),
+        ("ExecutionDuration", 250),
+    ]
+
+
+def test_state_store_transitions():
+    events = recorded_events("retried")
+    store = pipeline_telemetry.MemoryStore()
+    stage = "stage/" + RETRIED + "/Build"
+
+    replay(events[:6], store)
+    assert store.items == {
+        "execution/" + RETRIED: START + 3600,
+        "cursor/" + RETRIED: START + 3611,
+        "stage/" + RETRIED + "/Source": START + 3602,
+        "action/" + RETRIED + "/Source/Source": START + 3602,
+        stage: START + 3615,
+    }
+
+    # failing moves the cursor on, and leaves the start times alone
+    replay(events[6:10], store)
+    assert store.get("cursor/" + RETRIED) == START + 3676
+    assert store.get(stage) == START + 3615
+
+    # retrying restarts the execution and the stage
+    replay(events[10:12], store)
+    assert store.get("execution/" + RETRIED) == START + 5400
+    assert store.get(stage) == START + 5400
+    assert store.get("cursor/" + RETRIED) == START + 5400
+    assert not any(key.startswith("finished/") for key in store.items)
+
+
+def test_remembers_a_finish_until_its_start_arrives():
+    events = recorded_events("out_of_order")
+    store = pipeline_telemetry.MemoryStore()
+    stage = "stage/" + EXECUTION + "/Source"
+
+    # pipeline started, action started and succeeded, then the stage succeeded
+    assert metric_values(replay(events[:4], store))[-1:] == [
+        ("ActionDuration", ("pipeline-site-main", "Source", "Source"), 8)
+    ]
+    assert store.get("finished/" + stage) == START + 11
+    assert store.get(stage) is None
+
+    assert metric_values(replay(events[4:5], store)) == [
+        ("StageDuration", ("pipeline-site-main", "Source"), 9)
+    ]
+    # the late start doesn't move the cursor back
+    assert store.get("cursor/" + EXECUTION) == START + 11
+
+
+def test_ignores_other_pipelines():
+    event = recorded_events("execution")[0]
+    event["detail"]["pipeline"] = "someone-elses-pipeline"
+    store = pipeline_telemetry.MemoryStore()
+    assert pipeline_telemetry.process_event(event, store) == []
+    assert store.items == {}
+
+
+def test_dynamo_store():
+    store = pipeline_telemetry.DynamoStore("telemetry-state")
+    with Stubber(store.dynamodb) as dynamodb:
+        dynamodb.add_response(
+            "put_item",
+            {},
+            {
+                "TableName": "telemetry-state",
+                "Item": {
+                    "key": {"S": "execution/abc"},
+                    "value": {"N": "1614556800.0"},
+                    "expires_at": {"N": ANY},
+                },
+            },
+        )
+        dynamodb.add_response(
+            "get_item",
+            {"Item": {"key": {"S": "execution/abc"}, "value": {"N": "1614556800.0"}}},
+            {"TableName": "telemetry-state", "Key": {"key": {"S": "execution/abc"}}},
+        )
+        dynamodb.add_response(
+            "get_item",
+            {},
+            {"TableName": "telemetry-state", "Key": {"key": {"S": "missing"}}},
+        )
+
+        store.put("execution/abc", float(START))
+        assert store.get("execution/abc") == START
+        assert store.get("missing") is None
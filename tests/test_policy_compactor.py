@@ -0,0 +1,193 @@
+import pytest
+
+from stacks.policy_compactor import (
+    collapse_resources,
+    compact_statements,
+    plan_policies,
+    policy_size,
+)
+
+KMS = "arn:aws:kms:ap-southeast-2:111111111111:"
+CLOUDFORMATION = "arn:aws:cloudformation:ap-southeast-2:111111111111:"
+
+
+def allow(actions, resources, **extra):
+    return dict({"Effect": "Allow", "Action": actions, "Resource": resources}, **extra)
+
+
+def test_statements_for_the_same_resources_are_merged():
+    compacted = compact_statements(
+        [
+            allow("s3:GetObject", "arn:aws:s3:::bucket/*"),
+            allow("s3:PutObject", "arn:aws:s3:::bucket/*"),
+            allow("s3:PutObject", "arn:aws:s3:::other/*"),
+        ]
+    )
+    assert compacted == [
+        allow(["s3:GetObject", "s3:PutObject"], "arn:aws:s3:::bucket/*"),
+        allow("s3:PutObject", "arn:aws:s3:::other/*"),
+    ]
+
+
+def test_statements_for_the_same_actions_are_merged():
+    compacted = compact_statements(
+        [
+            allow(["s3:GetObject", "s3:PutObject"], "arn:aws:s3:::bucket/*"),
+            allow(["s3:PutObject", "s3:GetObject"], "arn:aws:s3:::other/*"),
+        ]
+    )
+    assert compacted == [
+        allow(
+            ["s3:GetObject", "s3:PutObject"],
+            ["arn:aws:s3:::bucket/*", "arn:aws:s3:::other/*"],
+        )
+    ]
+
+
+def test_statements_with_different_conditions_arent_merged():
+    condition = {"StringEquals": {"aws:PrincipalAccount": "222222222222"}}
+    compacted = compact_statements(
+        [
+            allow("s3:GetObject", "arn:aws:s3:::bucket/*"),
+            allow("s3:PutObject", "arn:aws:s3:::bucket/*", Condition=condition),
+        ]
+    )
+    assert len(compacted) == 2
+
+
+def test_statements_with_principals_are_passed_through():
+    statement = allow("kms:Decrypt", "*", Principal={"AWS": "222222222222"})
+    assert compact_statements([statement, statement]) == [statement, statement]
+
+
+def test_duplicates_and_values_covered_by_a_wildcard_are_dropped():
+    compacted = compact_statements(
+        [
+            allow(
+                ["s3:GetObject", "s3:getobject", "s3:Get*"],
+                [
+                    "arn:aws:s3:::bucket/a",
+                    "arn:aws:s3:::bucket/*",
+                    "arn:aws:s3:::bucket/*",
+                ],
+            )
+        ]
+    )
+    assert compacted == [allow("s3:Get*", "arn:aws:s3:::bucket/*")]
+
+
+def test_read_only_actions_collapse_to_their_verb():
+    compacted = compact_statements(
+        [
+            allow(
+                ["ec2:DescribeA", "ec2:DescribeB", "ec2:DescribeC", "ec2:RunInstances"],
+                "*",
+            )
+        ]
+    )
+    assert compacted == [allow(["ec2:Describe*", "ec2:RunInstances"], "*")]
+
+
+def test_resources_arent_collapsed_under_the_limit():
+    resources = ["arn:aws:s3:::myapp-%d" % i for i in range(10)]
+    assert collapse_resources(resources, 10, 4) == resources
+
+
+def test_resources_are_never_collapsed_without_a_limit():
+    resources = ["arn:aws:s3:::myapp-%d" % i for i in range(50)]
+    assert collapse_resources(resources, None, 4) == resources
+
+
+def test_resources_collapse_to_their_common_prefix():
+    resources = ["arn:aws:s3:::myapp-%d" % i for i in range(11)]
+    assert collapse_resources(resources, 10, 4) == ["arn:aws:s3:::myapp-*"]
+
+
+def test_collapsing_keeps_a_common_suffix():
+    resources = ["arn:aws:s3:::myapp-%d/*" % i for i in range(11)]
+    assert collapse_resources(resources, 10, 4) == ["arn:aws:s3:::myapp-*/*"]
+
+
+def test_resources_with_a_short_common_prefix_arent_collapsed():
+    resources = ["arn:aws:s3:::my%d" % i for i in range(11)]
+    assert collapse_resources(resources, 10, 4) == sorted(resources)
+
+
+def test_the_resource_type_doesnt_count_towards_the_prefix():
+    stacks = [
+        CLOUDFORMATION + "stack/%s/id-%d" % (name, i)
+        for i, name in enumerate("abcdefghijk")
+    ]
+    assert collapse_resources(stacks, 10, 4) == sorted(stacks)
+
+    roles = ["arn:aws:iam::111111111111:role/r%d" % i for i in range(11)]
+    assert collapse_resources(roles, 10, 4) == sorted(roles)
+
+    named = [CLOUDFORMATION + "stack/myapp-%d/*" % i for i in range(11)]
+    assert collapse_resources(named, 10, 4) == [CLOUDFORMATION + "stack/myapp-*/*"]
+
+
+def test_kms_keys_are_never_collapsed():
+    keys = [KMS + "key/1234abcd-0000-0000-0000-%012d" % i for i in range(11)]
+    assert collapse_resources(keys, 10, 4) == sorted(keys)
+
+    compacted = compact_statements([allow("kms:Decrypt", key) for key in keys])
+    assert compacted == [allow("kms:Decrypt", sorted(keys))]
+
+
+def test_resources_of_different_kinds_are_collapsed_separately():
+    resources = ["arn:aws:s3:::myapp-%d" % i for i in range(6)] + [
+        "arn:aws:s3:::other-%d" % i for i in range(6)
+    ]
+    assert collapse_resources(resources, 10, 4) == sorted(resources)
+
+    buckets = ["arn:aws:s3:::myapp-%d" % i for i in range(6)]
+    tables = [
+        "arn:aws:dynamodb:ap-southeast-2:111111111111:table/myapp-%d" % i
+        for i in range(6)
+    ]
+    assert collapse_resources(buckets + tables, 10, 4) == [
+        "arn:aws:dynamodb:ap-southeast-2:111111111111:table/myapp-*",
+        "arn:aws:s3:::myapp-*",
+    ]
+
+
+def test_collapsing_can_be_turned_off():
+    resources = ["arn:aws:s3:::myapp-%d" % i for i in range(11)]
+    compacted = compact_statements([allow("s3:GetObject", resources)], collapse=False)
+    assert compacted == [allow("s3:GetObject", sorted(resources))]
+
+
+def statements_of_size(count, size):
+    statements = []
+    for i in range(count):
+        statement = allow("s3:GetObject", "arn:aws:s3:::b%d-" % i)
+        statement["Resource"] += "x" * (size - policy_size([statement]))
+        statements.append(statement)
+    return statements
+
+
+def test_statements_that_fit_stay_inline():
+    statements = statements_of_size(3, 1000)
+    inline, managed = plan_policies(statements)
+    assert len(inline) == 3
+    assert managed == []
+
+
+def test_statements_spill_into_managed_policies():
+    statements = statements_of_size(5, 3500)
+    inline, managed = plan_policies(statements)
+    assert len(inline) == 2
+    assert [len(p) for p in managed] == [1, 1, 1]
+    assert all(policy_size(p) <= 6144 for p in managed)
+    assert sorted(map(str, inline + sum(managed, []))) == sorted(map(str, statements))
+
+
+def test_too_many_managed_policies_is_an_error():
+    with pytest.raises(ValueError, match="managed policies"):
+        plan_policies(statements_of_size(10, 3500), max_managed=3)
+
+
+def test_a_statement_too_big_for_a_managed_policy_is_an_error():
+    with pytest.raises(ValueError, match="too big"):
+        plan_policies(statements_of_size(1, 7000), inline_limit=1000)
@@ -0,0 +1,204 @@
+import json
+
+import pytest
+
+from conftest import fixture_path
+from tools import template_preflight
+from tools.template_preflight import check_template
+
+
+def template(resources=None, **sections):
+    return json.dumps(
+        dict(
+            {"Resources": resources or {"Topic": {"Type": "AWS::SNS::Topic"}}},
+            **sections
+        )
+    )
+
+
+def output(value):
+    return {"Outputs": {"Value": {"Value": value}}}
+
+
+def sam_template():
+    with open(fixture_path("template_preflight", "sam.yaml")) as f:
+        return f.read()
+
+
+def test_a_good_template_passes():
+    result = check_template(
+        template(
+            Parameters={"Environment": {"Type": "String", "Default": "staging"}},
+            **output({"Fn::Sub": "${Topic}-${Environment}-${AWS::Region}"})
+        )
+    )
+    assert result.ok
+    assert result.warnings == []
+
+
+@pytest.mark.parametrize(
+    "value, error",
+    [
+        ({"Ref": "Missing"}, "Ref to unknown parameter or resource 'Missing'"),
+        (
+            {"Fn::GetAtt": ["Missing", "Arn"]},
+            "Fn::GetAtt on unknown resource 'Missing'",
+        ),
+        ({"Fn::GetAtt": "Missing.Arn"}, "Fn::GetAtt on unknown resource 'Missing'"),
+        ({"Fn::Sub": "${Missing}"}, "Fn::Sub references unknown variable 'Missing'"),
+        (
+            {"Fn::Sub": ["${Name}-${Missing}", {"Name": "x"}]},
+            "Fn::Sub references unknown variable 'Missing'",
+        ),
+    ],
+)
+def test_undefined_targets_are_errors(value, error):
+    result = check_template(template(**output(value)))
+    assert result.errors == ["Outputs/Value/Value: " + error]
+
+
+def test_sub_can_use_its_own_variables_attributes_and_literals():
+    result = check_template(
+        template(
+            **output(
+                {"Fn::Sub": ["${Name}-${Topic.TopicName}-${!Literal}", {"Name": "x"}]}
+            )
+        )
+    )
+    assert result.ok
+
+
+def test_depends_on_and_conditions_must_exist():
+    result = check_template(
+        template(
+            {
+                "Topic": {
+                    "Type": "AWS::SNS::Topic",
+                    "DependsOn": "Missing",
+                    "Condition": "IsProd",
+                }
+            }
+        )
+    )
+    assert result.errors == [
+        "Resources/Topic: DependsOn unknown resource 'Missing'",
+        "Resources/Topic: unknown condition 'IsProd'",
+    ]
+
+
+def test_a_required_parameter_needs_an_override():
+    body = template(
+        Parameters={
+            "Environment": {"Type": "String"},
+            "Size": {"Type": "Number", "Default": 1},
+        }
+    )
+    assert check_template(body).errors == [
+        "Parameter 'Environment' has no default and no override was supplied"
+    ]
+    assert check_template(body, parameters={"Environment": "staging"}).ok
+
+
+def test_overrides_must_be_declared_and_allowed():
+    body = template(
+        Parameters={
+            "Environment": {
+                "Type": "String",
+                "AllowedValues": ["staging", "prod"],
+            },
+            "Name": {"Type": "String", "Default": "a", "AllowedPattern": "[a-z]+"},
+        }
+    )
+    result = check_template(
+        body, parameters={"Environment": "dev", "Name": "A1", "Other": "x"}
+    )
+    assert result.errors == [
+        "Parameter 'Environment' value 'dev' is not one of staging, prod",
+        "Parameter 'Name' value 'A1' does not match [a-z]+",
+        "Parameter override 'Other' is not declared in the template"
+        " (declared: Environment, Name)",
+    ]
+
+
+def test_iam_resources_need_capability_iam():
+    body = template({"Role": {"Type": "AWS::IAM::Role", "Properties": {}}})
+    assert check_template(body).errors == [
+        "CAPABILITY_IAM is required because the template creates IAM resources"
+    ]
+    assert check_template(body, capabilities=["CAPABILITY_IAM"]).ok
+    assert check_template(body, capabilities=["CAPABILITY_NAMED_IAM"]).ok
+
+
+def test_named_iam_resources_need_capability_named_iam():
+    body = template(
+        {"Role": {"Type": "AWS::IAM::Role", "Properties": {"RoleName": "named"}}}
+    )
+    assert check_template(body, capabilities=["CAPABILITY_IAM"]).errors == [
+        "CAPABILITY_NAMED_IAM is required for named IAM resources: Role"
+    ]
+    assert check_template(body, capabilities=["CAPABILITY_NAMED_IAM"]).ok
+
+
+def test_a_transform_needs_capability_auto_expand():
+    result = check_template(sam_template(), parameters={"Environment": "staging"})
+    assert result.errors == [
+        "CAPABILITY_AUTO_EXPAND is required because the template uses a Transform"
+    ]
+
+
+def test_references_to_what_the_sam_transform_creates_are_only_warnings():
+    result = check_template(
+        sam_template(),
+        parameters={"Environment": "staging"},
+        capabilities=["CAPABILITY_AUTO_EXPAND"],
+    )
+    assert result.ok
+    assert result.warnings == [
+        "Outputs/Role/Value: Fn::GetAtt on unknown resource 'FunctionRole'",
+        "Outputs/Url/Value: Fn::Sub references unknown variable 'ServerlessRestApi'",
+    ]
+
+
+def test_the_same_references_without_a_transform_are_errors():
+    body = template(
+        **output({"Fn::Sub": "${ServerlessRestApi}"}),
+        Parameters={"Environment": {"Type": "String", "Default": "staging"}}
+    )
+    assert check_template(body).errors == [
+        "Outputs/Value/Value: Fn::Sub references unknown variable 'ServerlessRestApi'"
+    ]
+
+
+def test_unknown_sections_and_bad_resources_are_errors():
+    result = check_template(template({"bad-id": {"Type": "NotAType"}}, Extra={}))
+    assert result.errors == [
+        "Unknown top-level section 'Extra'",
+        "Resources/bad-id: logical IDs must be alphanumeric",
+        "Resources/bad-id: invalid or missing Type 'NotAType'",
+    ]
+
+
+def test_a_template_that_cant_be_parsed_is_an_error():
+    result = check_template("Resources: [")
+    assert not result.ok
+    assert result.errors[0].startswith("Template is not valid JSON or YAML")
+
+
+def test_main_exits_non_zero_on_errors(capsys):
+    path = fixture_path("template_preflight", "sam.yaml")
+    assert template_preflight.main([path]) == 1
+    assert "ERROR: Parameter 'Environment'" in capsys.readouterr().out
+
+    assert (
+        template_preflight.main(
+            [
+                path,
+                "--parameter",
+                "Environment=prod",
+                "--capabilities",
+                "CAPABILITY_IAM,CAPABILITY_AUTO_EXPAND",
+            ]
+        )
+        == 0
+    )
+    assert "Pre-flight checks passed" in capsys.readouterr().out
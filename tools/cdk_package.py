@@ -0,0 +1,224 @@
+"""Packages a synthesized CDK stack for a CloudFormation pipeline.
+
+`cdk synth` names each template in the cloud assembly after the stack's
+construct id, which isn't always the CloudFormation stack name the pipeline
+deploys, so this finds the stack in the assembly's manifest.json by either.
+Then, like `sam package`, it uploads the stack's assets (Lambda code and the
+like) to the package bucket and writes a template that refers to them, as
+there's no `cdk deploy` to publish them.
+
+CDK's legacy synthesis passes each asset's location in as parameters
+(AssetParameters...S3Bucket and S3VersionKey). Those are resolved into the
+template, so it refers to s3://<bucket>/<prefix>/<hash>.zip the same way a
+SAM template does, and the deployment bake can keep a copy of each. Stacks
+synthesized the new style, with their assets in the target account's CDK
+bootstrap bucket, and Docker image assets aren't supported.
+
+In a build:
+
+    cdk synth -o cdk.out --quiet
+    python3 -m tools.cdk_package cdk.out my-stack --output packaged.yaml
+
+The bucket and prefix default to $PACKAGE_BUCKET and $PACKAGE_PREFIX. Only
+depends on the standard library, and boto3 for the upload.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+STACK_ARTIFACT = "aws:cloudformation:stack"
+ASSET_MANIFEST_ARTIFACT = "cdk:asset-manifest"
+ASSET_METADATA = "aws:cdk:asset"
+# CDK passes an asset's key as <prefix>||<file name>
+KEY_SEPARATOR = "||"
+
+
+def load_artifacts(assembly_dir):
+    with open(os.path.join(assembly_dir, "manifest.json")) as f:
+        return json.load(f).get("artifacts", {})
+
+
+def find_stack(artifacts, stack_name):
+    """The artifact id of the stack with this CloudFormation name or construct id."""
+    stacks = {
+        id: artifact
+        for id, artifact in artifacts.items()
+        if artifact.get("type") == STACK_ARTIFACT
+    }
+    for id, artifact in stacks.items():
+        if artifact.get("properties", {}).get("stackName", id) == stack_name:
+            return id
+    if stack_name in stacks:
+        return stack_name
+    raise ValueError(
+        "There's no stack called "
+        + stack_name
+        + " in the cloud assembly (it has "
+        + (", ".join(sorted(stacks)) or "none")
+        + ")"
+    )
+
+
+def stack_assets(assembly_dir, artifacts, id):
+    """The legacy assets a stack's template takes as parameters."""
+    artifact = artifacts[id]
+    assets = []
+    for entries in artifact.get("metadata", {}).values():
+        for entry in entries:
+            if entry.get("type") == ASSET_METADATA:
+                assets.append(entry["data"])
+
+    for asset in assets:
+        if asset.get("packaging") not in ("zip", "file"):
+            raise ValueError(
+                id + " has a " + str(asset.get("packaging")) + " asset, which can't be"
+                " deployed by the pipeline"
+            )
+
+    # new style synthesis lists its assets in a manifest of their own, and the template
+    # refers to the CDK bootstrap bucket rather than taking parameters
+    for dependency in artifact.get("dependencies", []):
+        manifest = artifacts.get(dependency, {})
+        if manifest.get("type") != ASSET_MANIFEST_ARTIFACT:
+            continue
+        with open(os.path.join(assembly_dir, manifest["properties"]["file"])) as f:
+            published = json.load(f)
+        # the template itself is always listed
+        files = {
+            k: v
+            for k, v in published.get("files", {}).items()
+            if v.get("source", {}).get("path") != artifact["properties"]["templateFile"]
+        }
+        if files or published.get("dockerImages"):
+            raise ValueError(
+                id + " keeps its assets in the CDK bootstrap bucket, synthesize it with"
+                " LegacyStackSynthesizer so the pipeline can publish them"
+            )
+    return assets
+
+
+def asset_key(prefix, asset):
+    # what sam package does too, one object per version of the code
+    extension = ".zip"
+    if asset["packaging"] == "file":
+        extension = os.path.splitext(asset["path"])[1]
+    return (prefix.strip("/") + "/" if prefix else "") + asset["sourceHash"] + extension
+
+
+def resolve(node, values):
+    """Replace Refs to `values` with their value, then fold the Fn::Split, Fn::Select and
+    Fn::Join that CDK wraps asset parameters in, where all of their arguments are known.
+    """
+    if isinstance(node, list):
+        return [resolve(item, values) for item in node]
+    if not isinstance(node, dict):
+        return node
+    if len(node) == 1:
+        ((key, value),) = node.items()
+        if key == "Ref" and value in values:
+            return values[value]
+        value = resolve(value, values)
+        if key == "Fn::Split" and all(isinstance(v, str) for v in value):
+            return value[1].split(value[0])
+        if key == "Fn::Select" and isinstance(value[1], list):
+            return value[1][int(value[0])]
+        if key == "Fn::Join" and all(isinstance(v, str) for v in value[1]):
+            return value[0].join(value[1])
+        return {key: value}
+    return {key: resolve(value, values) for key, value in node.items()}
+
+
+def package_stack(assembly_dir, stack_name, bucket, prefix, upload):
+    """Upload the stack's assets with `upload(path, key)`, returning its packaged template."""
+    artifacts = load_artifacts(assembly_dir)
+    id = find_stack(artifacts, stack_name)
+    template_file = artifacts[id]["properties"]["templateFile"]
+    with open(os.path.join(assembly_dir, template_file)) as f:
+        template = json.load(f)
+
+    values = {}
+    for asset in stack_assets(assembly_dir, artifacts, id):
+        if upload is None:
+            raise ValueError(id + " has assets, so needs a bucket to upload them to")
+        key = asset_key(prefix, asset)
+        upload(os.path.join(assembly_dir, asset["path"]), key)
+        directory, _, name = key.rpartition("/")
+        values[asset["s3BucketParameter"]] = bucket
+        values[asset["s3KeyParameter"]] = (
+            (directory + "/" if directory else "") + KEY_SEPARATOR + name
+        )
+        values[asset["artifactHashParameter"]] = asset["sourceHash"]
+
+    if not values:
+        return template
+    for name in values:
+        template.get("Parameters", {}).pop(name, None)
+    if not template.get("Parameters", True):
+        del template["Parameters"]
+    return resolve(template, values)
+
+
+def s3_uploader(bucket, s3=None):
+    if s3 is None:
+        import boto3
+
+        s3 = boto3.client("s3")
+
+    def upload(path, key):
+        # assets are named after the hash of their contents, so one that's there is up to date
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+            print("Already uploaded s3://" + bucket + "/" + key)
+            return
+        except s3.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                raise
+        if os.path.isdir(path):
+            with tempfile.TemporaryDirectory() as temp:
+                archive = shutil.make_archive(os.path.join(temp, "asset"), "zip", path)
+                s3.upload_file(archive, bucket, key)
+        else:
+            s3.upload_file(path, bucket, key)
+        print("Uploaded " + path + " to s3://" + bucket + "/" + key)
+
+    return upload
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Publish a synthesized CDK stack's assets and write its packaged template."
+    )
+    parser.add_argument("assembly", help="the cloud assembly directory, eg cdk.out")
+    parser.add_argument("stack", help="the stack's CloudFormation name or construct id")
+    parser.add_argument(
+        "--output", default="packaged.yaml", help="where to write the template"
+    )
+    parser.add_argument("--bucket", default=os.environ.get("PACKAGE_BUCKET"))
+    parser.add_argument("--prefix", default=os.environ.get("PACKAGE_PREFIX", ""))
+    args = parser.parse_args(argv)
+
+    try:
+        template = package_stack(
+            args.assembly,
+            args.stack,
+            args.bucket,
+            args.prefix,
+            s3_uploader(args.bucket) if args.bucket else None,
+        )
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+    # JSON is YAML too, and it's what CloudFormation gets from cdk deploy
+    with open(args.output, "w") as f:
+        json.dump(template, f, indent=1)
+    print("Packaged " + args.stack + " as " + args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
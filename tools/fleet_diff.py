@@ -0,0 +1,438 @@
+"""Works out which of a fleet's stacks actually need deploying after a change.
+
+A change to a shared stack file, eg stacks/cloudformation_pipeline_stack.py,
+might change every pipeline stack's template or none of them. This compares
+freshly synthesized templates with the templates last deployed (or last
+recorded in a state file) and lists only the stacks whose templates changed,
+or are new, in the order they need deploying.
+
+Templates are compared by a hash of their normalized JSON, so key order and
+the metadata CDK adds (construct paths, CDKMetadata, the bootstrap version
+check) don't count as changes. Asset parameters do, as their names change
+when the code they point at does.
+
+Stacks are ordered so that anything a stack imports (with Fn::ImportValue or
+an SSM parameter) or depends on in the cloud assembly is deployed before it,
+and otherwise create-pipeline-infra before pipelines before everything else.
+Stacks in the same wave don't depend on each other, so can be deployed at
+the same time.
+
+Usage, with any number of cloud assemblies (eg one `cdk synth -o` per pipeline):
+
+    python -m tools.fleet_diff cdk.out/* --state fleet-state.json
+    python -m tools.fleet_diff cdk.out/* --state fleet-state.json --record   # after deploying
+    python -m tools.fleet_diff cdk.out/* --deployed --profile 222222222222=target
+
+With --deployed the deployed templates are fetched with GetTemplate, using the
+default credentials or --profile for each account. A stack whose template
+can't be fetched is counted as changed. --names-only prints just the stack
+names, in order, one per line.
+
+Only depends on the standard library, and boto3 for --deployed.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from tools.template_preflight import parse_template
+
+STACK_ARTIFACT = "aws:cloudformation:stack"
+SSM_PARAMETER_TYPE = "AWS::SSM::Parameter::Value<"
+
+# added by CDK, and changes with the CDK version rather than the stack
+VOLATILE_RESOURCES = ("CDKMetadata",)
+VOLATILE_CONDITIONS = ("CDKMetadataAvailable",)
+VOLATILE_PARAMETERS = ("BootstrapVersion",)
+VOLATILE_RULES = ("CheckBootstrapVersion",)
+VOLATILE_METADATA = ("aws:cdk:path", "aws:asset:path", "aws:asset:property")
+
+# when nothing else decides it, stacks are deployed in this order (by the start of their name)
+STACK_ORDER = (
+    "create-repo-",
+    "create-shared-pipeline-infra-",
+    "create-pipeline-infra-",
+    "create-cross-account-role-",
+    "parameter-stack-",
+    "s3-create-pipeline-",
+    "cf-create-pipeline-",
+    "branch-pipelines-",
+)
+
+
+def normalize_template(template):
+    template = json.loads(json.dumps(template))
+    for section, names in (
+        ("Resources", VOLATILE_RESOURCES),
+        ("Conditions", VOLATILE_CONDITIONS),
+        ("Parameters", VOLATILE_PARAMETERS),
+        ("Rules", VOLATILE_RULES),
+    ):
+        for name in names:
+            template.get(section, {}).pop(name, None)
+        if section in template and not template[section]:
+            del template[section]
+
+    for resource in template.get("Resources", {}).values():
+        metadata = resource.get("Metadata")
+        if isinstance(metadata, dict):
+            for key in VOLATILE_METADATA:
+                metadata.pop(key, None)
+            if not metadata:
+                del resource["Metadata"]
+    return template
+
+
+def template_hash(template):
+    canonical = json.dumps(
+        normalize_template(template), sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _literal(value):
+    # export and parameter names are usually plain strings, or a join of them
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict) and "Fn::Join" in value:
+        separator, parts = value["Fn::Join"]
+        parts = [_literal(p) for p in parts]
+        if all(p is not None for p in parts):
+            return separator.join(parts)
+    return None
+
+
+def _walk(node):
+    yield node
+    if isinstance(node, dict):
+        for value in node.values():
+            yield from _walk(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _walk(value)
+
+
+class Stack:
+    def __init__(self, name, environment, template, dependencies=()):
+        self.name = name
+        self.environment = environment
+        self.template = template
+        self.dependencies = set(dependencies)
+        self.hash = template_hash(template)
+
+    @property
+    def account(self):
+        return self.environment.split("/")[2] if self.environment else None
+
+    @property
+    def region(self):
+        return self.environment.split("/")[3] if self.environment else None
+
+    def exports(self):
+        names = set()
+        for output in self.template.get("Outputs", {}).values():
+            name = _literal(output.get("Export", {}).get("Name"))
+            if name:
+                names.add(name)
+        for resource in self.template.get("Resources", {}).values():
+            if resource.get("Type") == "AWS::SSM::Parameter":
+                name = _literal(resource.get("Properties", {}).get("Name"))
+                if name:
+                    names.add("ssm:" + name)
+        return names
+
+    def imports(self):
+        names = set()
+        for node in _walk(self.template.get("Resources", {})):
+            if isinstance(node, dict) and "Fn::ImportValue" in node:
+                name = _literal(node["Fn::ImportValue"])
+                if name:
+                    names.add(name)
+        for name, parameter in self.template.get("Parameters", {}).items():
+            # the bootstrap version comes from the bootstrap stack, not one of ours
+            if name in VOLATILE_PARAMETERS:
+                continue
+            if str(parameter.get("Type", "")).startswith(SSM_PARAMETER_TYPE):
+                names.add("ssm:" + str(parameter.get("Default")))
+        return names
+
+
+def load_assembly(path):
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    artifacts = manifest.get("artifacts", {})
+    stacks = []
+    for id, artifact in artifacts.items():
+        if artifact.get("type") != STACK_ARTIFACT:
+            continue
+        properties = artifact.get("properties", {})
+        with open(os.path.join(path, properties["templateFile"])) as f:
+            template = json.load(f)
+        # dependencies on asset manifests and the like don't order deployments
+        dependencies = [
+            artifacts[d].get("properties", {}).get("stackName", d)
+            for d in artifact.get("dependencies", [])
+            if artifacts.get(d, {}).get("type") == STACK_ARTIFACT
+        ]
+        stacks.append(
+            Stack(
+                properties.get("stackName", id),
+                artifact.get("environment"),
+                template,
+                dependencies,
+            )
+        )
+    return stacks
+
+
+def load_stacks(paths):
+    stacks = {}
+    for path in paths:
+        for stack in load_assembly(path):
+            # the same stack synthesized into more than one assembly, eg a shared infra stack
+            existing = stacks.get((stack.environment, stack.name))
+            if existing and existing.hash != stack.hash:
+                raise ValueError(
+                    stack.name
+                    + " is synthesized differently in two of the assemblies, check their context matches"
+                )
+            stacks[(stack.environment, stack.name)] = stack
+    return list(stacks.values())
+
+
+def state_key(stack):
+    return stack.environment + "/" + stack.name if stack.environment else stack.name
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def record_state(path, stacks, state=None):
+    state = dict(state or {})
+    for stack in stacks:
+        state[state_key(stack)] = stack.hash
+    with open(path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+        f.write("\n")
+    return state
+
+
+def deployed_hashes(stacks, profiles=None):
+    """Hash the deployed template of each stack, None where it can't be fetched. Stacks
+    that haven't been deployed yet are left out, so count as new."""
+    import boto3
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    profiles = profiles or {}
+    sessions = {}
+    hashes = {}
+    for stack in stacks:
+        account = stack.account
+        if account not in sessions:
+            sessions[account] = boto3.Session(profile_name=profiles.get(account))
+        try:
+            body = (
+                sessions[account]
+                .client("cloudformation", region_name=stack.region)
+                .get_template(StackName=stack.name, TemplateStage="Original")[
+                    "TemplateBody"
+                ]
+            )
+        except ClientError as e:
+            if "does not exist" in e.response["Error"]["Message"]:
+                continue
+            print("Couldn't get " + stack.name + ": " + str(e), file=sys.stderr)
+            hashes[state_key(stack)] = None
+            continue
+        except BotoCoreError as e:
+            print("Couldn't get " + stack.name + ": " + str(e), file=sys.stderr)
+            hashes[state_key(stack)] = None
+            continue
+        # boto3 hands back JSON templates already parsed
+        if isinstance(body, str):
+            body = parse_template(body)
+        hashes[state_key(stack)] = template_hash(body)
+    return hashes
+
+
+def _rank(name):
+    for index, prefix in enumerate(STACK_ORDER):
+        if name.startswith(prefix):
+            return index
+    return len(STACK_ORDER)
+
+
+def deploy_waves(stacks, deploy):
+    """Order the stacks being deployed into waves, each only depending on earlier ones."""
+    exporters = {}
+    for stack in stacks:
+        for name in stack.exports():
+            exporters.setdefault((stack.environment, name), set()).add(stack)
+
+    names = {s.name for s in deploy}
+    depends_on = {}
+    for stack in deploy:
+        needs = {
+            exporter.name
+            for name in stack.imports()
+            for exporter in exporters.get((stack.environment, name), ())
+        } | stack.dependencies
+        # anything not being deployed is already there
+        depends_on[stack.name] = (needs & names) - {stack.name}
+
+    waves = []
+    remaining = dict(depends_on)
+    while remaining:
+        done = {name for wave in waves for name in wave}
+        ready = sorted(
+            (name for name, needs in remaining.items() if needs <= done),
+            key=lambda n: (_rank(n), n),
+        )
+        if not ready:
+            raise ValueError(
+                "These stacks depend on each other: " + ", ".join(sorted(remaining))
+            )
+        # keep the name order within dependencies too, eg all the infra before any pipelines
+        rank = _rank(ready[0])
+        wave = [name for name in ready if _rank(name) == rank]
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+    return waves
+
+
+def diff(stacks, previous):
+    """Compare stacks with the previous hashes, returning the report."""
+    changed, new, unchanged, unknown = [], [], [], []
+    for stack in stacks:
+        key = state_key(stack)
+        if key not in previous:
+            new.append(stack)
+        elif previous[key] is None:
+            unknown.append(stack)
+        elif previous[key] != stack.hash:
+            changed.append(stack)
+        else:
+            unchanged.append(stack)
+
+    current = {state_key(s) for s in stacks}
+    deploy = changed + new + unknown
+    return {
+        "changed": sorted(s.name for s in changed),
+        "new": sorted(s.name for s in new),
+        "unknown": sorted(s.name for s in unknown),
+        "unchanged": len(unchanged),
+        # in the state but not synthesized, these might need destroying
+        "missing": sorted(k for k in previous if k not in current),
+        "waves": deploy_waves(stacks, deploy),
+    }
+
+
+def print_report(report, out=sys.stdout):
+    print(
+        "%d changed, %d new, %d unknown, %d unchanged"
+        % (
+            len(report["changed"]),
+            len(report["new"]),
+            len(report["unknown"]),
+            report["unchanged"],
+        ),
+        file=out,
+    )
+    for name in report["missing"]:
+        print("Not synthesized any more: " + name, file=out)
+    if not report["waves"]:
+        print("Nothing to deploy", file=out)
+        return
+
+    print(file=out)
+    for index, wave in enumerate(report["waves"]):
+        print("Wave %d:" % (index + 1), file=out)
+        for name in wave:
+            reason = "new" if name in report["new"] else "changed"
+            if name in report["unknown"]:
+                reason = "couldn't compare"
+            print("  " + name + " (" + reason + ")", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="List the stacks whose synthesized templates changed, in the order to deploy them."
+    )
+    parser.add_argument(
+        "assemblies", nargs="+", help="cloud assembly directories, eg cdk.out"
+    )
+    parser.add_argument(
+        "--state", help="a JSON file of the template hashes last deployed"
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="save the synthesized templates' hashes to the state file",
+    )
+    parser.add_argument(
+        "--deployed",
+        action="store_true",
+        help="compare with the deployed templates rather than a state file",
+    )
+    parser.add_argument(
+        "--profile",
+        action="append",
+        default=[],
+        metavar="ACCOUNT=PROFILE",
+        help="the AWS profile to fetch an account's templates with (repeatable)",
+    )
+    parser.add_argument(
+        "--names-only",
+        action="store_true",
+        help="print only the names of the stacks to deploy, in order",
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if bool(args.state) == args.deployed:
+        parser.error("compare with either --state or --deployed")
+    if args.record and not args.state:
+        parser.error("--record needs a --state file")
+
+    profiles = {}
+    for mapping in args.profile:
+        account, separator, profile = mapping.partition("=")
+        if not separator:
+            parser.error("--profile takes ACCOUNT=PROFILE, not " + mapping)
+        profiles[account] = profile
+
+    stacks = load_stacks(args.assemblies)
+
+    if args.record:
+        record_state(args.state, stacks, load_state(args.state))
+        print("Recorded %d stacks in %s" % (len(stacks), args.state))
+        return 0
+
+    if args.deployed:
+        previous = deployed_hashes(stacks, profiles)
+    else:
+        previous = load_state(args.state)
+
+    report = diff(stacks, previous)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.names_only:
+        for wave in report["waves"]:
+            for name in wave:
+                print(name)
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""Counts the KMS requests made on behalf of pipeline artifact buckets.
+
+Every read and write of an SSE-KMS encrypted artifact costs a KMS request,
+unless the bucket uses an S3 Bucket Key, and a fleet-wide release can run into
+the per-account KMS request rate limit. This reads CloudTrail events, either
+CloudTrail log files ({"Records": [...]}), the output of
+`aws cloudtrail lookup-events`, or one event per line, and reports:
+
+- KMS requests per pipeline, split by operation
+- requests per pipeline run, when the pipelines' execution history is supplied
+  (the same exports tools.pipeline_run_analyzer reads)
+- the peak request rate per account and region, which is what gets throttled
+- which buckets are still making a KMS request per object rather than using a
+  bucket key
+
+Usage:
+
+    python -m tools.kms_request_report cloudtrail/ \\
+        --executions exports/ \\
+        --bucket <artifact-bucket>=pipeline-<reponame>-<branch>
+
+Requests are attributed to a pipeline by the S3 object they were made for:
+objects under a `pipeline-*` prefix (CodePipeline's own folder, which for
+pooled pipelines starts with a hash of the pipeline's name), or under
+the pipeline's own prefix in a pooled bucket (`packages/<pipeline>/`,
+`build-cache/<pipeline>/` or `releases/<pipeline>/`) belong to that
+pipeline. With a bucket key the request is only for the bucket, so use
+--bucket to say which pipeline a bucket belongs to.
+"""
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from stacks.pipeline_names import (
+    artifact_folder,
+    pooled_codepipeline_name,
+    unpooled_pipeline_name,
+)
+from tools.pipeline_run_analyzer import (
+    PIPELINE_PREFIX,
+    StreamingRecordReader,
+    find_export_files,
+    iter_records,
+    parse_time,
+    pipeline_for_path,
+    summarize,
+)
+
+CLOUDTRAIL_ARRAYS = ("Records", "Events")
+KMS_EVENT_SOURCE = "kms.amazonaws.com"
+S3_ARN_CONTEXT = "aws:s3:arn"
+S3_ARN_PREFIX = "arn:aws:s3:::"
+UNATTRIBUTED = "(unattributed)"
+# the parts of an artifact bucket that pipelines keep their objects in under a prefix of their own
+PIPELINE_OWNED_PREFIXES = ("packages", "build-cache", "releases")
+
+
+def iter_cloudtrail_events(path):
+    with open(path, encoding="utf-8") as fp:
+        for record in StreamingRecordReader(fp, array_keys=CLOUDTRAIL_ARRAYS):
+            # lookup-events wraps each event up as a string
+            if "CloudTrailEvent" in record:
+                record = json.loads(record["CloudTrailEvent"])
+            yield record
+
+
+def s3_object_for(event):
+    """(bucket, key) the request was made for, key is None when a bucket key was used."""
+    context = (event.get("requestParameters") or {}).get("encryptionContext") or {}
+    arn = context.get(S3_ARN_CONTEXT)
+    if not arn or not arn.startswith(S3_ARN_PREFIX):
+        return None, None
+    bucket, _, key = arn[len(S3_ARN_PREFIX) :].partition("/")
+    return bucket, key or None
+
+
+class PipelineRuns:
+    """Execution windows for each pipeline, to work out which run a request belongs to."""
+
+    def __init__(self):
+        self.windows = defaultdict(list)
+
+    def load(self, paths):
+        for path in find_export_files(paths):
+            path_pipeline = pipeline_for_path(path)
+            for record in iter_records(path):
+                pipeline = record.get("pipelineName") or path_pipeline
+                if pipeline:
+                    # pooled pipelines are reported under the name they were made from
+                    pipeline = unpooled_pipeline_name(pipeline)
+                start = parse_time(record.get("startTime"))
+                end = parse_time(record.get("lastUpdateTime"))
+                if pipeline and start is not None and "pipelineExecutionId" in record:
+                    self.windows[pipeline].append(
+                        (start, end or start, record["pipelineExecutionId"])
+                    )
+
+    def pipelines(self):
+        return set(self.windows)
+
+    def run_for(self, pipeline, timestamp):
+        # with parallel executions more than one may be running, pick the latest to start
+        matches = [
+            w for w in self.windows.get(pipeline, []) if w[0] <= timestamp <= w[1]
+        ]
+        if not matches:
+            return None
+        return max(matches)[2]
+
+
+class KmsRequestReport:
+    def __init__(self, bucket_pipelines=None, runs=None):
+        self.bucket_pipelines = bucket_pipelines or {}
+        self.runs = runs or PipelineRuns()
+        self.known_pipelines = self.runs.pipelines() | set(
+            unpooled_pipeline_name(p) for p in self.bucket_pipelines.values()
+        )
+        self.by_pipeline = defaultdict(lambda: defaultdict(int))
+        self.by_run = defaultdict(lambda: defaultdict(int))
+        self.per_second = defaultdict(lambda: defaultdict(int))
+        self.per_object_buckets = defaultdict(int)
+        self.bucket_key_buckets = defaultdict(int)
+        self.other_requests = 0
+
+    def pipeline_for(self, bucket, key):
+        if key:
+            parts = key.split("/", 2)
+            prefix = parts[0]
+            if prefix in PIPELINE_OWNED_PREFIXES and len(parts) > 2:
+                prefix = parts[1]
+            if prefix.startswith(PIPELINE_PREFIX):
+                name = unpooled_pipeline_name(prefix)
+                if name in self.known_pipelines:
+                    return name
+                # CodePipeline truncates the pipeline name for its artifact folder, and a pooled
+                # pipeline's CodePipeline name starts with a hash
+                matches = [
+                    p
+                    for p in self.known_pipelines
+                    if artifact_folder(p) == prefix
+                    or artifact_folder(pooled_codepipeline_name(p)) == prefix
+                ]
+                return matches[0] if len(matches) == 1 else prefix
+        return self.bucket_pipelines.get(bucket, UNATTRIBUTED)
+
+    def add_event(self, event):
+        if event.get("eventSource") != KMS_EVENT_SOURCE:
+            return
+        bucket, key = s3_object_for(event)
+        if bucket is None:
+            self.other_requests += 1
+            return
+
+        operation = event.get("eventName")
+        timestamp = parse_time(event.get("eventTime"))
+        pipeline = self.pipeline_for(bucket, key)
+
+        self.by_pipeline[pipeline][operation] += 1
+        if key:
+            self.per_object_buckets[bucket] += 1
+        else:
+            self.bucket_key_buckets[bucket] += 1
+
+        if timestamp is not None:
+            account_region = (
+                event.get("recipientAccountId", "?") + " " + event.get("awsRegion", "?")
+            )
+            self.per_second[account_region][int(timestamp)] += 1
+            run = self.runs.run_for(pipeline, timestamp)
+            if run:
+                self.by_run[pipeline][run] += 1
+
+    def report(self):
+        pipelines = {}
+        for pipeline, operations in sorted(self.by_pipeline.items()):
+            entry = {
+                "requests": sum(operations.values()),
+                "operations": dict(operations),
+            }
+            if self.by_run.get(pipeline):
+                entry["per_run"] = summarize(self.by_run[pipeline].values())
+            pipelines[pipeline] = entry
+
+        peaks = {}
+        for account_region, seconds in sorted(self.per_second.items()):
+            second, count = max(seconds.items(), key=lambda i: i[1])
+            peaks[account_region] = {"requests_per_second": count, "at": second}
+
+        return {
+            "requests": sum(p["requests"] for p in pipelines.values()),
+            "other_kms_requests": self.other_requests,
+            "pipelines": pipelines,
+            "peak_rate": peaks,
+            "buckets_without_bucket_key": dict(
+                sorted(self.per_object_buckets.items(), key=lambda i: -i[1])
+            ),
+            "buckets_with_bucket_key": dict(self.bucket_key_buckets),
+        }
+
+
+def print_report(report, out=sys.stdout):
+    print(
+        "KMS requests for artifact buckets: %d (%d other KMS requests)"
+        % (report["requests"], report["other_kms_requests"]),
+        file=out,
+    )
+
+    print("\nRequests by pipeline", file=out)
+    if not report["pipelines"]:
+        print("  (no data)", file=out)
+    width = max([len(name) for name in report["pipelines"]] + [8])
+    for name, entry in report["pipelines"].items():
+        per_run = entry.get("per_run")
+        print(
+            "  %-*s %8d  %s%s"
+            % (
+                width,
+                name,
+                entry["requests"],
+                ", ".join("%s %d" % o for o in sorted(entry["operations"].items())),
+                (
+                    "  (p50 %.0f, max %d per run over %d runs)"
+                    % (per_run["p50"], per_run["max"], per_run["count"])
+                    if per_run
+                    else ""
+                ),
+            ),
+            file=out,
+        )
+
+    print("\nPeak request rate", file=out)
+    for account_region, peak in report["peak_rate"].items():
+        print(
+            "  %s: %d/s at %s"
+            % (account_region, peak["requests_per_second"], _utc(peak["at"])),
+            file=out,
+        )
+
+    print("\nBuckets making a KMS request per object (no bucket key)", file=out)
+    if not report["buckets_without_bucket_key"]:
+        print("  (none)", file=out)
+    for bucket, count in report["buckets_without_bucket_key"].items():
+        print("  %-63s %8d" % (bucket, count), file=out)
+
+
+def _utc(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Count KMS requests per pipeline and per run from CloudTrail events."
+    )
+    parser.add_argument("paths", nargs="+", help="CloudTrail files or directories")
+    parser.add_argument(
+        "--executions",
+        action="append",
+        default=[],
+        help="list-pipeline-executions exports, to count requests per run",
+    )
+    parser.add_argument(
+        "--bucket",
+        action="append",
+        default=[],
+        metavar="BUCKET=PIPELINE",
+        help="the pipeline an artifact bucket belongs to",
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    bucket_pipelines = {}
+    for mapping in args.bucket:
+        bucket, separator, pipeline = mapping.partition("=")
+        if not separator:
+            parser.error("--bucket takes BUCKET=PIPELINE, not " + mapping)
+        bucket_pipelines[bucket] = pipeline
+
+    runs = PipelineRuns()
+    runs.load(args.executions)
+
+    analysis = KmsRequestReport(bucket_pipelines=bucket_pipelines, runs=runs)
+    for path in find_export_files(args.paths):
+        for event in iter_cloudtrail_events(path):
+            analysis.add_event(event)
+
+    report = analysis.report()
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
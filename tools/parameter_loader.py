@@ -0,0 +1,200 @@
+"""Loads a pipeline's Parameter Store parameters in as few calls as possible.
+
+Reading parameters one name at a time (`env.parameter-store` in a buildspec,
+or ssm:GetParameters with its 10 names per call) gets throttled when lots of
+pipelines build at once. This loads everything under the pipeline's path
+with paginated GetParametersByPath calls instead, backing off with jitter
+when it is throttled, and keeps the result in a local cache for a few minutes
+so later phases of the same build don't ask again.
+
+Parameters created by the parameter stack with `-c parameter_format=json`
+are a single JSON document, which is expanded into its keys.
+
+In a build (the pipeline stacks set PARAMETER_PATH when created with
+`-c load_parameters=true`):
+
+    eval "$(python3 -m tools.parameter_loader --format shell)"
+
+which exports each parameter as an environment variable named after its key,
+upper cased, eg /pipeline-myrepo-main/api_key becomes API_KEY.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shlex
+import sys
+import time
+
+# the name of the single parameter written by the parameter stack's json format
+PARAMETER_DOCUMENT = "parameters.json"
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "pipeline-parameters"
+)
+MAX_ATTEMPTS = 8
+BASE_DELAY_SECONDS = 0.2
+MAX_DELAY_SECONDS = 10
+THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException", "Throttling")
+
+
+def _is_throttled(error):
+    code = getattr(error, "response", {}).get("Error", {}).get("Code", "")
+    return code in THROTTLING_ERRORS or "Rate exceeded" in str(error)
+
+
+def with_backoff(call, max_attempts=MAX_ATTEMPTS, sleep=time.sleep):
+    """Call `call()`, retrying throttling errors with exponential backoff and full jitter."""
+    for attempt in range(max_attempts):
+        try:
+            return call()
+        except Exception as e:
+            if not _is_throttled(e) or attempt == max_attempts - 1:
+                raise
+            sleep(
+                random.uniform(
+                    0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2**attempt)
+                )
+            )
+
+
+def list_parameters(client, path, sleep=time.sleep):
+    """Every parameter under `path` as returned by SSM, keyed by its name relative to the path."""
+    path = "/" + path.strip("/")
+    parameters = {}
+    kwargs = {"Path": path, "Recursive": True, "WithDecryption": True}
+    while True:
+        page = with_backoff(
+            lambda: client.get_parameters_by_path(**kwargs), sleep=sleep
+        )
+        for parameter in page.get("Parameters", []):
+            parameters[parameter["Name"][len(path) + 1 :]] = parameter
+        if not page.get("NextToken"):
+            break
+        kwargs["NextToken"] = page["NextToken"]
+    return parameters
+
+
+def fetch_parameters(client, path, sleep=time.sleep):
+    """The value of every parameter under `path`, keyed by its name relative to the path."""
+    return expand_document(
+        {
+            name: parameter["Value"]
+            for name, parameter in list_parameters(client, path, sleep=sleep).items()
+        }
+    )
+
+
+def expand_document(parameters):
+    # a json document's keys are the parameters, anything stored separately wins
+    parameters = dict(parameters)
+    document = parameters.pop(PARAMETER_DOCUMENT, None)
+    if document:
+        merged = json.loads(document)
+        merged.update(parameters)
+        parameters = merged
+    return parameters
+
+
+def _cache_file(cache_dir, path):
+    return os.path.join(cache_dir, hashlib.sha256(path.encode()).hexdigest() + ".json")
+
+
+def cache_parameters(cache_dir, path, parameters):
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    cache_file = _cache_file(cache_dir, path)
+    # values can be secrets, so only we get to read the cache
+    fd = os.open(cache_file + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fp:
+        json.dump(parameters, fp)
+    os.replace(cache_file + ".tmp", cache_file)
+
+
+def load_parameters(
+    path,
+    client=None,
+    cache_dir=DEFAULT_CACHE_DIR,
+    ttl=DEFAULT_TTL_SECONDS,
+    sleep=time.sleep,
+):
+    cache_file = _cache_file(cache_dir, path) if cache_dir and ttl > 0 else None
+    if cache_file and os.path.exists(cache_file):
+        if time.time() - os.path.getmtime(cache_file) < ttl:
+            with open(cache_file) as fp:
+                return json.load(fp)
+
+    if client is None:
+        import boto3
+
+        client = boto3.client("ssm")
+    parameters = fetch_parameters(client, path, sleep=sleep)
+
+    if cache_file:
+        cache_parameters(cache_dir, path, parameters)
+    return parameters
+
+
+def variable_name(key, prefix=""):
+    return prefix + re.sub(r"[^A-Za-z0-9_]", "_", key).upper()
+
+
+def render(parameters, output_format, prefix=""):
+    if output_format == "json":
+        return json.dumps(parameters, indent=2, sort_keys=True)
+    lines = []
+    for key, value in sorted(parameters.items()):
+        name = variable_name(key, prefix)
+        if output_format == "shell":
+            lines.append("export %s=%s" % (name, shlex.quote(value)))
+        else:
+            lines.append("%s=%s" % (name, json.dumps(value)))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load a pipeline's parameters from Parameter Store with get-by-path."
+    )
+    parser.add_argument(
+        "--path",
+        default=os.environ.get("PARAMETER_PATH"),
+        help="the parameter path, eg /pipeline-<repo>-<branch> (default $PARAMETER_PATH)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("shell", "dotenv", "json"),
+        default="shell",
+        help="shell export statements, a .env file, or JSON",
+    )
+    parser.add_argument(
+        "--prefix",
+        default="",
+        help="prefix for the variable names, eg REACT_APP_",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        default=DEFAULT_TTL_SECONDS,
+        help="seconds to reuse cached values for, 0 to always fetch",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("PARAMETER_CACHE_DIR", DEFAULT_CACHE_DIR),
+    )
+    args = parser.parse_args(argv)
+
+    if not args.path:
+        parser.error("a parameter path is needed, pass --path or set PARAMETER_PATH")
+
+    parameters = load_parameters(args.path, cache_dir=args.cache_dir, ttl=args.ttl)
+    output = render(parameters, args.format, args.prefix)
+    if output:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""Syncs the parameters of many pipelines from one file, changing only what differs.
+
+The parameter stack is handy for a pipeline or two, but every change to it
+redeploys every parameter, one stack per pipeline. This reads the parameters
+for any number of pipelines from a JSON file:
+
+    {
+        "pipeline-myrepo-main": {"api_key": "abc", "user_pool": "ap-southeast-2_x"},
+        "pipeline-myrepo-develop": {"api_key": "def", "user_pool": null}
+    }
+
+compares them with what is already in Parameter Store (one get-by-path per
+pipeline) and works out what to create, update and, with --prune, delete. A
+null value means the parameter just has to exist: an existing value is left
+alone, and a missing one is created as "placeholder", like the parameter
+stack does.
+
+Nothing is changed unless --apply is given:
+
+    python -m tools.parameter_sync parameters.json            # show the plan
+    python -m tools.parameter_sync parameters.json --apply    # make the changes
+
+Use --format json to store each pipeline's parameters as the single JSON
+document written by the parameter stack's json format. Parameters managed
+this way shouldn't also be managed by a parameter stack, or the stack will
+put its values back the next time it is deployed.
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.parameter_loader import PARAMETER_DOCUMENT, list_parameters, with_backoff
+
+PLACEHOLDER = "placeholder"
+PARAMETER_FORMATS = ("hierarchy", "json")
+# DeleteParameters takes at most 10 names per call
+DELETE_BATCH_SIZE = 10
+STANDARD_PARAMETER_LIMIT = 4096
+# PutParameter has no batch call, so a few are made at once and throttling is left to the backoff
+DEFAULT_CONCURRENCY = 4
+
+
+class Change:
+    __slots__ = ("action", "name", "value", "type", "tier")
+
+    def __init__(self, action, name, value=None, type="String", tier="Standard"):
+        self.action = action
+        self.name = name
+        self.value = value
+        self.type = type
+        self.tier = tier
+
+    def __repr__(self):
+        return "%s %s" % (self.action, self.name)
+
+
+def parameter_path(pipeline):
+    return "/" + pipeline.strip("/")
+
+
+def parameter_tier(value, current=None):
+    # the limit is in bytes, and SSM won't turn an advanced parameter back into a standard one
+    if current == "Advanced" or len(value.encode("utf-8")) > STANDARD_PARAMETER_LIMIT:
+        return "Advanced"
+    return "Standard"
+
+
+def list_tiers(client, path, sleep=time.sleep):
+    """The tier of every parameter under `path`, keyed by its name relative to the path."""
+    tiers = {}
+    kwargs = {
+        "ParameterFilters": [{"Key": "Path", "Option": "Recursive", "Values": [path]}]
+    }
+    while True:
+        page = with_backoff(lambda: client.describe_parameters(**kwargs), sleep=sleep)
+        for parameter in page.get("Parameters", []):
+            tiers[parameter["Name"][len(path) + 1 :]] = parameter.get("Tier")
+        if not page.get("NextToken"):
+            break
+        kwargs["NextToken"] = page["NextToken"]
+    return tiers
+
+
+def desired_parameters(values, existing, parameter_format):
+    """The relative names and values we want, resolving nulls against what exists."""
+    if parameter_format == "json":
+        current = {}
+        if PARAMETER_DOCUMENT in existing:
+            current = json.loads(existing[PARAMETER_DOCUMENT]["Value"])
+        document = {
+            key: (current.get(key, PLACEHOLDER) if value is None else str(value))
+            for key, value in values.items()
+        }
+        return {PARAMETER_DOCUMENT: json.dumps(document, sort_keys=True)}
+
+    return {
+        key: (
+            existing[key]["Value"]
+            if value is None and key in existing
+            else PLACEHOLDER if value is None else str(value)
+        )
+        for key, value in values.items()
+    }
+
+
+def _same(name, current, wanted):
+    # documents are compared by content, so key order or spacing alone isn't a change
+    if name == PARAMETER_DOCUMENT:
+        try:
+            return json.loads(current) == json.loads(wanted)
+        except ValueError:
+            return False
+    return current == wanted
+
+
+def plan_pipeline(
+    pipeline, values, existing, parameter_format="hierarchy", prune=False
+):
+    path = parameter_path(pipeline)
+    wanted = desired_parameters(values, existing, parameter_format)
+    changes = []
+    unchanged = 0
+
+    for name, value in sorted(wanted.items()):
+        full_name = path + "/" + name
+        if name not in existing:
+            changes.append(
+                Change("create", full_name, value, tier=parameter_tier(value))
+            )
+        elif not _same(name, existing[name]["Value"], value):
+            # keep SecureStrings secure, and advanced parameters advanced
+            changes.append(
+                Change(
+                    "update",
+                    full_name,
+                    value,
+                    existing[name].get("Type", "String"),
+                    parameter_tier(value, existing[name].get("Tier")),
+                )
+            )
+        else:
+            unchanged += 1
+
+    if prune:
+        for name in sorted(set(existing) - set(wanted)):
+            changes.append(Change("delete", path + "/" + name))
+
+    return changes, unchanged
+
+
+def plan(client, desired, parameter_format="hierarchy", prune=False, sleep=time.sleep):
+    changes = []
+    unchanged = 0
+    for pipeline, values in sorted(desired.items()):
+        path = parameter_path(pipeline)
+        existing = list_parameters(client, path, sleep=sleep)
+        pipeline_changes, pipeline_unchanged = plan_pipeline(
+            pipeline, values, existing, parameter_format, prune
+        )
+        # get-by-path doesn't say what tier a parameter is, so that's only looked up when
+        # there's something to update
+        if any(change.action == "update" for change in pipeline_changes):
+            for name, tier in list_tiers(client, path, sleep=sleep).items():
+                if name in existing:
+                    existing[name]["Tier"] = tier
+            pipeline_changes, pipeline_unchanged = plan_pipeline(
+                pipeline, values, existing, parameter_format, prune
+            )
+        changes.extend(pipeline_changes)
+        unchanged += pipeline_unchanged
+    return changes, unchanged
+
+
+def _put(client, change, sleep):
+    with_backoff(
+        lambda: client.put_parameter(
+            Name=change.name,
+            Value=change.value,
+            Type=change.type,
+            Tier=change.tier,
+            Overwrite=change.action == "update",
+        ),
+        sleep=sleep,
+    )
+
+
+def apply(client, changes, concurrency=DEFAULT_CONCURRENCY, sleep=time.sleep):
+    puts = [change for change in changes if change.action != "delete"]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # list() so the first failure is raised here
+        list(executor.map(lambda change: _put(client, change, sleep), puts))
+
+    deletes = [change.name for change in changes if change.action == "delete"]
+    for start in range(0, len(deletes), DELETE_BATCH_SIZE):
+        batch = deletes[start : start + DELETE_BATCH_SIZE]
+        with_backoff(lambda: client.delete_parameters(Names=batch), sleep=sleep)
+
+
+def load_file(path):
+    with open(path) as fp:
+        desired = json.load(fp)
+    for pipeline, values in desired.items():
+        if not isinstance(values, dict):
+            raise ValueError(
+                "The parameters for " + pipeline + " need to be an object of key: value"
+            )
+    return desired
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Sync the parameters of many pipelines from a JSON file, changing only what differs."
+    )
+    parser.add_argument("file", help="JSON file of pipeline name -> {key: value}")
+    parser.add_argument("--format", choices=PARAMETER_FORMATS, default="hierarchy")
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="delete parameters under a pipeline's path that aren't in the file",
+    )
+    parser.add_argument(
+        "--apply", action="store_true", help="make the changes, not just show them"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="parameters to write at once",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        desired = load_file(args.file)
+    except ValueError as e:
+        parser.error(str(e))
+
+    import boto3
+
+    client = boto3.client("ssm")
+    changes, unchanged = plan(client, desired, args.format, args.prune)
+
+    for change in changes:
+        print("  %-6s %s" % (change.action, change.name))
+    counts = {
+        action: sum(1 for c in changes if c.action == action)
+        for action in ("create", "update", "delete")
+    }
+    print(
+        "%d to create, %d to update, %d to delete, %d unchanged"
+        % (counts["create"], counts["update"], counts["delete"], unchanged)
+    )
+
+    if not changes:
+        return 0
+    if not args.apply:
+        print("Dry run, pass --apply to make these changes")
+        return 0
+
+    apply(client, changes, args.concurrency)
+    print("Done")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
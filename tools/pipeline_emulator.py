@@ -0,0 +1,713 @@
+"""Runs a synthesized pipeline locally, to time its deploy path without AWS accounts.
+
+Reads the pipeline out of a template synthesized from the S3 or CloudFormation
+pipeline stack (`cdk synth` writes them to cdk.out) and runs its stages in
+order against local stand-ins kept in a state directory:
+
+- source actions zip up a local checkout (--source)
+- CodeBuild actions unpack their input into a sandbox directory and run the
+  buildspec's phases there with bash, using the project's environment
+  variables (Parameter Store values come from --parameter), then collect the
+  buildspec's artifacts. `aws s3 cp` to and from s3:// URLs uses the stand-in
+  buckets, the pipeline tools are this checkout's tools/, and the parameter
+  loader is handed the --parameter values under $PARAMETER_PATH
+- S3 deploys unpack into <state>/s3/<bucket>/
+- CloudFormation change sets are worked out against the last template
+  "deployed" to <state>/cloudformation/<stack>.json and applied on execute
+- manual approvals are approved straight away, and Lambda invokes (deploy
+  locks, bakes) are skipped, as they need the real thing
+
+and reports how long each stage and action took:
+
+    cdk synth s3-create-pipeline-myrepo-main -c ... > /dev/null
+    python -m tools.pipeline_emulator cdk.out/s3-create-pipeline-myrepo-main.template.json \\
+        --source ~/code/myrepo --repeat 5
+
+Runtime versions in the buildspec aren't installed, the build uses whatever is
+on this machine. Commands that would install a different toolchain can be left
+out with --skip-command, eg --skip-command '*npm install -g*'. Build output goes
+to a log per action in the state directory.
+
+This module only depends on the standard library (and PyYAML for YAML
+buildspecs and templates).
+"""
+
+import argparse
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import zipfile
+
+from tools.parameter_loader import cache_parameters, expand_document
+from tools.pipeline_run_analyzer import summarize
+from tools.template_preflight import parse_template
+
+PIPELINE_TYPE = "AWS::CodePipeline::Pipeline"
+BUILD_PHASES = ("install", "pre_build", "build", "post_build")
+DEFAULT_STATE_DIR = ".pipeline-emulator"
+PSEUDO_PARAMETERS = {
+    "AWS::AccountId": "000000000000",
+    "AWS::Region": "local",
+    "AWS::Partition": "aws",
+    "AWS::URLSuffix": "amazonaws.com",
+    "AWS::NoValue": None,
+}
+# never packaged into a source artifact
+SOURCE_EXCLUDES = (".git", "cdk.out", "node_modules", "__pycache__")
+# this checkout's tools/, which builds download from $PIPELINE_TOOLS_URL
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS_BUCKET = "pipeline-tools"
+EXECUTION_ID_VARIABLE = "#{codepipeline.PipelineExecutionId}"
+# copies to and from s3:// use the stand-in buckets, anything else goes to the real CLI
+LOCAL_AWS_FUNCTION = """aws() {
+  if [ "$1" = s3 ] && [ "$2" = cp ] && [ "${3#s3://}" != "$3" ]; then
+    cp "$EMULATOR_S3_DIR/${3#s3://}" "$4"
+  elif [ "$1" = s3 ] && [ "$2" = cp ] && [ "${4#s3://}" != "$4" ]; then
+    mkdir -p "$(dirname "$EMULATOR_S3_DIR/${4#s3://}")" && cp "$3" "$EMULATOR_S3_DIR/${4#s3://}"
+  else
+    command aws "$@"
+  fi
+}"""
+
+
+class ActionFailed(Exception):
+    pass
+
+
+class Template:
+    """A synthesized template, with just enough of the intrinsic functions resolved to run it."""
+
+    def __init__(self, body, stack_name):
+        self.body = body
+        self.stack_name = stack_name
+        self.resources = body.get("Resources", {})
+        self.parameters = body.get("Parameters", {})
+
+    def resolve(self, value):
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        if len(value) != 1:
+            return {key: self.resolve(item) for key, item in value.items()}
+
+        function, argument = next(iter(value.items()))
+        if function == "Ref":
+            if argument == "AWS::StackName":
+                return self.stack_name
+            if argument in PSEUDO_PARAMETERS:
+                return PSEUDO_PARAMETERS[argument]
+            if argument in self.parameters:
+                return str(self.parameters[argument].get("Default", ""))
+            # resources are referred to by their logical id, which is how we look them up
+            return argument
+        if function == "Fn::Join":
+            separator, items = argument
+            return separator.join(str(self.resolve(item)) for item in items)
+        if function == "Fn::GetAtt":
+            if isinstance(argument, str):
+                argument = argument.split(".", 1)
+            return argument[0] + "." + argument[1]
+        if function == "Fn::ImportValue":
+            return "import:" + str(self.resolve(argument))
+        if function == "Fn::Sub":
+            text = argument if isinstance(argument, str) else argument[0]
+            for name, pseudo in PSEUDO_PARAMETERS.items():
+                text = text.replace("${" + name + "}", pseudo or "")
+            return text
+        return {function: self.resolve(argument)}
+
+    def pipelines(self):
+        return [
+            logical_id
+            for logical_id, resource in self.resources.items()
+            if resource.get("Type") == PIPELINE_TYPE
+        ]
+
+
+class LocalState:
+    """Directories standing in for S3, Parameter Store and CloudFormation."""
+
+    def __init__(self, state_dir, parameters=None):
+        self.state_dir = state_dir
+        self.parameters = dict(parameters or {})
+        os.makedirs(state_dir, exist_ok=True)
+
+    def path(self, *parts):
+        path = os.path.join(self.state_dir, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def bucket_path(self, bucket, key=""):
+        return self.path("s3", bucket, *[p for p in key.split("/") if p])
+
+    def get_parameter(self, name):
+        if name not in self.parameters:
+            raise ActionFailed(
+                "No value for parameter " + name + ", pass --parameter " + name + "=..."
+            )
+        return self.parameters[name]
+
+    def stack_path(self, stack_name):
+        return self.path("cloudformation", stack_name + ".json")
+
+    def load_stack(self, stack_name):
+        path = self.stack_path(stack_name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fp:
+            return json.load(fp)
+
+    def save_stack(self, stack_name, stack):
+        with open(self.stack_path(stack_name), "w") as fp:
+            json.dump(stack, fp, indent=2)
+
+
+def zip_directory(directory, zip_path, excludes=()):
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if d not in excludes]
+            for name in files:
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, directory))
+
+
+def unzip(zip_path, directory):
+    with zipfile.ZipFile(zip_path) as archive:
+        archive.extractall(directory)
+
+
+def collect_artifacts(artifacts, src_dir, zip_path):
+    """Zip the files a buildspec's `artifacts` section selects, like CodeBuild does."""
+    base = os.path.join(src_dir, artifacts.get("base-directory", "") or "")
+    discard_paths = str(artifacts.get("discard-paths", "no")).lower() in ("yes", "true")
+    patterns = artifacts.get("files") or ["**/*"]
+    if isinstance(patterns, str):
+        patterns = [patterns]
+
+    count = 0
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        seen = set()
+        for pattern in patterns:
+            for path in glob.glob(os.path.join(base, pattern), recursive=True):
+                if not os.path.isfile(path) or path in seen:
+                    continue
+                seen.add(path)
+                name = (
+                    os.path.basename(path)
+                    if discard_paths
+                    else os.path.relpath(path, base)
+                )
+                archive.write(path, name)
+                count += 1
+    if count == 0:
+        raise ActionFailed("The buildspec's artifacts matched no files")
+    return count
+
+
+def substitute(value, variables):
+    """Replace CodePipeline #{...} variables in an action's configuration."""
+    if isinstance(value, list):
+        return [substitute(item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: substitute(item, variables) for key, item in value.items()}
+    if isinstance(value, str):
+        for name, setting in variables.items():
+            value = value.replace(name, setting)
+    return value
+
+
+def _resource_hashes(template):
+    return {
+        logical_id: hashlib.sha256(
+            json.dumps(
+                [resource.get("Type"), resource.get("Properties")], sort_keys=True
+            ).encode()
+        ).hexdigest()
+        for logical_id, resource in template.get("Resources", {}).items()
+    }
+
+
+def change_set(previous, template, parameters):
+    """Resources to add, modify and remove to get from the deployed stack to this template."""
+    old = previous["resources"] if previous else {}
+    new = _resource_hashes(template)
+    changes = {
+        "add": sorted(set(new) - set(old)),
+        "modify": sorted(k for k in set(new) & set(old) if new[k] != old[k]),
+        "remove": sorted(set(old) - set(new)),
+    }
+    if previous and previous.get("parameters") != parameters:
+        changes["parameters"] = True
+    return {"resources": new, "parameters": parameters, "changes": changes}
+
+
+class PipelineEmulator:
+    def __init__(
+        self,
+        template,
+        pipeline_id,
+        state,
+        source_dir,
+        skip_phases=(),
+        env=None,
+        out=sys.stderr,
+        skip_commands=(),
+    ):
+        self.template = template
+        self.pipeline = template.resources[pipeline_id]["Properties"]
+        self.name = template.resolve(self.pipeline.get("Name")) or pipeline_id
+        self.state = state
+        self.source_dir = source_dir
+        self.skip_phases = set(skip_phases)
+        self.skip_commands = list(skip_commands)
+        self.tools_uploaded = False
+        self.env = dict(env or {})
+        self.out = out
+        self.runs = 0
+
+    def run(self):
+        self.runs += 1
+        execution_id = time.strftime("%Y%m%dT%H%M%S") + "-" + str(self.runs)
+        self.execution_id = execution_id
+        self.artifacts = {}
+        self.work_dir = self.state.path("executions", self.name, execution_id, "")
+        result = {"pipeline": self.name, "execution": execution_id, "stages": []}
+
+        start = time.monotonic()
+        status = "Succeeded"
+        for stage in self.pipeline["Stages"]:
+            stage_result = self.run_stage(stage)
+            result["stages"].append(stage_result)
+            if stage_result["status"] == "Failed":
+                status = "Failed"
+                break
+        result["status"] = status
+        result["seconds"] = time.monotonic() - start
+        return result
+
+    def run_stage(self, stage):
+        actions = sorted(stage["Actions"], key=lambda a: a.get("RunOrder", 1))
+        stage_result = {"stage": stage["Name"], "status": "Succeeded", "actions": []}
+        start = time.monotonic()
+        for action in actions:
+            action_start = time.monotonic()
+            try:
+                status, detail = self.run_action(action)
+            except ActionFailed as e:
+                status, detail = "Failed", str(e)
+            stage_result["actions"].append(
+                {
+                    "action": action["Name"],
+                    "status": status,
+                    "detail": detail,
+                    "seconds": time.monotonic() - action_start,
+                }
+            )
+            print(
+                "%s/%s: %s %s" % (stage["Name"], action["Name"], status, detail),
+                file=self.out,
+            )
+            if status == "Failed":
+                stage_result["status"] = "Failed"
+                break
+        stage_result["seconds"] = time.monotonic() - start
+        return stage_result
+
+    def run_action(self, action):
+        type_id = action["ActionTypeId"]
+        category, provider = type_id["Category"], type_id["Provider"]
+        config = substitute(
+            self.template.resolve(action.get("Configuration", {})),
+            {EXECUTION_ID_VARIABLE: self.execution_id},
+        )
+        inputs = [a["Name"] for a in action.get("InputArtifacts", [])]
+        outputs = [a["Name"] for a in action.get("OutputArtifacts", [])]
+
+        if category == "Source":
+            return self.source(outputs[0], config)
+        if provider == "CodeBuild":
+            return self.codebuild(action["Name"], config, inputs, outputs)
+        if category == "Approval":
+            return "Succeeded", "approved"
+        if provider == "S3" and category == "Deploy":
+            return self.s3_deploy(config, inputs[0])
+        if provider == "CloudFormation":
+            return self.cloudformation(config)
+        return "Skipped", provider + " actions aren't emulated"
+
+    def artifact_path(self, name):
+        if name not in self.artifacts:
+            raise ActionFailed("Artifact " + name + " hasn't been produced")
+        return self.artifacts[name]
+
+    def source(self, output, config):
+        zip_path = os.path.join(self.work_dir, output + ".zip")
+        zip_directory(self.source_dir, zip_path, SOURCE_EXCLUDES)
+        self.artifacts[output] = zip_path
+        detail = "%.1f MB" % (os.path.getsize(zip_path) / 1e6)
+        if config.get("OutputArtifactFormat") == "CODEBUILD_CLONE_REF":
+            detail += ", full clone emulated with a zip"
+        return "Succeeded", detail
+
+    def build_environment(self, project, buildspec, src_dir):
+        env = dict(os.environ)
+        env.update(
+            {
+                "CODEBUILD_SRC_DIR": src_dir,
+                "CODEBUILD_BUILD_ID": self.name + ":local",
+                "AWS_REGION": PSEUDO_PARAMETERS["AWS::Region"],
+                "EMULATOR_S3_DIR": self.state.path("s3", ""),
+            }
+        )
+        for variable in project.get("Environment", {}).get("EnvironmentVariables", []):
+            value = self.template.resolve(variable.get("Value"))
+            if variable.get("Type") == "PARAMETER_STORE":
+                value = self.state.get_parameter(value)
+            env[variable["Name"]] = str(value)
+
+        # the tools asset's URL is only known once it's deployed, so builds get this checkout's
+        if "PIPELINE_TOOLS_URL" in env:
+            env["PIPELINE_TOOLS_URL"] = self.tools_url()
+        # and the parameter loader finds the --parameter values in its cache
+        if "PARAMETER_PATH" in env:
+            env["PARAMETER_CACHE_DIR"] = self.state.path("parameter-cache", "")
+            path = "/" + env["PARAMETER_PATH"].strip("/")
+            cache_parameters(
+                env["PARAMETER_CACHE_DIR"],
+                env["PARAMETER_PATH"],
+                expand_document(
+                    {
+                        name[len(path) + 1 :]: value
+                        for name, value in self.state.parameters.items()
+                        if name.startswith(path + "/")
+                    }
+                ),
+            )
+
+        spec_env = buildspec.get("env") or {}
+        env.update({k: str(v) for k, v in (spec_env.get("variables") or {}).items()})
+        for name, parameter in (spec_env.get("parameter-store") or {}).items():
+            env[name] = self.state.get_parameter(parameter)
+        env.update(self.env)
+        return env
+
+    def tools_url(self):
+        key = "tools.zip"
+        if not self.tools_uploaded:
+            zip_directory(
+                TOOLS_DIR, self.state.bucket_path(TOOLS_BUCKET, key), SOURCE_EXCLUDES
+            )
+            self.tools_uploaded = True
+        return "s3://" + TOOLS_BUCKET + "/" + key
+
+    def load_buildspec(self, project, src_dir):
+        spec = project.get("Source", {}).get("BuildSpec")
+        spec = self.template.resolve(spec) if spec else "buildspec.yml"
+        if "\n" not in spec and not spec.lstrip().startswith("{"):
+            path = os.path.join(src_dir, spec)
+            if not os.path.exists(path):
+                raise ActionFailed("No " + spec + " in the source")
+            with open(path) as fp:
+                spec = fp.read()
+        try:
+            return parse_template(spec)
+        except ValueError as e:
+            raise ActionFailed(str(e))
+
+    def codebuild(self, action_name, config, inputs, outputs):
+        project_id = config.get("ProjectName")
+        project = self.template.resources.get(project_id, {}).get("Properties")
+        if project is None:
+            return "Skipped", "project " + str(project_id) + " isn't in this template"
+
+        src_dir = os.path.join(self.work_dir, action_name, "src")
+        os.makedirs(src_dir)
+        if inputs:
+            unzip(self.artifact_path(inputs[0]), src_dir)
+
+        buildspec = self.load_buildspec(project, src_dir)
+        env = self.build_environment(project, buildspec, src_dir)
+        env_file = os.path.join(self.work_dir, action_name, "env.sh")
+        log_path = os.path.join(self.work_dir, action_name, "build.log")
+
+        phase_seconds = {}
+        with open(log_path, "w") as log:
+            for phase in BUILD_PHASES:
+                commands = ((buildspec.get("phases") or {}).get(phase) or {}).get(
+                    "commands"
+                ) or []
+                if not commands or phase in self.skip_phases:
+                    continue
+                # each phase starts in the source directory with the variables the last one exported
+                script = ["set -e", LOCAL_AWS_FUNCTION]
+                if os.path.exists(env_file):
+                    script.append(". " + env_file)
+                for command in commands:
+                    if any(fnmatch.fnmatchcase(command, p) for p in self.skip_commands):
+                        script.append("echo " + shlex.quote("skipped: " + command))
+                    else:
+                        script.append(command)
+                script.append("export -p > " + env_file)
+
+                log.write("[%s]\n" % phase)
+                log.flush()
+                phase_start = time.monotonic()
+                returncode = subprocess.call(
+                    ["bash", "-c", "\n".join(script)],
+                    cwd=src_dir,
+                    env=env,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                )
+                phase_seconds[phase] = time.monotonic() - phase_start
+                if returncode != 0:
+                    raise ActionFailed(
+                        "%s phase failed (exit %d), see %s"
+                        % (phase, returncode, log_path)
+                    )
+
+        for output in outputs:
+            zip_path = os.path.join(self.work_dir, output + ".zip")
+            collect_artifacts(buildspec.get("artifacts") or {}, src_dir, zip_path)
+            self.artifacts[output] = zip_path
+
+        return "Succeeded", ", ".join(
+            "%s %.1fs" % (phase, seconds) for phase, seconds in phase_seconds.items()
+        )
+
+    def s3_deploy(self, config, input_name):
+        bucket = config["BucketName"]
+        key = config.get("ObjectKey", "") or ""
+        if str(config.get("Extract", "true")).lower() == "true":
+            target = self.state.bucket_path(bucket, key)
+            os.makedirs(target, exist_ok=True)
+            unzip(self.artifact_path(input_name), target)
+        else:
+            target = self.state.bucket_path(bucket, key)
+            shutil.copyfile(self.artifact_path(input_name), target)
+        return "Succeeded", "s3://" + bucket + "/" + key
+
+    def _template_from(self, template_path):
+        artifact, _, path = template_path.partition("::")
+        with zipfile.ZipFile(self.artifact_path(artifact)) as archive:
+            try:
+                body = archive.read(path).decode()
+            except KeyError:
+                raise ActionFailed(path + " isn't in the " + artifact + " artifact")
+        try:
+            return parse_template(body)
+        except ValueError as e:
+            raise ActionFailed(str(e))
+
+    def cloudformation(self, config):
+        mode = config.get("ActionMode")
+        stack_name = config["StackName"]
+        previous = self.state.load_stack(stack_name)
+
+        if mode == "DELETE_ONLY":
+            if previous:
+                os.remove(self.state.stack_path(stack_name))
+            return "Succeeded", "deleted " + stack_name
+
+        if mode == "CHANGE_SET_EXECUTE":
+            pending = (
+                (previous or {})
+                .get("change_sets", {})
+                .pop(config.get("ChangeSetName"), None)
+            )
+            if pending is None:
+                raise ActionFailed("No change set " + str(config.get("ChangeSetName")))
+            # like CloudFormation, executing a change set deletes the stack's others
+            pending["change_sets"] = {}
+            self.state.save_stack(stack_name, pending)
+            return "Succeeded", _describe_changes(pending["changes"])
+
+        template = self._template_from(config["TemplatePath"])
+        parameters = json.loads(config.get("ParameterOverrides") or "{}")
+        proposed = change_set(previous, template, parameters)
+
+        if mode == "CHANGE_SET_REPLACE":
+            stack = previous or {"resources": {}, "parameters": None}
+            stack.setdefault("change_sets", {})[config["ChangeSetName"]] = proposed
+            self.state.save_stack(stack_name, stack)
+            return "Succeeded", "change set: " + _describe_changes(proposed["changes"])
+
+        # CREATE_UPDATE and REPLACE_ON_FAILURE deploy straight away
+        proposed["change_sets"] = (previous or {}).get("change_sets", {})
+        self.state.save_stack(stack_name, proposed)
+        return "Succeeded", _describe_changes(proposed["changes"])
+
+
+def _describe_changes(changes):
+    return "%d to add, %d to modify, %d to remove" % (
+        len(changes["add"]),
+        len(changes["modify"]),
+        len(changes["remove"]),
+    )
+
+
+def find_template(path, stack=None):
+    if os.path.isfile(path):
+        return path
+    candidates = sorted(glob.glob(os.path.join(path, "*.template.json")))
+    if stack:
+        candidates = [
+            c for c in candidates if os.path.basename(c) == stack + ".template.json"
+        ]
+    else:
+        candidates = [
+            c
+            for c in candidates
+            if fnmatch.fnmatch(os.path.basename(c), "*-create-pipeline-*")
+        ]
+    if len(candidates) != 1:
+        raise ValueError(
+            "Found %d pipeline templates in %s, pass the template or --stack"
+            % (len(candidates), path)
+        )
+    return candidates[0]
+
+
+def print_report(results, out=sys.stdout):
+    last = results[-1]
+    print(
+        "%s: %s in %.1fs" % (last["pipeline"], last["status"], last["seconds"]),
+        file=out,
+    )
+    for stage in last["stages"]:
+        print("  %-20s %8.1fs" % (stage["stage"], stage["seconds"]), file=out)
+        for action in stage["actions"]:
+            print(
+                "    %-18s %8.1fs  %s %s"
+                % (
+                    action["action"],
+                    action["seconds"],
+                    action["status"],
+                    action["detail"],
+                ),
+                file=out,
+            )
+
+    if len(results) > 1:
+        print("\nOver %d runs" % len(results), file=out)
+        for name, summary in timing_summary(results).items():
+            print(
+                "  %-20s p50 %6.1fs  max %6.1fs"
+                % (name, summary["p50"], summary["max"]),
+                file=out,
+            )
+
+
+def timing_summary(results):
+    durations = {"(pipeline)": [r["seconds"] for r in results]}
+    for result in results:
+        for stage in result["stages"]:
+            durations.setdefault(stage["stage"], []).append(stage["seconds"])
+    return {name: summarize(values) for name, values in durations.items()}
+
+
+def _parse_assignment(value):
+    name, separator, setting = value.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE, not " + value)
+    return name, setting
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a synthesized pipeline locally against stand-in S3, SSM and CloudFormation, timing each stage."
+    )
+    parser.add_argument("template", help="a pipeline stack's template, or cdk.out")
+    parser.add_argument("--stack", help="the pipeline stack to run, when given cdk.out")
+    parser.add_argument(
+        "--source", default=".", help="the checkout the source stage packages"
+    )
+    parser.add_argument("--state-dir", default=DEFAULT_STATE_DIR)
+    parser.add_argument(
+        "--parameter",
+        action="append",
+        default=[],
+        type=_parse_assignment,
+        metavar="NAME=VALUE",
+        help="a Parameter Store value, eg /pipeline-myrepo-main/api_key=abc",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        type=_parse_assignment,
+        metavar="NAME=VALUE",
+        help="override a build environment variable",
+    )
+    parser.add_argument(
+        "--skip-phase",
+        action="append",
+        default=[],
+        choices=BUILD_PHASES,
+        help="buildspec phases not to run, all of their commands are left out",
+    )
+    parser.add_argument(
+        "--skip-command",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="buildspec commands not to run, as shell-style patterns, eg '*npm install -g*'",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="run the pipeline this many times"
+    )
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        template_path = find_template(args.template, args.stack)
+        with open(template_path) as fp:
+            body = parse_template(fp.read())
+    except ValueError as e:
+        parser.error(str(e))
+
+    stack_name = os.path.basename(template_path).split(".template.json")[0]
+    template = Template(body, stack_name)
+    pipelines = template.pipelines()
+    if not pipelines:
+        parser.error("There's no pipeline in " + template_path)
+
+    state = LocalState(os.path.abspath(args.state_dir), dict(args.parameter))
+    emulator = PipelineEmulator(
+        template,
+        pipelines[0],
+        state,
+        os.path.abspath(args.source),
+        skip_phases=args.skip_phase,
+        env=dict(args.env),
+        skip_commands=args.skip_command,
+    )
+
+    results = []
+    for _ in range(max(1, args.repeat)):
+        results.append(emulator.run())
+        if results[-1]["status"] == "Failed":
+            break
+
+    if args.json:
+        json.dump(
+            {"runs": results, "summary": timing_summary(results)},
+            sys.stdout,
+            indent=2,
+        )
+        print()
+    else:
+        print_report(results)
+    return 0 if results[-1]["status"] == "Succeeded" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,532 @@
+"""Offline analysis of exported CodePipeline execution history.
+
+Reads the JSON written by
+
+    aws codepipeline list-pipeline-executions --pipeline-name <name>
+    aws codepipeline list-action-executions --pipeline-name <name>
+
+for any number of pipelines and reports, across the whole fleet:
+
+- p50/p95/p99 execution and stage durations
+- the actions that most often sit on the critical path of an execution
+- manual approval latency
+- time lost to failed action attempts that then had to be retried
+
+Usage:
+
+    python -m tools.pipeline_run_analyzer exports/ [--by-pipeline] [--json]
+
+Arguments can be files or directories (searched for *.json, *.jsonl and
+*.ndjson). Each record is attributed to its `pipelineName` field if it has one,
+otherwise to the nearest file or directory name starting with `pipeline-`, eg
+exports/pipeline-myrepo-main/actions.json or exports/pipeline-myrepo-main.actions.json.
+
+Exports are streamed, one record at a time, so they never have to fit in memory
+as a whole. Only a few numbers per action attempt are kept, and only until all
+the files for that pipeline have been read.
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+RECORD_ARRAYS = ("actionExecutionDetails", "pipelineExecutionSummaries")
+PIPELINE_PREFIX = "pipeline-"
+EXPORT_SUFFIXES = (".json", ".jsonl", ".ndjson")
+CHUNK_SIZE = 1 << 16
+PERCENTILES = (50, 95, 99)
+# the CLI writes times like 2021-03-01T11:00:00.123000+11:00, CloudTrail like 2021-03-01T00:00:00Z
+TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z")
+UTC_OFFSET = re.compile(r"([+-]\d\d):?(\d\d)$")
+
+
+class StreamingRecordReader:
+    """
+    Yields records from a JSON export without parsing the whole file at once.
+
+    Understands a top-level object holding record arrays (the CLI output, including
+    several pages concatenated together), a top-level array of records, and one
+    record per line.
+    """
+
+    def __init__(self, fp, array_keys=RECORD_ARRAYS):
+        self.fp = fp
+        self.array_keys = array_keys
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.fp.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while self.pos >= len(self.buffer):
+                if not self._fill():
+                    return None
+            char = self.buffer[self.pos]
+            if not char.isspace():
+                return char
+            self.pos += 1
+
+    def _decode_value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # most likely the value runs on into the next chunk
+                if not self._fill():
+                    raise
+                continue
+            # a number that ends with the buffer might carry on in the next chunk
+            if end == len(self.buffer) and isinstance(value, (int, float)):
+                if self._fill():
+                    continue
+            self.pos = end
+            return value
+
+    def _expect(self, char):
+        if self._skip_whitespace() != char:
+            raise ValueError("Expected '%s' at offset %d" % (char, self.pos))
+        self.pos += 1
+
+    def _array(self):
+        self._expect("[")
+        while True:
+            char = self._skip_whitespace()
+            if char is None:
+                raise ValueError("Unterminated array")
+            if char == "]":
+                self.pos += 1
+                return
+            if char == ",":
+                self.pos += 1
+                continue
+            yield self._decode_value()
+
+    def _object(self):
+        self._expect("{")
+        found_array = False
+        fields = {}
+        while True:
+            char = self._skip_whitespace()
+            if char is None:
+                raise ValueError("Unterminated object")
+            if char == "}":
+                self.pos += 1
+                break
+            if char == ",":
+                self.pos += 1
+                continue
+            key = self._decode_value()
+            self._expect(":")
+            if key in self.array_keys and self._skip_whitespace() == "[":
+                found_array = True
+                yield from self._array()
+            else:
+                fields[key] = self._decode_value()
+
+        # an object without record arrays is a record itself (eg one line of a .jsonl file)
+        if not found_array and fields:
+            yield fields
+
+    def __iter__(self):
+        while True:
+            char = self._skip_whitespace()
+            if char is None:
+                return
+            if char == "[":
+                yield from self._array()
+            elif char == "{":
+                yield from self._object()
+            else:
+                raise ValueError("Unexpected '%s' at offset %d" % (char, self.pos))
+
+
+def iter_records(path):
+    with open(path, encoding="utf-8") as fp:
+        yield from StreamingRecordReader(fp)
+
+
+def find_export_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(EXPORT_SUFFIXES):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def pipeline_for_path(path):
+    # the nearest file or directory name that looks like one of our pipelines
+    parts = os.path.normpath(os.path.abspath(path)).split(os.sep)
+    for part in reversed(parts):
+        if part.startswith(PIPELINE_PREFIX):
+            name = part
+            for suffix in EXPORT_SUFFIXES:
+                if name.endswith(suffix):
+                    name = name[: -len(suffix)]
+            # pipeline names can't contain dots, so pipeline-x.actions.json is pipeline-x
+            return name.split(".", 1)[0]
+    return None
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    # strptime only takes +hhmm for %z before Python 3.7, and times without an offset are UTC
+    text = value.strip().replace(" ", "T", 1)
+    if text.endswith("Z"):
+        text = text[:-1] + "+0000"
+    elif UTC_OFFSET.search(text):
+        text = UTC_OFFSET.sub(r"\1\2", text)
+    else:
+        text += "+0000"
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(text, time_format).timestamp()
+        except ValueError:
+            continue
+    raise ValueError("Can't read the time " + repr(value))
+
+
+def percentile(values, pct):
+    """Linearly interpolated percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(math.floor(rank))
+    high = int(math.ceil(rank))
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(values):
+    values = sorted(values)
+    summary = {"count": len(values), "total": sum(values)}
+    for pct in PERCENTILES:
+        summary["p%d" % pct] = percentile(values, pct)
+    summary["max"] = values[-1] if values else None
+    return summary
+
+
+class Attempt:
+    __slots__ = ("stage", "action", "category", "status", "start", "end")
+
+    def __init__(self, record):
+        self.stage = record.get("stageName")
+        self.action = record.get("actionName")
+        self.category = record.get("input", {}).get("actionTypeId", {}).get("category")
+        self.status = record.get("status")
+        self.start = parse_time(record.get("startTime"))
+        self.end = parse_time(record.get("lastUpdateTime")) or self.start
+
+    @property
+    def duration(self):
+        return max((self.end or 0) - (self.start or 0), 0)
+
+
+def critical_path(attempts):
+    """
+    Walk back from the attempt that finished last, each time stepping to the attempt
+    that finished latest before the current one started, ie the one that gated it.
+    """
+    attempts = [a for a in attempts if a.start is not None]
+    if not attempts:
+        return []
+    current = max(attempts, key=lambda a: a.end)
+    path = [current]
+    visited = {id(current)}
+    while True:
+        gating = [
+            a for a in attempts if a.end <= current.start and id(a) not in visited
+        ]
+        if not gating:
+            break
+        current = max(gating, key=lambda a: a.end)
+        visited.add(id(current))
+        path.append(current)
+    path.reverse()
+    return path
+
+
+class FleetAnalysis:
+    def __init__(self, by_pipeline=False):
+        self.by_pipeline = by_pipeline
+        self.execution_durations = defaultdict(list)
+        self.execution_statuses = defaultdict(lambda: defaultdict(int))
+        self.stage_durations = defaultdict(list)
+        self.approval_waits = defaultdict(list)
+        self.retry_loss = defaultdict(float)
+        self.failed_attempts = defaultdict(int)
+        self.critical_time = defaultdict(float)
+        self.critical_count = defaultdict(int)
+        self.critical_paths = defaultdict(int)
+        self.pipelines = set()
+        # pipeline -> execution id -> attempts, released once the pipeline is finished
+        self._pending = defaultdict(lambda: defaultdict(list))
+
+    def _group(self, pipeline, name):
+        return (pipeline, name) if self.by_pipeline else name
+
+    def add_record(self, pipeline, record):
+        self.pipelines.add(pipeline)
+        execution_id = record.get("pipelineExecutionId")
+
+        if "stageName" in record and "actionName" in record:
+            self._pending[pipeline][execution_id].append(Attempt(record))
+
+        elif "status" in record and execution_id:
+            start = parse_time(record.get("startTime"))
+            end = parse_time(record.get("lastUpdateTime"))
+            group = self._group(pipeline, "execution")
+            self.execution_statuses[group][record["status"]] += 1
+            if (
+                start is not None
+                and end is not None
+                and record["status"] != "InProgress"
+            ):
+                self.execution_durations[group].append(max(end - start, 0))
+
+    def finish_pipeline(self, pipeline):
+        for execution_id, attempts in self._pending.pop(pipeline, {}).items():
+            self._analyze_execution(pipeline, attempts)
+
+    def finish(self):
+        for pipeline in list(self._pending):
+            self.finish_pipeline(pipeline)
+
+    def _analyze_execution(self, pipeline, attempts):
+        by_stage = defaultdict(list)
+        for attempt in attempts:
+            by_stage[attempt.stage].append(attempt)
+
+        for stage, stage_attempts in by_stage.items():
+            timed = [a for a in stage_attempts if a.start is not None]
+            if timed:
+                duration = max(a.end for a in timed) - min(a.start for a in timed)
+                self.stage_durations[self._group(pipeline, stage)].append(duration)
+
+        # failed attempts of an action that later succeeded in the same execution were retried
+        succeeded = {(a.stage, a.action) for a in attempts if a.status == "Succeeded"}
+        for attempt in attempts:
+            if attempt.status == "Failed":
+                self.failed_attempts[self._group(pipeline, attempt.stage)] += 1
+                if (attempt.stage, attempt.action) in succeeded:
+                    self.retry_loss[
+                        self._group(pipeline, attempt.stage + "/" + attempt.action)
+                    ] += attempt.duration
+
+            if attempt.category == "Approval" and attempt.status == "Succeeded":
+                self.approval_waits[self._group(pipeline, "approval")].append(
+                    attempt.duration
+                )
+
+        path = critical_path(attempts)
+        for attempt in path:
+            name = self._group(pipeline, attempt.stage + "/" + attempt.action)
+            self.critical_time[name] += attempt.duration
+            self.critical_count[name] += 1
+        if path:
+            self.critical_paths[" > ".join(a.stage + "/" + a.action for a in path)] += 1
+
+    def report(self, top=10):
+        def summaries(source):
+            return {
+                _label(group): summarize(values)
+                for group, values in sorted(source.items(), key=lambda i: str(i[0]))
+            }
+
+        critical_total = sum(self.critical_time.values()) or 1
+        return {
+            "pipelines": len(self.pipelines),
+            "executions": summaries(self.execution_durations),
+            "execution_statuses": {
+                _label(group): dict(statuses)
+                for group, statuses in self.execution_statuses.items()
+            },
+            "stages": summaries(self.stage_durations),
+            "approvals": summaries(self.approval_waits),
+            "critical_path_actions": [
+                {
+                    "action": _label(name),
+                    "executions": self.critical_count[name],
+                    "seconds": seconds,
+                    "share": seconds / critical_total,
+                }
+                for name, seconds in sorted(
+                    self.critical_time.items(), key=lambda i: -i[1]
+                )[:top]
+            ],
+            "common_critical_paths": [
+                {"path": path, "executions": count}
+                for path, count in sorted(
+                    self.critical_paths.items(), key=lambda i: -i[1]
+                )[:top]
+            ],
+            "failed_attempts": {
+                _label(group): count for group, count in self.failed_attempts.items()
+            },
+            "retry_loss_seconds": {
+                _label(name): seconds
+                for name, seconds in sorted(
+                    self.retry_loss.items(), key=lambda i: -i[1]
+                )
+            },
+        }
+
+
+def _label(group):
+    return " ".join(group) if isinstance(group, tuple) else group
+
+
+def _seconds(value):
+    if value is None:
+        return "-"
+    if value >= 3600:
+        return "%.1fh" % (value / 3600)
+    if value >= 60:
+        return "%.1fm" % (value / 60)
+    return "%.0fs" % value
+
+
+def print_report(report, out=sys.stdout):
+    def table(title, summaries):
+        print("\n" + title, file=out)
+        if not summaries:
+            print("  (no data)", file=out)
+            return
+        width = max(len(name) for name in summaries)
+        print(
+            "  %-*s %7s %8s %8s %8s %8s"
+            % (width, "", "count", "p50", "p95", "p99", "max"),
+            file=out,
+        )
+        for name, summary in summaries.items():
+            print(
+                "  %-*s %7d %8s %8s %8s %8s"
+                % (
+                    width,
+                    name,
+                    summary["count"],
+                    _seconds(summary["p50"]),
+                    _seconds(summary["p95"]),
+                    _seconds(summary["p99"]),
+                    _seconds(summary["max"]),
+                ),
+                file=out,
+            )
+
+    print("Pipelines analysed: %d" % report["pipelines"], file=out)
+    table("Execution duration", report["executions"])
+    for group, statuses in report["execution_statuses"].items():
+        print(
+            "  %s: %s"
+            % (group, ", ".join("%s %d" % s for s in sorted(statuses.items()))),
+            file=out,
+        )
+    table("Stage duration", report["stages"])
+    table("Approval latency", report["approvals"])
+
+    print("\nCritical path (share of critical time)", file=out)
+    for entry in report["critical_path_actions"]:
+        print(
+            "  %5.1f%%  %-40s %s over %d executions"
+            % (
+                entry["share"] * 100,
+                entry["action"],
+                _seconds(entry["seconds"]),
+                entry["executions"],
+            ),
+            file=out,
+        )
+    for entry in report["common_critical_paths"][:3]:
+        print("  %dx  %s" % (entry["executions"], entry["path"]), file=out)
+
+    print("\nTime lost to failed attempts that were retried", file=out)
+    if not report["retry_loss_seconds"]:
+        print("  (none)", file=out)
+    for name, seconds in report["retry_loss_seconds"].items():
+        print("  %-40s %s" % (name, _seconds(seconds)), file=out)
+
+
+def analyze(paths, by_pipeline=False, pipeline=None):
+    analysis = FleetAnalysis(by_pipeline=by_pipeline)
+
+    # read each pipeline's files together so its attempts can be released as soon as it's done
+    files = sorted(
+        find_export_files(paths),
+        key=lambda p: (pipeline or pipeline_for_path(p) or "", p),
+    )
+    current = None
+    for path in files:
+        path_pipeline = pipeline or pipeline_for_path(path)
+        if current is not None and path_pipeline != current:
+            analysis.finish_pipeline(current)
+        current = path_pipeline
+
+        for record in iter_records(path):
+            name = record.get("pipelineName") or path_pipeline
+            if name is None:
+                raise ValueError(
+                    "Can't tell which pipeline the records in "
+                    + path
+                    + " belong to, name the file or directory after the pipeline or pass --pipeline"
+                )
+            analysis.add_record(name, record)
+
+    analysis.finish()
+    return analysis
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Report stage percentiles, critical paths, approval latency and retry losses from exported pipeline history."
+    )
+    parser.add_argument("paths", nargs="+", help="export files or directories")
+    parser.add_argument(
+        "--pipeline", help="attribute every record to this pipeline name"
+    )
+    parser.add_argument(
+        "--by-pipeline",
+        action="store_true",
+        help="report each pipeline separately instead of aggregating the fleet",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="how many critical path entries to show"
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    analysis = analyze(args.paths, by_pipeline=args.by_pipeline, pipeline=args.pipeline)
+    report = analysis.report(top=args.top)
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,439 @@
+"""Static pre-flight checks for a packaged CloudFormation template.
+
+Catches the template errors that would otherwise only surface in the target
+account after CreateChangeSet has assumed the cross-account role: bad
+intrinsic references, templates over the CloudFormation limits, parameter
+overrides that don't match the declared parameters and missing capabilities.
+
+Usage:
+
+    python -m tools.template_preflight packaged.yaml \
+        --parameter Environment=staging \
+        --capabilities CAPABILITY_NAMED_IAM,CAPABILITY_AUTO_EXPAND
+
+Exits non-zero if any errors are found. This module only depends on the
+standard library (and PyYAML for YAML templates) so it can be shipped to
+CodeBuild as-is.
+"""
+
+import argparse
+import json
+import re
+import sys
+
+try:
+    import yaml
+except ImportError:  # pragma: no cover - only JSON templates can be read
+    yaml = None
+
+
+# CodePipeline hands the template to CloudFormation via S3, so the S3 limit applies
+MAX_TEMPLATE_BYTES = 1024 * 1024
+# the limit for a template passed inline as a TemplateBody
+MAX_TEMPLATE_BODY_BYTES = 51200
+MAX_RESOURCES = 500
+MAX_PARAMETERS = 200
+MAX_OUTPUTS = 200
+MAX_MAPPINGS = 200
+
+TOP_LEVEL_SECTIONS = {
+    "AWSTemplateFormatVersion",
+    "Description",
+    "Metadata",
+    "Parameters",
+    "Rules",
+    "Mappings",
+    "Conditions",
+    "Transform",
+    "Resources",
+    "Outputs",
+    # only valid alongside the SAM transform
+    "Globals",
+}
+
+PSEUDO_PARAMETERS = {
+    "AWS::AccountId",
+    "AWS::NotificationARNs",
+    "AWS::NoValue",
+    "AWS::Partition",
+    "AWS::Region",
+    "AWS::StackId",
+    "AWS::StackName",
+    "AWS::URLSuffix",
+}
+
+RESOURCE_TYPE_PATTERN = re.compile(
+    r"^(Custom::[A-Za-z0-9_@-]+|[A-Za-z0-9]+::[A-Za-z0-9]+::[A-Za-z0-9]+)$"
+)
+LOGICAL_ID_PATTERN = re.compile(r"^[A-Za-z0-9]+$")
+SUB_VARIABLE_PATTERN = re.compile(r"\$\{([^!}][^}]*)\}")
+
+# resource types that need CAPABILITY_IAM, and the properties that make them "named"
+IAM_RESOURCE_NAME_PROPERTIES = {
+    "AWS::IAM::AccessKey": None,
+    "AWS::IAM::Group": "GroupName",
+    "AWS::IAM::InstanceProfile": "InstanceProfileName",
+    "AWS::IAM::ManagedPolicy": "ManagedPolicyName",
+    "AWS::IAM::Policy": None,
+    "AWS::IAM::Role": "RoleName",
+    "AWS::IAM::User": "UserName",
+    "AWS::IAM::UserToGroupAddition": None,
+}
+
+
+class PreflightResult:
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def error(self, message):
+        self.errors.append(message)
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
+def _cfn_yaml_loader():
+    # SafeLoader that understands the CloudFormation short form intrinsics (!Ref, !Sub, ...)
+    class CloudFormationLoader(yaml.SafeLoader):
+        pass
+
+    def construct_intrinsic(loader, tag_suffix, node):
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+
+        if tag_suffix == "Ref":
+            return {"Ref": value}
+        if tag_suffix == "Condition":
+            return {"Condition": value}
+        if tag_suffix == "GetAtt" and isinstance(value, str):
+            value = value.split(".", 1)
+        return {"Fn::" + tag_suffix: value}
+
+    CloudFormationLoader.add_multi_constructor("!", construct_intrinsic)
+    return CloudFormationLoader
+
+
+def parse_template(body):
+    """Parse a JSON or YAML template body into a dict."""
+    try:
+        return json.loads(body)
+    except ValueError:
+        pass
+
+    if yaml is None:
+        raise ValueError(
+            "PyYAML is required to read YAML templates (pip install pyyaml)"
+        )
+
+    try:
+        return yaml.load(body, Loader=_cfn_yaml_loader())
+    except yaml.YAMLError as e:
+        raise ValueError("Template is not valid JSON or YAML: " + str(e))
+
+
+def _walk(node, path):
+    yield node, path
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield from _walk(value, path + [str(key)])
+    elif isinstance(node, list):
+        for index, value in enumerate(node):
+            yield from _walk(value, path + [str(index)])
+
+
+def _check_references(template, result, lenient):
+    parameters = set((template.get("Parameters") or {}).keys())
+    resources = set((template.get("Resources") or {}).keys())
+    conditions = set((template.get("Conditions") or {}).keys())
+    refable = parameters | resources | PSEUDO_PARAMETERS
+
+    # macros (eg the SAM transform) generate resources we can't see, so only warn about them
+    unresolved = result.warning if lenient else result.error
+
+    for node, path in _walk(template, []):
+        if not isinstance(node, dict) or len(node) != 1:
+            continue
+        location = "/".join(path) or "<root>"
+        ((key, value),) = node.items()
+
+        if key == "Ref":
+            if not isinstance(value, str):
+                result.error(location + ": Ref must be a string")
+            elif value not in refable:
+                unresolved(
+                    location + ": Ref to unknown parameter or resource '" + value + "'"
+                )
+
+        elif key == "Fn::GetAtt":
+            if isinstance(value, str):
+                value = value.split(".", 1)
+            if not isinstance(value, list) or len(value) != 2:
+                result.error(location + ": Fn::GetAtt needs [LogicalId, Attribute]")
+            elif isinstance(value[0], str) and value[0] not in resources:
+                unresolved(
+                    location + ": Fn::GetAtt on unknown resource '" + value[0] + "'"
+                )
+
+        elif key == "Fn::Sub":
+            variables = {}
+            if isinstance(value, list):
+                if len(value) != 2 or not isinstance(value[1], dict):
+                    result.error(
+                        location + ": Fn::Sub needs a string or [string, {variables}]"
+                    )
+                    continue
+                value, variables = value
+            if not isinstance(value, str):
+                continue
+            for name in SUB_VARIABLE_PATTERN.findall(value):
+                name = name.strip()
+                target = name.split(".", 1)[0]
+                if name in variables or name in refable or target in resources:
+                    continue
+                unresolved(
+                    location + ": Fn::Sub references unknown variable '" + name + "'"
+                )
+
+        elif key == "Condition" and isinstance(value, str):
+            if value not in conditions:
+                result.error(location + ": unknown condition '" + value + "'")
+
+    for logical_id, resource in (template.get("Resources") or {}).items():
+        if not isinstance(resource, dict):
+            continue
+        depends_on = resource.get("DependsOn") or []
+        if isinstance(depends_on, str):
+            depends_on = [depends_on]
+        for target in depends_on:
+            if target not in resources:
+                unresolved(
+                    "Resources/"
+                    + logical_id
+                    + ": DependsOn unknown resource '"
+                    + str(target)
+                    + "'"
+                )
+        condition = resource.get("Condition")
+        if isinstance(condition, str) and condition not in conditions:
+            result.error(
+                "Resources/" + logical_id + ": unknown condition '" + condition + "'"
+            )
+
+
+def _check_resources(template, result):
+    resources = template.get("Resources")
+    if not isinstance(resources, dict) or not resources:
+        result.error("Template must declare at least one resource")
+        return
+
+    if len(resources) > MAX_RESOURCES:
+        result.error(
+            "Template declares %d resources, the limit is %d"
+            % (len(resources), MAX_RESOURCES)
+        )
+
+    for logical_id, resource in resources.items():
+        if not LOGICAL_ID_PATTERN.match(str(logical_id)):
+            result.error(
+                "Resources/" + str(logical_id) + ": logical IDs must be alphanumeric"
+            )
+        if not isinstance(resource, dict):
+            result.error("Resources/" + str(logical_id) + ": must be a mapping")
+            continue
+        resource_type = resource.get("Type")
+        if not isinstance(resource_type, str) or not RESOURCE_TYPE_PATTERN.match(
+            resource_type
+        ):
+            result.error(
+                "Resources/"
+                + str(logical_id)
+                + ": invalid or missing Type "
+                + repr(resource_type)
+            )
+
+
+def _check_parameters(template, parameters, result):
+    declared = template.get("Parameters") or {}
+
+    for name, value in parameters.items():
+        if name not in declared:
+            result.error(
+                "Parameter override '" + name + "' is not declared in the template"
+                " (declared: " + (", ".join(sorted(declared)) or "none") + ")"
+            )
+            continue
+
+        definition = declared[name] or {}
+        allowed_values = definition.get("AllowedValues")
+        if allowed_values and value not in [str(v) for v in allowed_values]:
+            result.error(
+                "Parameter '"
+                + name
+                + "' value '"
+                + value
+                + "' is not one of "
+                + ", ".join(str(v) for v in allowed_values)
+            )
+        allowed_pattern = definition.get("AllowedPattern")
+        if allowed_pattern and not re.fullmatch(allowed_pattern, value):
+            result.error(
+                "Parameter '"
+                + name
+                + "' value '"
+                + value
+                + "' does not match "
+                + allowed_pattern
+            )
+
+    for name, definition in declared.items():
+        if name not in parameters and "Default" not in (definition or {}):
+            result.error(
+                "Parameter '" + name + "' has no default and no override was supplied"
+            )
+
+
+def _check_capabilities(template, capabilities, result):
+    resources = template.get("Resources") or {}
+    needs_iam = False
+    named_iam = []
+
+    for logical_id, resource in resources.items():
+        if not isinstance(resource, dict):
+            continue
+        resource_type = resource.get("Type")
+        if resource_type in IAM_RESOURCE_NAME_PROPERTIES:
+            needs_iam = True
+            name_property = IAM_RESOURCE_NAME_PROPERTIES[resource_type]
+            if name_property and name_property in (resource.get("Properties") or {}):
+                named_iam.append(logical_id)
+
+    if named_iam and "CAPABILITY_NAMED_IAM" not in capabilities:
+        result.error(
+            "CAPABILITY_NAMED_IAM is required for named IAM resources: "
+            + ", ".join(sorted(named_iam))
+        )
+    elif needs_iam and not {"CAPABILITY_IAM", "CAPABILITY_NAMED_IAM"} & set(
+        capabilities
+    ):
+        result.error(
+            "CAPABILITY_IAM is required because the template creates IAM resources"
+        )
+
+    if template.get("Transform") and "CAPABILITY_AUTO_EXPAND" not in capabilities:
+        result.error(
+            "CAPABILITY_AUTO_EXPAND is required because the template uses a Transform"
+        )
+
+
+def check_template(body, parameters=None, capabilities=None):
+    """Run all the static checks over a template body and return a PreflightResult."""
+    result = PreflightResult()
+    parameters = parameters or {}
+    capabilities = capabilities or []
+
+    size = len(body.encode("utf-8")) if isinstance(body, str) else len(body)
+    if size > MAX_TEMPLATE_BYTES:
+        result.error(
+            "Template is %d bytes, the limit is %d" % (size, MAX_TEMPLATE_BYTES)
+        )
+    elif size > MAX_TEMPLATE_BODY_BYTES:
+        result.warning(
+            "Template is %d bytes, it can only be deployed from S3 (inline limit %d)"
+            % (size, MAX_TEMPLATE_BODY_BYTES)
+        )
+
+    try:
+        template = parse_template(body)
+    except ValueError as e:
+        result.error(str(e))
+        return result
+
+    if not isinstance(template, dict):
+        result.error("Template must be a mapping at the top level")
+        return result
+
+    for section in template:
+        if section not in TOP_LEVEL_SECTIONS:
+            result.error("Unknown top-level section '" + str(section) + "'")
+
+    for section, limit in (
+        ("Parameters", MAX_PARAMETERS),
+        ("Outputs", MAX_OUTPUTS),
+        ("Mappings", MAX_MAPPINGS),
+    ):
+        count = len(template.get(section) or {})
+        if count > limit:
+            result.error(
+                "Template declares %d %s, the limit is %d" % (count, section, limit)
+            )
+
+    _check_resources(template, result)
+    _check_references(template, result, lenient=bool(template.get("Transform")))
+    _check_parameters(template, parameters, result)
+    _check_capabilities(template, capabilities, result)
+
+    return result
+
+
+def _parse_parameter(value):
+    if "=" not in value:
+        raise argparse.ArgumentTypeError("parameters must be given as Key=Value")
+    return tuple(value.split("=", 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Statically validate a CloudFormation template before creating a change set."
+    )
+    parser.add_argument("template", help="path to the template, eg packaged.yaml")
+    parser.add_argument(
+        "--parameter",
+        action="append",
+        default=[],
+        type=_parse_parameter,
+        metavar="KEY=VALUE",
+        help="a parameter override that will be passed to the change set (repeatable)",
+    )
+    parser.add_argument(
+        "--capabilities",
+        default="",
+        help="comma separated capabilities the change set will be created with",
+    )
+    args = parser.parse_args(argv)
+
+    with open(args.template, "rb") as fp:
+        body = fp.read().decode("utf-8")
+
+    result = check_template(
+        body,
+        parameters=dict(args.parameter),
+        capabilities=[c for c in args.capabilities.split(",") if c],
+    )
+
+    for warning in result.warnings:
+        print("WARNING: " + warning)
+    for error in result.errors:
+        print("ERROR: " + error)
+
+    if result.ok:
+        print("Pre-flight checks passed for " + args.template)
+        return 0
+
+    print(
+        "Pre-flight checks failed for %s with %d error(s)"
+        % (args.template, len(result.errors))
+    )
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())